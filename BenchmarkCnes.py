@@ -0,0 +1,1222 @@
+import argparse
+import asyncio
+import csv
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime
+
+from GerarScriptSQLCnes import CAMPOS
+
+
+def gerar_registro_sintetico(codigo_cnes):
+    """
+    Gera um registro no formato retornado por /cnes/estabelecimentos/{codigo},
+    com valores determinísticos a partir do código
+    """
+    rnd = random.Random(codigo_cnes)
+    registro = {campo: f'{campo.upper()} {codigo_cnes}' for campo in CAMPOS}
+    registro.update({
+        'codigo_cnes': int(codigo_cnes),
+        'codigo_tipo_unidade': rnd.choice([1, 2, 4, 5, 7, 15, 22, 36, 39, 40, 70]),
+        'codigo_cep_estabelecimento': f'{rnd.randint(76800000, 76999999)}',
+        'latitude_estabelecimento_decimo_grau': round(rnd.uniform(-13.7, -7.9), 6),
+        'longitude_estabelecimento_decimo_grau': round(rnd.uniform(-66.8, -59.8), 6),
+        'codigo_uf': 11,
+        'codigo_municipio': rnd.randint(110001, 110180),
+        'codigo_motivo_desabilitacao_estabelecimento': None,
+        'estabelecimento_possui_centro_cirurgico': rnd.randint(0, 1),
+        'estabelecimento_possui_centro_obstetrico': rnd.randint(0, 1),
+        'estabelecimento_possui_centro_neonatal': rnd.randint(0, 1),
+        'estabelecimento_possui_atendimento_hospitalar': rnd.randint(0, 1),
+        'estabelecimento_possui_servico_apoio': rnd.randint(0, 1),
+        'estabelecimento_possui_atendimento_ambulatorial': rnd.randint(0, 1),
+        'data_atualizacao': f'2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}',
+    })
+    return registro
+
+
+class MockApiCnes:
+    """
+    Servidor local que imita os endpoints /cnes/estabelecimentos/{codigo} e a listagem
+    paginada /cnes/estabelecimentos?codigo_uf=..&limit=..&offset=.. da API de dados
+    abertos, com latência configurável, e conta requisições e conexões TCP.
+    A listagem pagina os registros sintéticos de codigos_listagem (todos da UF 11),
+    com no máximo limite_pagina por página, como a API.
+    taxa_erro injeta respostas 503 aleatórias; com capacidade definida, requisições
+    além desse número em andamento recebem 429 com Retry-After. Uma fração_lenta das
+    requisições (sorteadas) demora latencia_lenta em vez de latencia (cauda de latência).
+    Roda em uma thread própria; use como context manager.
+    """
+
+    def __init__(self, latencia=0.05, porta=0, taxa_erro=0.0, capacidade=None, retry_after=1,
+                 codigos_listagem=(), limite_pagina=20, fracao_lenta=0.0, latencia_lenta=1.0):
+        self.latencia = latencia
+        self.fracao_lenta = fracao_lenta
+        self.latencia_lenta = latencia_lenta
+        self.porta = porta
+        self.taxa_erro = taxa_erro
+        self.capacidade = capacidade
+        self.retry_after = retry_after
+        self.codigos_listagem = list(codigos_listagem)
+        self.limite_pagina = limite_pagina
+        self.requisicoes = 0
+        self.em_andamento = 0
+        self.status = {}
+        self.conexoes = set()
+        self._loop = None
+        self._runner = None
+        self._pronto = threading.Event()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.porta}'
+
+    def zerar_contadores(self):
+        self.requisicoes = 0
+        self.status = {}
+        self.conexoes = set()
+
+    def _contar(self, status):
+        self.status[status] = self.status.get(status, 0) + 1
+
+    async def _atender(self, request):
+        """
+        Contagem, limite de capacidade, latência e erros injetados comuns aos endpoints.
+        Retorna a resposta de erro, ou None se a requisição deve ser atendida.
+        """
+        from aiohttp import web
+        self.requisicoes += 1
+        self.conexoes.add(request.transport.get_extra_info('peername'))
+        if self.capacidade is not None and self.em_andamento >= self.capacidade:
+            self._contar(429)
+            return web.Response(status=429, headers={'Retry-After': str(self.retry_after)})
+        self.em_andamento += 1
+        try:
+            lenta = self.fracao_lenta and random.random() < self.fracao_lenta
+            await asyncio.sleep(self.latencia_lenta if lenta else self.latencia)
+        finally:
+            self.em_andamento -= 1
+        if self.taxa_erro and random.random() < self.taxa_erro:
+            self._contar(503)
+            return web.Response(status=503)
+        return None
+
+    async def _listagem(self, request):
+        from aiohttp import web
+        erro = await self._atender(request)
+        if erro is not None:
+            return erro
+        limite = min(int(request.query.get('limit', self.limite_pagina)), self.limite_pagina)
+        offset = int(request.query.get('offset', 0))
+        codigos = self.codigos_listagem if request.query.get('codigo_uf') == '11' else []
+        self._contar(200)
+        response = web.json_response({'estabelecimentos': [gerar_registro_sintetico(codigo)
+                                                           for codigo in codigos[offset:offset + limite]]})
+        response.enable_compression()
+        return response
+
+    async def _estabelecimento(self, request):
+        from aiohttp import web
+        erro = await self._atender(request)
+        if erro is not None:
+            return erro
+        # ETag fixo por código: o conteúdo sintético não muda entre requisições
+        etag = f'"{request.match_info["codigo"]}"'
+        if request.headers.get('If-None-Match') == etag:
+            self._contar(304)
+            return web.Response(status=304, headers={'ETag': etag})
+        self._contar(200)
+        response = web.json_response(gerar_registro_sintetico(request.match_info['codigo']), headers={'ETag': etag})
+        response.enable_compression()
+        return response
+
+    async def _iniciar(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/cnes/estabelecimentos', self._listagem)
+        app.router.add_get('/cnes/estabelecimentos/{codigo}', self._estabelecimento)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.porta, backlog=1024)
+        await site.start()
+        self.porta = site._server.sockets[0].getsockname()[1]
+
+    def _executar(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._iniciar())
+        self._pronto.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._executar, daemon=True)
+        self._thread.start()
+        self._pronto.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def benchmark_api(quantidade=2000, latencia=0.05, max_workers=20, max_concorrencia=200,
+                  taxa_erro=0.0, capacidade=None):
+    """
+    Compara o modo com threads (requests, uma conexão por requisição) com o modo
+    assíncrono (aiohttp, conexões keep-alive) contra o mock local.
+    Retorna uma lista de dicionários com requisições/s e conexões abertas.
+    """
+    from BuscarCnesApiOficial import consultar_cnes_threads, consultar_cnes_async
+
+    codigos = [str(2000000 + i) for i in range(quantidade)]
+    resultados = []
+    with MockApiCnes(latencia=latencia, taxa_erro=taxa_erro, capacidade=capacidade) as mock:
+        execucoes = [
+            (f'threads ({max_workers} workers)',
+             lambda: consultar_cnes_threads(codigos, max_workers, url_base=mock.url)),
+            (f'async ({max_concorrencia} em andamento)',
+             lambda: asyncio.run(consultar_cnes_async(codigos, max_concorrencia, url_base=mock.url))),
+        ]
+        for nome, executar in execucoes:
+            mock.zerar_contadores()
+            inicio = time.perf_counter()
+            respostas = executar()
+            duracao = time.perf_counter() - inicio
+            resultados.append({
+                'modo': nome,
+                'requisicoes': mock.requisicoes,
+                'sucesso': sum(1 for r in respostas if r),
+                'segundos': round(duracao, 3),
+                'requisicoes_por_segundo': round(mock.requisicoes / duracao, 1),
+                'conexoes_tcp': len(mock.conexoes),
+                'status_http': mock.status,
+            })
+    return resultados
+
+
+def benchmark_listagem(quantidade=10000, latencia=0.05, max_concorrencia=50, tamanho_pagina=20,
+                       fracao_fora_da_listagem=0.02):
+    """
+    Compara a busca de uma UF só com requisições por código com a busca pela listagem
+    paginada (consultar_lista_cnes_api com listagem=True) contra o mock local.
+    Uma fração dos códigos fica fora da listagem do mock, para medir o preenchimento
+    das lacunas pelas requisições individuais.
+    """
+    from BuscarCnesApiOficial import consultar_lista_cnes_api
+
+    codigos = [str(2000000 + i) for i in range(quantidade)]
+    passo = int(1 / fracao_fora_da_listagem) if fracao_fora_da_listagem else 0
+    listados = [codigo for indice, codigo in enumerate(codigos) if not passo or indice % passo]
+    resultados = []
+    with MockApiCnes(latencia=latencia, codigos_listagem=listados, limite_pagina=tamanho_pagina) as mock, \
+            tempfile.TemporaryDirectory() as pasta:
+        for modo, listagem in (('por código', False), ('listagem', True)):
+            mock.zerar_contadores()
+            registros = []
+            inicio = time.perf_counter()
+            resumo = consultar_lista_cnes_api(codigos, pasta_downloads=pasta, max_concorrencia=max_concorrencia,
+                                              url_base=mock.url, incremental=False, usar_cache=False,
+                                              ao_registro=registros.append, uf=11, listagem=listagem,
+                                              tamanho_pagina=tamanho_pagina)
+            duracao = time.perf_counter() - inicio
+            resultados.append({
+                'modo': modo,
+                'codigos': quantidade,
+                'registros': len(registros),
+                'requisicoes': mock.requisicoes,
+                'paginas_listagem': resumo['paginas_listagem'],
+                'segundos': round(duracao, 3),
+                'registros_por_segundo': round(len(registros) / duracao, 1),
+                'status_http': mock.status,
+            })
+    return resultados
+
+
+def benchmark_hedge(quantidade=5000, latencia=0.05, max_concorrencia=50, fracao_lenta=0.02, latencia_lenta=2.0,
+                    orcamento=0.05):
+    """
+    Compara a busca sem e com requisições duplicadas (hedge, até orcamento de requisições
+    extras) contra o mock local com uma cauda de requisições lentas.
+    Retorna, por modo, o tempo total, as requisições feitas e os percentis de latência.
+    """
+    from BuscarCnesApiOficial import consultar_lista_cnes_api
+
+    codigos = [str(2000000 + i) for i in range(quantidade)]
+    resultados = []
+    with MockApiCnes(latencia=latencia, fracao_lenta=fracao_lenta, latencia_lenta=latencia_lenta) as mock, \
+            tempfile.TemporaryDirectory() as pasta:
+        for modo, orcamento_hedge in (('sem hedge', 0.0), (f'hedge ({orcamento:.0%})', orcamento)):
+            mock.zerar_contadores()
+            registros = []
+            inicio = time.perf_counter()
+            resumo = consultar_lista_cnes_api(codigos, pasta_downloads=pasta, max_concorrencia=max_concorrencia,
+                                              url_base=mock.url, incremental=False, usar_cache=False,
+                                              ao_registro=registros.append, orcamento_hedge=orcamento_hedge)
+            duracao = time.perf_counter() - inicio
+            resultados.append({
+                'modo': modo,
+                'registros': len(registros),
+                'requisicoes': mock.requisicoes,
+                'duplicadas': resumo['hedge_duplicadas'],
+                'segundos': round(duracao, 3),
+                'latencia_ms': resumo['latencia_ms'],
+            })
+    return resultados
+
+
+def benchmark_repescagem(quantidade=5000, latencia=0.05, max_concorrencia=50, taxa_erro=0.1):
+    """
+    Compara, contra o mock local com taxa_erro de respostas 503, as repetições dentro
+    da passagem principal (sem repescagem) com uma única tentativa na passagem principal
+    seguida da repescagem das falhas transitórias com concorrência reduzida.
+    Retorna, por modo, o tempo total, as requisições feitas e as falhas que sobraram.
+    """
+    from BuscarCnesApiOficial import consultar_lista_cnes_api, TENTATIVAS_REPESCAGEM
+
+    codigos = [str(2000000 + i) for i in range(quantidade)]
+    modos = (
+        ('repetições na passagem principal', {'max_retries': 1 + TENTATIVAS_REPESCAGEM, 'tentativas_repescagem': 0}),
+        ('passagem principal + repescagem', {}),
+    )
+    resultados = []
+    with MockApiCnes(latencia=latencia, taxa_erro=taxa_erro) as mock:
+        for modo, parametros in modos:
+            mock.zerar_contadores()
+            registros = []
+            # Pasta nova em cada modo: a fila de falhas de um não deve alimentar o outro
+            with tempfile.TemporaryDirectory() as pasta:
+                inicio = time.perf_counter()
+                resumo = consultar_lista_cnes_api(codigos, pasta_downloads=pasta, max_concorrencia=max_concorrencia,
+                                                  url_base=mock.url, incremental=False, usar_cache=False,
+                                                  ao_registro=registros.append, **parametros)
+                duracao = time.perf_counter() - inicio
+            resultados.append({
+                'modo': modo,
+                'registros': len(registros),
+                'requisicoes': mock.requisicoes,
+                'repescados': resumo['repescados'],
+                'falhas_pendentes': resumo['falhas_pendentes'],
+                'segundos': round(duracao, 3),
+                'latencia_ms': resumo['latencia_ms'],
+            })
+    return resultados
+
+
+def benchmark_codificacao(quantidade=50000, fracao_invalida=0.01, repeticoes=3):
+    """
+    Compara a formatação valor a valor (formatar_linha_copy / formatar_registro) com o
+    codificador tipado (CodificadorCnes) para as linhas do COPY e de VALUES, em
+    microssegundos por registro (melhor de repeticoes). fracao_invalida dos registros
+    recebe um valor malformado, que só o codificador rejeita.
+    """
+    from CodificadorCnes import obter_codificador
+    from GerarScriptSQLCnes import formatar_linha_copy, formatar_registro
+
+    registros = [gerar_registro_sintetico(2000000 + i) for i in range(quantidade)]
+    if fracao_invalida:
+        for i in range(0, quantidade, int(1 / fracao_invalida)):
+            registros[i]['latitude_estabelecimento_decimo_grau'] = 'sem coordenada'
+    codificador = obter_codificador()
+    execucoes = (
+        ('COPY', 'valor a valor', lambda: ''.join(formatar_linha_copy(registro) for registro in registros)),
+        ('COPY', 'codificador', lambda: codificador.linhas_copy(registros)),
+        ('VALUES', 'valor a valor', lambda: [formatar_registro(registro) for registro in registros]),
+        ('VALUES', 'codificador', lambda: codificador.valores_sql(registros)),
+    )
+    resultados = []
+    for formato, modo, executar in execucoes:
+        melhor = None
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            saida = executar()
+            duracao = time.perf_counter() - inicio
+            melhor = duracao if melhor is None else min(melhor, duracao)
+        resultados.append({
+            'formato': formato,
+            'modo': modo,
+            'registros': quantidade,
+            'us_por_registro': round(melhor / quantidade * 1e6, 2),
+            'rejeitados': len(saida[-1]) if modo == 'codificador' else 0,
+        })
+    return resultados
+
+
+def benchmark_snapshot(quantidade=50000, fracao_alterada=0.05, fracao_removida=0.01, fracao_nova=0.01):
+    """
+    Compara o tamanho dos registros sintéticos em JSON indentado, JSON Lines e no
+    snapshot Parquet (SnapshotCnes), e mede a montagem do snapshot, a leitura e a
+    comparação com um segundo snapshot com parte dos registros alterados, removidos e novos.
+    """
+    from SnapshotCnes import ColetorSnapshot, comparar_snapshots, gravar_snapshot, ler_snapshot, mesclar_snapshot
+
+    rnd = random.Random(0)
+    registros = [gerar_registro_sintetico(2000000 + i) for i in range(quantidade)]
+    resultados = []
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho_json = os.path.join(pasta, 'cnes_resultados.json')
+        with open(caminho_json, 'w', encoding='utf-8') as f:
+            json.dump(registros, f, ensure_ascii=False, indent=2)
+        caminho_jsonl = os.path.join(pasta, 'cnes_resultados.jsonl')
+        with open(caminho_jsonl, 'w', encoding='utf-8') as f:
+            for registro in registros:
+                f.write(json.dumps(registro, ensure_ascii=False) + '\n')
+
+        inicio = time.perf_counter()
+        coletor = ColetorSnapshot()
+        for registro in registros:
+            coletor.adicionar(registro)
+        anterior = mesclar_snapshot(None, coletor.tabela())
+        segundos_montagem = time.perf_counter() - inicio
+        caminho_parquet = os.path.join(pasta, 'cnes_snapshot.parquet')
+        inicio = time.perf_counter()
+        gravar_snapshot(anterior, caminho_parquet)
+        segundos_gravacao = time.perf_counter() - inicio
+
+        tamanho_json = os.path.getsize(caminho_json)
+        for formato, caminho in (('json indentado', caminho_json), ('jsonl', caminho_jsonl),
+                                 ('parquet', caminho_parquet)):
+            tamanho = os.path.getsize(caminho)
+            resultados.append({'formato': formato, 'bytes': tamanho,
+                               'fracao_do_json': round(tamanho / tamanho_json, 4)})
+
+        # Segunda execução: registros alterados e novos buscados de novo, removidos fora do dump
+        amostra = rnd.sample(range(quantidade), int(quantidade * (fracao_alterada + fracao_removida)))
+        alterados = amostra[:int(quantidade * fracao_alterada)]
+        removidos = {registros[indice]['codigo_cnes'] for indice in amostra[len(alterados):]}
+        buscados = ColetorSnapshot()
+        for indice in alterados:
+            buscados.adicionar(dict(registros[indice], data_atualizacao='2025-01-01'))
+        for codigo in range(quantidade, quantidade + int(quantidade * fracao_nova)):
+            buscados.adicionar(gerar_registro_sintetico(2000000 + codigo))
+        codigos_atuais = [registro['codigo_cnes'] for registro in registros
+                          if registro['codigo_cnes'] not in removidos]
+        codigos_atuais.extend(2000000 + codigo for codigo in range(quantidade, quantidade + int(quantidade * fracao_nova)))
+
+        inicio = time.perf_counter()
+        anterior = ler_snapshot(caminho_parquet)
+        segundos_leitura = time.perf_counter() - inicio
+        atual = mesclar_snapshot(anterior, buscados.tabela(), codigos_atuais)
+        inicio = time.perf_counter()
+        diferencas = comparar_snapshots(anterior, atual)
+        segundos_comparacao = time.perf_counter() - inicio
+        resultados.append({
+            'registros': quantidade,
+            'montagem_segundos': round(segundos_montagem, 3),
+            'gravacao_segundos': round(segundos_gravacao, 3),
+            'leitura_ms': round(segundos_leitura * 1000, 2),
+            'comparacao_ms': round(segundos_comparacao * 1000, 2),
+            'novos': len(diferencas['novos']),
+            'alterados': len(diferencas['alterados']),
+            'removidos': len(diferencas['removidos']),
+            'inalterados': diferencas['inalterados'],
+            'esperado': {'novos': int(quantidade * fracao_nova), 'alterados': len(alterados),
+                         'removidos': len(removidos)},
+        })
+    return resultados
+
+
+def benchmark_indice_espacial(quantidade=600000, consultas=500, k=5, raio_km=10.0, municipios=5570, tipos=40):
+    """
+    Índice espacial (IndiceEspacialCnes) com pontos sintéticos em escala nacional,
+    agrupados em torno de sedes de municípios, com tipos de unidade de frequência
+    desigual: montagem, tamanho do arquivo, abertura e latência das consultas (k mais
+    próximos e raio, com todos os tipos, o tipo mais comum e um raro), comparadas a uma
+    varredura vetorizada de todos os pontos, que também confere os resultados.
+    """
+    import numpy as np
+
+    from IndiceEspacialCnes import RAIO_TERRA_KM, abrir_indice, construir_indice
+
+    rng = np.random.default_rng(0)
+    sedes_latitude = rng.uniform(-33.7, 5.3, municipios)
+    sedes_longitude = rng.uniform(-73.9, -34.8, municipios)
+    # Poucos municípios grandes e muitos pequenos
+    pesos = 1 / np.arange(1, municipios + 1)
+    municipio_ponto = rng.choice(municipios, quantidade, p=pesos / pesos.sum())
+    latitudes = sedes_latitude[municipio_ponto] + rng.normal(0, 0.08, quantidade)
+    longitudes = sedes_longitude[municipio_ponto] + rng.normal(0, 0.08, quantidade)
+    pesos_tipo = 1 / np.arange(1, tipos + 1) ** 1.5
+    tipo_ponto = rng.choice(tipos, quantidade, p=pesos_tipo / pesos_tipo.sum()) + 1
+    codigos = np.arange(2000000, 2000000 + quantidade)
+    codigos_municipio = 110000 + municipio_ponto
+
+    def varredura(latitude, longitude, mascara):
+        # Haversine sobre todos os pontos, em float64
+        lat1, lon1 = np.radians(latitude), np.radians(longitude)
+        lat2, lon2 = np.radians(latitudes[mascara]), np.radians(longitudes[mascara])
+        a = (np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+        return 2 * RAIO_TERRA_KM * np.arcsin(np.sqrt(a)), codigos[mascara]
+
+    resultados = []
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = os.path.join(pasta, 'indice_espacial_cnes.bin')
+        resumo = construir_indice(codigos, latitudes, longitudes, codigos_municipio, tipo_ponto, caminho)
+        inicio = time.perf_counter()
+        indice = abrir_indice(caminho)
+        segundos_abertura = time.perf_counter() - inicio
+        resultados.append({'registros': resumo['registros'], 'tipos': resumo['tipos'],
+                           'montagem_segundos': resumo['montagem_segundos'],
+                           'arquivo_mb': round(resumo['bytes'] / 1024 / 1024, 1),
+                           'abertura_ms': round(segundos_abertura * 1000, 2)})
+
+        pontos_consulta = rng.integers(0, quantidade, consultas)
+        deslocamentos = rng.normal(0, 0.05, (consultas, 2))
+        contagem_tipos = np.bincount(tipo_ponto)
+        tipo_raro = int(np.flatnonzero(contagem_tipos)[np.argmin(contagem_tipos[np.flatnonzero(contagem_tipos)])])
+        for nome_tipo, tipo in (('todos', None), ('comum', int(np.argmax(contagem_tipos))), ('raro', tipo_raro)):
+            mascara = np.ones(quantidade, dtype=bool) if tipo is None else tipo_ponto == tipo
+            for consulta in ('knn', 'raio'):
+                duracoes_indice, duracoes_varredura = [], []
+                divergencias = encontrados = 0
+                for ponto, (dlat, dlon) in zip(pontos_consulta.tolist(), deslocamentos.tolist()):
+                    latitude, longitude = float(latitudes[ponto] + dlat), float(longitudes[ponto] + dlon)
+                    inicio = time.perf_counter()
+                    if consulta == 'knn':
+                        achados = indice.mais_proximos(latitude, longitude, k, tipo)
+                    else:
+                        achados = indice.no_raio(latitude, longitude, raio_km, tipo)
+                    duracoes_indice.append(time.perf_counter() - inicio)
+
+                    inicio = time.perf_counter()
+                    distancias, codigos_varredura = varredura(latitude, longitude, mascara)
+                    if consulta == 'knn':
+                        esperadas = np.sort(distancias)[:k]
+                    else:
+                        esperadas = np.sort(distancias[distancias <= raio_km])
+                    duracoes_varredura.append(time.perf_counter() - inicio)
+
+                    encontrados += len(achados)
+                    # O índice guarda as coordenadas em float32: as distâncias são comparadas
+                    # com tolerância de 10 m, e os pontos a essa distância da borda do raio
+                    # podem ficar de qualquer lado
+                    obtidas = np.array([achado['distancia_km'] for achado in achados])
+                    if consulta == 'knn':
+                        iguais = len(obtidas) == len(esperadas) and np.allclose(obtidas, esperadas, atol=0.01)
+                    else:
+                        diferentes = {achado['codigo_cnes'] for achado in achados}.symmetric_difference(
+                            codigos_varredura[distancias <= raio_km].tolist())
+                        borda = set(codigos_varredura[np.abs(distancias - raio_km) <= 0.01].tolist())
+                        iguais = diferentes <= borda
+                    divergencias += not iguais
+                duracoes_indice = np.array(duracoes_indice) * 1e6
+                duracoes_varredura = np.array(duracoes_varredura) * 1e6
+                resultados.append({
+                    'consulta': consulta if consulta == 'knn' else f'raio {raio_km:g} km',
+                    'tipo': nome_tipo,
+                    'pontos_tipo': int(np.count_nonzero(mascara)),
+                    'indice_p50_us': round(float(np.percentile(duracoes_indice, 50)), 1),
+                    'indice_p99_us': round(float(np.percentile(duracoes_indice, 99)), 1),
+                    'varredura_p50_us': round(float(np.percentile(duracoes_varredura, 50)), 1),
+                    'resultados_por_consulta': round(encontrados / consultas, 1),
+                    'divergencias': divergencias,
+                })
+        del indice
+    return resultados
+
+
+def ddl_unidade_saude():
+    """
+    CREATE TABLE de uma unidade_saude compatível com os registros sintéticos
+    (tipos deduzidos de um registro de exemplo, texto quando nulo), particionada por
+    codigo_uf como a de produção, com a partição da UF dos registros sintéticos
+    """
+    from GerarScriptSQLCnes import CHAVE_PRIMARIA, nome_particao
+
+    exemplo = gerar_registro_sintetico(2000000)
+    tipos = {int: 'bigint', float: 'double precision'}
+    colunas = [f"{campo} {tipos.get(type(exemplo[campo]), 'text')}" for campo in CAMPOS]
+    colunas.append(f"PRIMARY KEY ({', '.join(CHAVE_PRIMARIA)})")
+    uf = exemplo['codigo_uf']
+    return (f"CREATE TABLE unidade_saude ({', '.join(colunas)}) PARTITION BY LIST (codigo_uf); "
+            f"CREATE TABLE {nome_particao(uf)} PARTITION OF unidade_saude FOR VALUES IN ({uf})")
+
+
+def benchmark_carga(dsn, quantidade=20000, tamanho_lote=1000, fracao_alterada=0.05):
+    """
+    Compara a carga por script de UPSERTs em lotes (modo 'sql') com COPY para staging +
+    merge único (modo 'copy') em um PostgreSQL local, no schema cnes_benchmark (recriado).
+    Cada modo roda duas vezes: carga inicial (só inserções) e recarga dos mesmos registros
+    com fracao_alterada deles modificados; o WAL gerado em cada etapa também é medido.
+    """
+    import psycopg2
+    from GerarScriptSQLCnes import gerar_upserts_em_lotes, nome_particao, MARCADOR_FIM_LOTE
+    from UptadeBancoDeDados import carregar_script_sql, carregar_via_copy
+
+    # Os registros sintéticos são todos da mesma UF: a carga vai direto para a partição dela
+    tabela = nome_particao(gerar_registro_sintetico(2000000)['codigo_uf'])
+
+    def registros(alterados=0.0):
+        # Na recarga, uma fração dos registros tem o conteúdo alterado
+        passo = int(1 / alterados) if alterados else 0
+        for i in range(quantidade):
+            registro = gerar_registro_sintetico(2000000 + i)
+            if passo and i % passo == 0:
+                registro['data_atualizacao'] = '2025-01-01'
+            yield registro
+
+    def posicao_wal(conn):
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_current_wal_lsn()")
+            return cursor.fetchone()[0]
+
+    def bytes_wal(conn, inicio):
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", (inicio,))
+            return int(cursor.fetchone()[0])
+
+    def carregar_sql(conn, alterados):
+        with tempfile.NamedTemporaryFile('w', suffix='.sql', delete=False, encoding='utf-8') as f:
+            for comando, quantidade_lote, _ in gerar_upserts_em_lotes(registros(alterados), tamanho_lote, tabela):
+                f.write(f"{comando}\n{MARCADOR_FIM_LOTE} ({quantidade_lote} registros)\n")
+        try:
+            lotes, falhas, resumo = carregar_script_sql(conn, f.name)
+        finally:
+            os.remove(f.name)
+        return dict(resumo, lotes=lotes, falhas=falhas)
+
+    modos = {
+        'sql': carregar_sql,
+        'copy': lambda conn, alterados: carregar_via_copy(conn, registros(alterados), tabela=tabela),
+    }
+    resultados = []
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA IF EXISTS cnes_benchmark CASCADE")
+            cursor.execute("CREATE SCHEMA cnes_benchmark")
+            cursor.execute("SET search_path TO cnes_benchmark")
+        conn.commit()
+        for modo, carregar in modos.items():
+            with conn.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS unidade_saude")
+                cursor.execute(ddl_unidade_saude())
+            conn.commit()
+            for etapa, alterados in (('carga inicial', 0.0), ('recarga', fracao_alterada)):
+                wal_inicio = posicao_wal(conn)
+                inicio = time.perf_counter()
+                resumo = carregar(conn, alterados)
+                duracao = time.perf_counter() - inicio
+                resultados.append({
+                    'modo': modo,
+                    'etapa': etapa,
+                    'registros': quantidade,
+                    'segundos': round(duracao, 3),
+                    'registros_por_segundo': round(quantidade / duracao, 1),
+                    'bytes_wal': bytes_wal(conn, wal_inicio),
+                    'resumo': resumo,
+                })
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA cnes_benchmark CASCADE")
+        conn.commit()
+    finally:
+        conn.close()
+    return resultados
+
+
+def benchmark_carga_paralela(dsn, quantidade=100000, conexoes=(1, 2, 4, 8), modo='copy', tamanho_lote=2000,
+                             fracao_alterada=0.05):
+    """
+    Mede a carga com o CarregadorParalelo para cada quantidade de conexões em um
+    PostgreSQL local, no schema cnes_benchmark (recriado): carga inicial (só inserções)
+    e recarga com fracao_alterada dos registros modificados. Registra a vazão e o lote
+    mais demorado (o tempo máximo em que uma transação segura bloqueios).
+    """
+    import psycopg2
+    from GerarScriptSQLCnes import nome_particao
+    from UptadeBancoDeDados import CarregadorParalelo
+
+    tabela = nome_particao(gerar_registro_sintetico(2000000)['codigo_uf'])
+    iniciais = [gerar_registro_sintetico(2000000 + i) for i in range(quantidade)]
+    passo = int(1 / fracao_alterada) if fracao_alterada else 0
+    recarga = [dict(registro, data_atualizacao='2025-01-01') if passo and i % passo == 0 else registro
+               for i, registro in enumerate(iniciais)]
+
+    def fabrica_conexao():
+        return psycopg2.connect(dsn, options='-c search_path=cnes_benchmark')
+
+    resultados = []
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA IF EXISTS cnes_benchmark CASCADE")
+            cursor.execute("CREATE SCHEMA cnes_benchmark")
+            cursor.execute("SET search_path TO cnes_benchmark")
+        conn.commit()
+        for quantidade_conexoes in conexoes:
+            with conn.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS unidade_saude")
+                cursor.execute(ddl_unidade_saude())
+            conn.commit()
+            for etapa, registros in (('carga inicial', iniciais), ('recarga', recarga)):
+                carregador = CarregadorParalelo(modo, quantidade_conexoes, tamanho_lote, tabela,
+                                                fabrica_conexao=fabrica_conexao)
+                inicio = time.perf_counter()
+                carregador.iniciar()
+                for registro in registros:
+                    carregador.enviar(registro)
+                resumo = carregador.finalizar()
+                duracao = time.perf_counter() - inicio
+                resultados.append({
+                    'modo': modo,
+                    'conexoes': quantidade_conexoes,
+                    'etapa': etapa,
+                    'registros': quantidade,
+                    'segundos': round(duracao, 3),
+                    'registros_por_segundo': round(quantidade / duracao, 1),
+                    'lotes': carregador.lotes,
+                    'maior_lote_segundos': round(carregador.maior_lote_segundos, 3),
+                    'lotes_com_falha': len(carregador.lotes_com_falha),
+                    'resumo': resumo,
+                })
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA cnes_benchmark CASCADE")
+        conn.commit()
+    finally:
+        conn.close()
+    return resultados
+
+
+def benchmark_reconciliacao(dsn, quantidade=100000, divergentes=50, baldes=1024):
+    """
+    Compara duas formas de descobrir o que difere entre um snapshot e a partição no
+    PostgreSQL (schema cnes_benchmark, recriado), depois de alterar, apagar e inserir
+    linhas direto no banco: ler a tabela inteira e comparar linha a linha em Python, e a
+    reconciliação por baldes de ReconciliacaoCnes. Confere que as duas acham o mesmo.
+    """
+    import psycopg2
+    from GerarScriptSQLCnes import nome_particao
+    from ReconciliacaoCnes import reconciliar
+    from SnapshotCnes import tabela_registros
+    from UptadeBancoDeDados import carregar_via_copy
+
+    tabela = nome_particao(gerar_registro_sintetico(2000000)['codigo_uf'])
+    registros = [gerar_registro_sintetico(2000000 + i) for i in range(quantidade)]
+    snapshot = tabela_registros(registros)
+    rnd = random.Random(0)
+    sorteados = rnd.sample(range(quantidade), divergentes)
+    alterados = [2000000 + i for i in sorteados[:divergentes // 2]]
+    apagados = [2000000 + i for i in sorteados[divergentes // 2:]]
+    extras = [gerar_registro_sintetico(3000000 + i) for i in range(max(1, divergentes // 10))]
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA IF EXISTS cnes_benchmark CASCADE")
+            cursor.execute("CREATE SCHEMA cnes_benchmark")
+            cursor.execute("SET search_path TO cnes_benchmark")
+            cursor.execute(ddl_unidade_saude())
+        conn.commit()
+        carregar_via_copy(conn, registros + extras, tabela=tabela)
+        with conn.cursor() as cursor:
+            cursor.execute(f"UPDATE {tabela} SET nome_fantasia = nome_fantasia || ' (alterado)' "
+                           f"WHERE codigo_cnes = ANY(%s)", (alterados,))
+            cursor.execute(f"DELETE FROM {tabela} WHERE codigo_cnes = ANY(%s)", (apagados,))
+        conn.commit()
+        esperado = {'recarregar': sorted(alterados + apagados),
+                    'remover': sorted(extra['codigo_cnes'] for extra in extras)}
+
+        # Linha a linha: a tabela inteira vem para o Python e é comparada com os registros
+        inicio = time.perf_counter()
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT {', '.join(CAMPOS)} FROM {tabela}")
+            banco = {linha[0]: linha for linha in cursor}
+        fonte = {registro['codigo_cnes']: tuple(registro[campo] for campo in CAMPOS) for registro in registros}
+        linha_a_linha = {'recarregar': sorted(codigo for codigo, linha in fonte.items() if banco.get(codigo) != linha),
+                         'remover': sorted(banco.keys() - fonte.keys())}
+        duracao_linhas = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        diferencas = reconciliar(conn, tabela, snapshot, [registro['codigo_cnes'] for registro in registros], baldes)
+        duracao_baldes = time.perf_counter() - inicio
+        por_baldes = {tipo: diferencas[tipo].tolist() for tipo in ('recarregar', 'remover')}
+
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA cnes_benchmark CASCADE")
+        conn.commit()
+    finally:
+        conn.close()
+    return [
+        {'modo': 'linha a linha em Python', 'registros': quantidade, 'linhas_lidas': len(banco),
+         'segundos': round(duracao_linhas, 3), 'correto': linha_a_linha == esperado},
+        {'modo': f'baldes ({baldes})', 'registros': quantidade, 'linhas_lidas': diferencas['linhas_abertas'],
+         'baldes_divergentes': diferencas['baldes_divergentes'], 'segundos': round(duracao_baldes, 3),
+         'correto': por_baldes == esperado},
+    ]
+
+
+def benchmark_pipeline(dsn, quantidade=5000, latencia=0.05, max_concorrencia=50, modo_carga='sql',
+                       tamanho_lote=500):
+    """
+    Compara a execução em etapas (a carga consome os registros da busca um a um, na
+    mesma conexão) com a execução em fluxo (carga em lotes, em uma thread própria,
+    enquanto a busca continua), com o mock da API e um
+    PostgreSQL local (schema cnes_benchmark, recriado a cada modo).
+    """
+    import psycopg2
+    from PipelineCnes import executar_pipeline, executar_pipeline_em_fluxo
+
+    codigos = [2000000 + i for i in range(quantidade)]
+    opcoes_busca = {'max_concorrencia': max_concorrencia, 'incremental': False, 'usar_cache': False}
+    modos = {
+        'etapas': lambda conn, url: executar_pipeline(codigos=codigos, materializar=False, modo_carga=modo_carga,
+                                                      conn=conn, url_base=url, **opcoes_busca),
+        'fluxo': lambda conn, url: executar_pipeline_em_fluxo(codigos=codigos, modo_carga=modo_carga, conn=conn,
+                                                              tamanho_lote=tamanho_lote, url_base=url,
+                                                              **opcoes_busca),
+    }
+    resultados = []
+    conn = psycopg2.connect(dsn)
+    try:
+        with MockApiCnes(latencia=latencia) as mock:
+            for modo, executar in modos.items():
+                with conn.cursor() as cursor:
+                    cursor.execute("DROP SCHEMA IF EXISTS cnes_benchmark CASCADE")
+                    cursor.execute("CREATE SCHEMA cnes_benchmark")
+                    cursor.execute("SET search_path TO cnes_benchmark")
+                    cursor.execute(ddl_unidade_saude())
+                conn.commit()
+                inicio = time.perf_counter()
+                resumo = executar(conn, mock.url)
+                duracao = time.perf_counter() - inicio
+                resultados.append({
+                    'modo': modo,
+                    'modo_carga': modo_carga,
+                    'registros': quantidade,
+                    'segundos': round(duracao, 3),
+                    'registros_por_segundo': round(quantidade / duracao, 1),
+                    'tempos': resumo['tempos'],
+                    'carga': resumo['carga'],
+                })
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA cnes_benchmark CASCADE")
+        conn.commit()
+    finally:
+        conn.close()
+    return resultados
+
+
+# Colunas do dump sintético: as lidas pela filtragem (CO_CNES, CO_UF e as de data de
+# atualização) mais uma amostra das demais colunas do CSV de estabelecimentos do OpenDataSUS
+COLUNAS_DUMP = [
+    'CO_UNIDADE', 'CO_CNES', 'NU_CNPJ_MANTENEDORA', 'TP_PFPJ', 'NIVEL_DEP', 'NO_RAZAO_SOCIAL', 'NO_FANTASIA',
+    'NO_LOGRADOURO', 'NU_ENDERECO', 'NO_COMPLEMENTO', 'NO_BAIRRO', 'CO_CEP', 'NU_TELEFONE', 'NO_EMAIL', 'NU_CNPJ',
+    'TP_UNIDADE', 'CO_TURNO_ATENDIMENTO', 'CO_ESTADO_GESTOR', 'CO_MUNICIPIO_GESTOR', 'DT_ATUALIZACAO',
+    'NU_LATITUDE', 'NU_LONGITUDE', 'DT_ATU_GEO', 'CO_NATUREZA_JUR', 'CO_TIPO_UNIDADE', 'TP_GESTAO', 'CO_UF',
+]
+
+
+def gerar_dump_sintetico(caminho_zip, quantidade=200000, ufs=None, semente=0):
+    """
+    Grava um .zip com um CSV de estabelecimentos no layout do dump do OpenDataSUS
+    (separador ';', latin1, campos entre aspas), com 'quantidade' linhas distribuídas
+    aleatoriamente entre as UFs (padrão: todas). Os códigos CNES são 2000000, 2000001, ...
+    Retorna {uf: quantidade de linhas} para conferência.
+    """
+    from EstabelecimentosCsvDownload import SIGLAS_UF
+
+    ufs = list(ufs or SIGLAS_UF)
+    rnd = random.Random(semente)
+    por_uf = {uf: 0 for uf in ufs}
+    with zipfile.ZipFile(caminho_zip, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        with zip_ref.open('cnes_estabelecimentos.csv', 'w') as membro:
+            texto = io.TextIOWrapper(membro, encoding='latin1', newline='')
+            escritor = csv.writer(texto, delimiter=';', quoting=csv.QUOTE_ALL)
+            escritor.writerow(COLUNAS_DUMP)
+            for indice in range(quantidade):
+                uf = rnd.choice(ufs)
+                por_uf[uf] += 1
+                cnes = f'{2000000 + indice:07d}'
+                municipio = f'{uf}{rnd.randint(0, 9999):04d}'
+                data = f'{rnd.randint(1, 28):02d}/{rnd.randint(1, 12):02d}/{rnd.choice([2022, 2023, 2024])}'
+                escritor.writerow([
+                    f'{municipio}{cnes}', cnes, f'{rnd.randint(0, 10 ** 14):014d}', rnd.choice('13'), rnd.choice('13'),
+                    f'SECRETARIA MUNICIPAL DE SAÚDE DE {municipio}', f'UNIDADE BÁSICA DE SAÚDE {cnes}',
+                    'AVENIDA PRESIDENTE DUTRA', str(rnd.randint(1, 9999)), '', 'CENTRO',
+                    f'{rnd.randint(10000000, 99999999)}', f'({uf}) 3{rnd.randint(0, 9999999):07d}',
+                    f'ubs{cnes}@saude.gov.br', '', str(rnd.choice([1, 2, 4, 5, 7, 15, 22, 36, 39, 40, 70])),
+                    str(rnd.randint(1, 6)), str(uf), municipio, data, f'{rnd.uniform(-33, 5):.6f}',
+                    f'{rnd.uniform(-73, -35):.6f}', data, str(rnd.choice([1023, 1244, 2062, 3999])),
+                    str(rnd.randint(1, 80)), rnd.choice('EMD'), str(uf),
+                ])
+            texto.flush()
+            texto.detach()
+    return por_uf
+
+
+def _rss_mb():
+    # ru_maxrss é em KB no Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _etapa_filtrar(uf):
+    from EstabelecimentosCsvDownload import filtrar_estabelecimentos
+    filtrar_estabelecimentos([uf])
+
+
+def _etapa_consultar(uf, url_base, max_concorrencia, orcamento_hedge):
+    from BuscarCnesApiOficial import consultar_lista_cnes_api, ler_codigos_cnes
+    from EstabelecimentosCsvDownload import caminho_codigos_uf
+    caminho_csv = caminho_codigos_uf(uf)
+    return consultar_lista_cnes_api(ler_codigos_cnes(caminho_csv), caminho_csv=caminho_csv, uf=uf,
+                                    max_concorrencia=max_concorrencia, url_base=url_base, usar_cache=False,
+                                    orcamento_hedge=orcamento_hedge)
+
+
+def _etapa_gerar(uf):
+    from GerarScriptSQLCnes import gerar_script_uf
+    gerar_script_uf(uf)
+
+
+def _etapa_carregar(uf, dsn):
+    import psycopg2
+    from GerarScriptSQLCnes import nome_particao
+    from UptadeBancoDeDados import garantir_particao_uf, carregar_uf
+    conn = psycopg2.connect(dsn, options='-c search_path=cnes_benchmark')
+    try:
+        garantir_particao_uf(conn, uf)
+        carregar_uf(conn, uf)
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {nome_particao(uf)}")
+            return {'linhas_na_particao': cursor.fetchone()[0]}
+    finally:
+        conn.close()
+
+
+ETAPAS_PONTA_A_PONTA = {
+    'filtrar_estabelecimentos': _etapa_filtrar,
+    'consultar_lista_cnes_api': _etapa_consultar,
+    'gerar_upsert_cnes': _etapa_gerar,
+    'carregar_banco': _etapa_carregar,
+}
+
+
+def _executar_etapa_isolada(fila, etapa, argumentos):
+    """
+    Roda uma etapa em um processo próprio (o pico de RSS medido é só o dela) e devolve
+    pela fila o tempo de parede, o tempo de CPU, o pico de RSS e o retorno da etapa
+    """
+    try:
+        rss_inicial = _rss_mb()
+        uso_inicial = resource.getrusage(resource.RUSAGE_SELF)
+        inicio = time.perf_counter()
+        detalhes = ETAPAS_PONTA_A_PONTA[etapa](**argumentos)
+        segundos = time.perf_counter() - inicio
+        uso = resource.getrusage(resource.RUSAGE_SELF)
+        fila.put({
+            'segundos': round(segundos, 3),
+            'cpu_segundos': round(uso.ru_utime + uso.ru_stime - uso_inicial.ru_utime - uso_inicial.ru_stime, 3),
+            'rss_inicial_mb': rss_inicial,
+            'pico_rss_mb': _rss_mb(),
+            'detalhes': detalhes,
+        })
+    except BaseException as e:
+        fila.put({'erro': f'{type(e).__name__}: {e}'})
+        raise
+
+
+def _contar_linhas(caminho):
+    if not os.path.exists(caminho):
+        return 0
+    with open(caminho, 'rb') as f:
+        return sum(1 for _ in f)
+
+
+def versao_codigo():
+    """
+    Commit atual do repositório (com '+alterado' se houver mudanças não commitadas), ou None
+    """
+    pasta = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=pasta, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        alterado = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=pasta,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f'{commit}+alterado' if alterado else commit
+
+
+def benchmark_ponta_a_ponta(dsn=None, quantidade=200000, uf=11, latencia=0.01, taxa_erro=0.0, max_concorrencia=100,
+                            modo_carga='sql', orcamento_hedge=0.0, saida=None):
+    """
+    Executa todas as etapas da automação, como nos scripts isolados, sobre um dump
+    sintético (gerar_dump_sintetico) e o mock da API, numa pasta de downloads temporária
+    (CNES_PASTA_DOWNLOADS): filtragem do .zip, busca na API (JSONL), geração do script
+    SQL (só no modo de carga 'sql') e carga no PostgreSQL de dsn, no schema
+    cnes_benchmark (recriado). Sem dsn, a carga é pulada.
+    Cada etapa roda em um processo próprio; o relatório traz, por etapa, tempo de parede,
+    tempo de CPU, itens por segundo e pico de RSS, e é gravado em JSON em saida, para
+    comparação entre commits (ver comparar_relatorios).
+    """
+    contexto = multiprocessing.get_context('spawn')
+    etapas = []
+    ambiente_anterior = {chave: os.environ.get(chave) for chave in ('CNES_PASTA_DOWNLOADS', 'CNES_MODO_CARGA')}
+    with tempfile.TemporaryDirectory() as pasta, \
+            MockApiCnes(latencia=latencia, taxa_erro=taxa_erro) as mock:
+        # Os processos das etapas herdam o ambiente: pasta de downloads e modo de carga do benchmark
+        os.environ['CNES_PASTA_DOWNLOADS'] = pasta
+        os.environ['CNES_MODO_CARGA'] = modo_carga
+        try:
+            inicio = time.perf_counter()
+            por_uf = gerar_dump_sintetico(os.path.join(pasta, 'cnes_estabelecimentos.zip'), quantidade)
+            etapas.append({'etapa': 'gerar_dump_sintetico', 'segundos': round(time.perf_counter() - inicio, 3),
+                           'itens': quantidade, 'detalhes': {'bytes_zip': os.path.getsize(
+                               os.path.join(pasta, 'cnes_estabelecimentos.zip'))}})
+            pasta_da_uf = os.path.join(pasta, f'uf_{uf}')
+            planejadas = [
+                ('filtrar_estabelecimentos', {'uf': uf}, lambda: quantidade),
+                ('consultar_lista_cnes_api', {'uf': uf, 'url_base': mock.url, 'max_concorrencia': max_concorrencia,
+                                              'orcamento_hedge': orcamento_hedge}, lambda: por_uf[uf]),
+            ]
+            if modo_carga == 'sql':
+                planejadas.append(('gerar_upsert_cnes', {'uf': uf}, lambda: _contar_linhas(
+                    os.path.join(pasta_da_uf, 'cnes_resultados.jsonl'))))
+            else:
+                planejadas.append(('gerar_upsert_cnes', 'o modo de carga copy lê o JSONL direto', None))
+            if dsn:
+                planejadas.append(('carregar_banco', {'uf': uf, 'dsn': dsn}, lambda: por_uf[uf]))
+                import psycopg2
+                conn = psycopg2.connect(dsn)
+                with conn.cursor() as cursor:
+                    cursor.execute("DROP SCHEMA IF EXISTS cnes_benchmark CASCADE")
+                    cursor.execute("CREATE SCHEMA cnes_benchmark")
+                    cursor.execute("SET search_path TO cnes_benchmark")
+                    cursor.execute(ddl_unidade_saude())
+                conn.commit()
+            else:
+                planejadas.append(('carregar_banco', 'sem dsn de um PostgreSQL local', None))
+
+            for etapa, argumentos, contar_itens in planejadas:
+                if contar_itens is None:
+                    # Etapa pulada: argumentos traz o motivo
+                    etapas.append({'etapa': etapa, 'pulada': argumentos})
+                    continue
+                itens = contar_itens()
+                fila = contexto.Queue()
+                processo = contexto.Process(target=_executar_etapa_isolada, args=(fila, etapa, argumentos))
+                processo.start()
+                resultado = fila.get()
+                processo.join()
+                if 'erro' in resultado:
+                    raise RuntimeError(f"Etapa {etapa} falhou: {resultado['erro']}")
+                resultado.update(etapa=etapa, itens=itens,
+                                 itens_por_segundo=round(itens / resultado['segundos'], 1) if resultado['segundos'] else None)
+                etapas.append(resultado)
+                print(f"⏱️ {etapa}: {resultado['segundos']}s, {resultado['itens_por_segundo']} itens/s, "
+                      f"pico de {resultado['pico_rss_mb']} MB")
+            if dsn:
+                with conn.cursor() as cursor:
+                    cursor.execute("DROP SCHEMA cnes_benchmark CASCADE")
+                conn.commit()
+                conn.close()
+        finally:
+            for chave, valor in ambiente_anterior.items():
+                if valor is None:
+                    os.environ.pop(chave, None)
+                else:
+                    os.environ[chave] = valor
+
+    relatorio = {
+        'versao': versao_codigo(),
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'parametros': {'quantidade': quantidade, 'uf': uf, 'latencia': latencia, 'taxa_erro': taxa_erro,
+                       'max_concorrencia': max_concorrencia, 'modo_carga': modo_carga,
+                       'orcamento_hedge': orcamento_hedge, 'com_banco': bool(dsn)},
+        'etapas': etapas,
+        'total_segundos': round(sum(etapa.get('segundos', 0) for etapa in etapas), 3),
+    }
+    if saida:
+        with open(saida, 'w', encoding='utf-8') as f:
+            json.dump(relatorio, f, ensure_ascii=False, indent=2)
+        print(f"Relatório gravado em {saida}")
+    return [relatorio]
+
+
+def comparar_relatorios(caminho_base, caminho_novo):
+    """
+    Compara dois relatórios de benchmark_ponta_a_ponta (ex.: de dois commits), etapa a etapa.
+    Razão < 1 em segundos/pico de RSS e > 1 em itens/s indicam melhora.
+    """
+    relatorios = []
+    for caminho in (caminho_base, caminho_novo):
+        with open(caminho, 'r', encoding='utf-8') as f:
+            relatorios.append(json.load(f))
+    base, novo = ({etapa['etapa']: etapa for etapa in relatorio['etapas']} for relatorio in relatorios)
+    if relatorios[0]['parametros'] != relatorios[1]['parametros']:
+        print(f"⚠️ Parâmetros diferentes: {relatorios[0]['parametros']} x {relatorios[1]['parametros']}")
+    resultados = []
+    for etapa in base:
+        if etapa not in novo:
+            continue
+        comparacao = {'etapa': etapa, 'versoes': [relatorios[0]['versao'], relatorios[1]['versao']]}
+        for metrica in ('segundos', 'itens_por_segundo', 'pico_rss_mb'):
+            antes, depois = base[etapa].get(metrica), novo[etapa].get(metrica)
+            if antes and depois:
+                comparacao[metrica] = [antes, depois, round(depois / antes, 3)]
+        resultados.append(comparacao)
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks locais da automação CNES')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_api = subparsers.add_parser('api', help='Busca na API: threads x asyncio contra um mock local')
+    parser_api.add_argument('--quantidade', type=int, default=2000)
+    parser_api.add_argument('--latencia', type=float, default=0.05, help='Latência do mock em segundos')
+    parser_api.add_argument('--max-workers', type=int, default=20)
+    parser_api.add_argument('--max-concorrencia', type=int, default=200)
+    parser_api.add_argument('--taxa-erro', type=float, default=0.0, help='Fração de respostas 503 do mock')
+    parser_api.add_argument('--capacidade', type=int, default=None,
+                            help='Requisições simultâneas aceitas pelo mock antes de responder 429')
+
+    parser_listagem = subparsers.add_parser('listagem', help='Busca de uma UF: por código x listagem paginada')
+    parser_listagem.add_argument('--quantidade', type=int, default=10000)
+    parser_listagem.add_argument('--latencia', type=float, default=0.05, help='Latência do mock em segundos')
+    parser_listagem.add_argument('--max-concorrencia', type=int, default=50)
+    parser_listagem.add_argument('--tamanho-pagina', type=int, default=20,
+                                 help='Estabelecimentos por página (também o limite do mock)')
+    parser_listagem.add_argument('--fracao-fora-da-listagem', type=float, default=0.02,
+                                 help='Fração dos códigos ausentes da listagem do mock')
+
+    parser_hedge = subparsers.add_parser('hedge', help='Busca na API: sem x com requisições duplicadas (hedge)')
+    parser_hedge.add_argument('--quantidade', type=int, default=5000)
+    parser_hedge.add_argument('--latencia', type=float, default=0.05, help='Latência do mock em segundos')
+    parser_hedge.add_argument('--max-concorrencia', type=int, default=50)
+    parser_hedge.add_argument('--fracao-lenta', type=float, default=0.02,
+                              help='Fração das requisições do mock com latência alta')
+    parser_hedge.add_argument('--latencia-lenta', type=float, default=2.0, help='Latência alta do mock em segundos')
+    parser_hedge.add_argument('--orcamento', type=float, default=0.05, help='Fração máxima de requisições extras')
+
+    parser_repescagem = subparsers.add_parser('repescagem',
+                                              help='Busca na API: repetições imediatas x repescagem das falhas')
+    parser_repescagem.add_argument('--quantidade', type=int, default=5000)
+    parser_repescagem.add_argument('--latencia', type=float, default=0.05, help='Latência do mock em segundos')
+    parser_repescagem.add_argument('--max-concorrencia', type=int, default=50)
+    parser_repescagem.add_argument('--taxa-erro', type=float, default=0.1, help='Fração de respostas 503 do mock')
+
+    parser_codificacao = subparsers.add_parser('codificacao',
+                                               help='Linhas do COPY e de VALUES: valor a valor x codificador tipado')
+    parser_codificacao.add_argument('--quantidade', type=int, default=50000)
+    parser_codificacao.add_argument('--fracao-invalida', type=float, default=0.01,
+                                    help='Fração dos registros com um valor malformado')
+
+    parser_indice = subparsers.add_parser('indice-espacial',
+                                          help='Estabelecimento mais próximo: índice espacial x varredura')
+    parser_indice.add_argument('--quantidade', type=int, default=600000)
+    parser_indice.add_argument('--consultas', type=int, default=500)
+    parser_indice.add_argument('-k', type=int, default=5, help='Estabelecimentos por consulta k mais próximos')
+    parser_indice.add_argument('--raio', type=float, default=10.0, help='Raio das consultas por raio (km)')
+
+    parser_snapshot = subparsers.add_parser('snapshot', help='Registros em JSON x snapshot Parquet, e comparação')
+    parser_snapshot.add_argument('--quantidade', type=int, default=50000)
+    parser_snapshot.add_argument('--fracao-alterada', type=float, default=0.05)
+    parser_snapshot.add_argument('--fracao-removida', type=float, default=0.01)
+    parser_snapshot.add_argument('--fracao-nova', type=float, default=0.01)
+
+    parser_carga = subparsers.add_parser('carga', help='Carga no PostgreSQL: script SQL em lotes x COPY + merge')
+    parser_carga.add_argument('--dsn', default=os.environ.get('CNES_BENCHMARK_DSN', 'dbname=postgres'),
+                              help='Conexão com um PostgreSQL local (o schema cnes_benchmark é recriado)')
+    parser_carga.add_argument('--quantidade', type=int, default=20000)
+    parser_carga.add_argument('--tamanho-lote', type=int, default=1000)
+    parser_carga.add_argument('--fracao-alterada', type=float, default=0.05,
+                              help='Fração dos registros com conteúdo alterado na recarga')
+
+    parser_paralela = subparsers.add_parser('carga-paralela',
+                                            help='Carga no PostgreSQL com 1, 2, 4... conexões em paralelo')
+    parser_paralela.add_argument('--dsn', default=os.environ.get('CNES_BENCHMARK_DSN', 'dbname=postgres'),
+                                 help='Conexão com um PostgreSQL local (o schema cnes_benchmark é recriado)')
+    parser_paralela.add_argument('--quantidade', type=int, default=100000)
+    parser_paralela.add_argument('--conexoes', default='1,2,4,8', help='Quantidades de conexões comparadas')
+    parser_paralela.add_argument('--modo-carga', choices=['sql', 'copy'], default='copy')
+    parser_paralela.add_argument('--tamanho-lote', type=int, default=2000)
+    parser_paralela.add_argument('--fracao-alterada', type=float, default=0.05,
+                                 help='Fração dos registros com conteúdo alterado na recarga')
+
+    parser_reconciliacao = subparsers.add_parser('reconciliacao',
+                                                 help='Snapshot x banco: comparação linha a linha x por baldes')
+    parser_reconciliacao.add_argument('--dsn', default=os.environ.get('CNES_BENCHMARK_DSN', 'dbname=postgres'),
+                                      help='Conexão com um PostgreSQL local (o schema cnes_benchmark é recriado)')
+    parser_reconciliacao.add_argument('--quantidade', type=int, default=100000)
+    parser_reconciliacao.add_argument('--divergentes', type=int, default=50,
+                                      help='Linhas alteradas ou apagadas no banco depois da carga')
+    parser_reconciliacao.add_argument('--baldes', type=int, default=1024)
+
+    parser_pipeline = subparsers.add_parser('pipeline', help='Busca + carga: em etapas x em fluxo')
+    parser_pipeline.add_argument('--dsn', default=os.environ.get('CNES_BENCHMARK_DSN', 'dbname=postgres'),
+                                 help='Conexão com um PostgreSQL local (o schema cnes_benchmark é recriado)')
+    parser_pipeline.add_argument('--quantidade', type=int, default=5000)
+    parser_pipeline.add_argument('--latencia', type=float, default=0.05, help='Latência do mock em segundos')
+    parser_pipeline.add_argument('--max-concorrencia', type=int, default=50)
+    parser_pipeline.add_argument('--modo-carga', choices=['sql', 'copy'], default='sql')
+    parser_pipeline.add_argument('--tamanho-lote', type=int, default=500)
+
+    parser_ponta = subparsers.add_parser('ponta-a-ponta',
+                                         help='Todas as etapas sobre um dump sintético e o mock da API, com relatório JSON')
+    parser_ponta.add_argument('--dsn', default=os.environ.get('CNES_BENCHMARK_DSN'),
+                              help='Conexão com um PostgreSQL local (schema cnes_benchmark recriado); '
+                                   'sem ela, a carga é pulada')
+    parser_ponta.add_argument('--quantidade', type=int, default=200000, help='Linhas do dump sintético (todas as UFs)')
+    parser_ponta.add_argument('--uf', type=int, default=11, help='UF processada')
+    parser_ponta.add_argument('--latencia', type=float, default=0.01, help='Latência do mock em segundos')
+    parser_ponta.add_argument('--taxa-erro', type=float, default=0.0, help='Fração de respostas 503 do mock')
+    parser_ponta.add_argument('--max-concorrencia', type=int, default=100)
+    parser_ponta.add_argument('--modo-carga', choices=['sql', 'copy'], default='sql')
+    parser_ponta.add_argument('--orcamento-hedge', type=float, default=0.0)
+    parser_ponta.add_argument('--saida', default='benchmark_cnes.json', help='Arquivo JSON do relatório')
+
+    parser_comparar = subparsers.add_parser('comparar', help='Compara dois relatórios do ponta-a-ponta')
+    parser_comparar.add_argument('base')
+    parser_comparar.add_argument('novo')
+
+    args = parser.parse_args()
+    if args.benchmark == 'api':
+        resultados = benchmark_api(args.quantidade, args.latencia, args.max_workers, args.max_concorrencia,
+                                   args.taxa_erro, args.capacidade)
+    elif args.benchmark == 'listagem':
+        resultados = benchmark_listagem(args.quantidade, args.latencia, args.max_concorrencia, args.tamanho_pagina,
+                                        args.fracao_fora_da_listagem)
+    elif args.benchmark == 'hedge':
+        resultados = benchmark_hedge(args.quantidade, args.latencia, args.max_concorrencia, args.fracao_lenta,
+                                     args.latencia_lenta, args.orcamento)
+    elif args.benchmark == 'repescagem':
+        resultados = benchmark_repescagem(args.quantidade, args.latencia, args.max_concorrencia, args.taxa_erro)
+    elif args.benchmark == 'codificacao':
+        resultados = benchmark_codificacao(args.quantidade, args.fracao_invalida)
+    elif args.benchmark == 'indice-espacial':
+        resultados = benchmark_indice_espacial(args.quantidade, args.consultas, args.k, args.raio)
+    elif args.benchmark == 'snapshot':
+        resultados = benchmark_snapshot(args.quantidade, args.fracao_alterada, args.fracao_removida, args.fracao_nova)
+    elif args.benchmark == 'ponta-a-ponta':
+        resultados = benchmark_ponta_a_ponta(args.dsn, args.quantidade, args.uf, args.latencia, args.taxa_erro,
+                                             args.max_concorrencia, args.modo_carga, args.orcamento_hedge, args.saida)
+    elif args.benchmark == 'comparar':
+        resultados = comparar_relatorios(args.base, args.novo)
+    elif args.benchmark == 'carga':
+        resultados = benchmark_carga(args.dsn, args.quantidade, args.tamanho_lote, args.fracao_alterada)
+    elif args.benchmark == 'carga-paralela':
+        resultados = benchmark_carga_paralela(args.dsn, args.quantidade,
+                                              [int(valor) for valor in args.conexoes.split(',')],
+                                              args.modo_carga, args.tamanho_lote, args.fracao_alterada)
+    elif args.benchmark == 'reconciliacao':
+        resultados = benchmark_reconciliacao(args.dsn, args.quantidade, args.divergentes, args.baldes)
+    elif args.benchmark == 'pipeline':
+        resultados = benchmark_pipeline(args.dsn, args.quantidade, args.latencia, args.max_concorrencia,
+                                        args.modo_carga, args.tamanho_lote)
+
+    for resultado in resultados:
+        print(json.dumps(resultado, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
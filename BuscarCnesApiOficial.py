@@ -1,7 +1,278 @@
 import os
+import asyncio
+import collections
+import inspect
+import itertools
+import random
+import time
 import requests
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from CacheApiCnes import CacheRespostasCnes, cabecalhos_condicionais
+from EstabelecimentosCsvDownload import UF_PADRAO, UFS, pasta_uf, caminho_codigos_uf
+from MetricasCnes import metricas
+
+# Endereço base da API de dados abertos. Pode ser sobrescrito pela variável de
+# ambiente CNES_API_URL (ex.: servidor local de testes/benchmark)
+URL_API_CNES = os.environ.get('CNES_API_URL', 'https://apidadosabertos.saude.gov.br')
+
+# Requisições simultâneas no modo assíncrono (todas em uma única thread).
+# O controle adaptativo começa em CONCORRENCIA_INICIAL e nunca passa de MAX_CONCORRENCIA
+MAX_CONCORRENCIA = 200
+CONCORRENCIA_INICIAL = 20
+
+# Status HTTP que indicam falha temporária e devem ser repetidos
+STATUS_REPETIR = {429, 500, 502, 503, 504}
+# Status que indicam que o servidor está sobrecarregado (reduzem a concorrência pela metade)
+STATUS_SOBRECARGA = {429, 503}
+
+# Backoff exponencial: espera máxima de BACKOFF_BASE * 2^tentativa, limitada a BACKOFF_TETO segundos
+BACKOFF_BASE = 1.0
+BACKOFF_TETO = 60.0
+
+# Sem JSONL (registros entregues em memória), o estado incremental é gravado a cada
+# INTERVALO_COMMIT_ESTADO consultas ou INTERVALO_COMMIT_ESTADO_SEGUNDOS, o que vier primeiro
+INTERVALO_COMMIT_ESTADO = 500
+INTERVALO_COMMIT_ESTADO_SEGUNDOS = 1.0
+
+# Busca pela listagem paginada /cnes/estabelecimentos?codigo_uf=..&limit=..&offset=..:
+# uma requisição traz até TAMANHO_PAGINA estabelecimentos da UF, e só os códigos que não
+# vieram na listagem são consultados um a um. A API pode devolver páginas menores que
+# o pedido; o tamanho efetivo é o da primeira página
+USAR_LISTAGEM = os.environ.get('CNES_USAR_LISTAGEM', '0') == '1'
+TAMANHO_PAGINA = int(os.environ.get('CNES_TAMANHO_PAGINA', '20'))
+# As páginas são poucas e cada uma traz muitos códigos: são repetidas na hora, com espera
+TENTATIVAS_PAGINA = 3
+
+# Requisições duplicadas (hedge) no modo assíncrono: uma tentativa que passa do p95 das
+# latências recentes ganha uma cópia, e vale a primeira resposta. ORCAMENTO_HEDGE é a
+# fração máxima de requisições extras (ex.: 0.05 = até 5% a mais); 0 desliga
+ORCAMENTO_HEDGE = float(os.environ.get('CNES_ORCAMENTO_HEDGE', '0'))
+# Latências mais recentes guardadas para os percentis do resumo da busca
+AMOSTRA_LATENCIAS = 10000
+
+# Fila de falhas e repescagem: a passagem principal faz TENTATIVAS_PASSAGEM_PRINCIPAL
+# tentativas por código, sem esperar entre elas; os códigos que falharam por erro
+# transitório (conexão, 429, 5xx) são repetidos no fim da busca, com concorrência
+# CONCORRENCIA_REPESCAGEM e até TENTATIVAS_REPESCAGEM tentativas com espera. O que ainda
+# falhar vai para a fila de falhas da UF (EstadoIncrementalCnes) e entra na próxima execução.
+# A passagem principal faz pelo menos uma tentativa
+TENTATIVAS_PASSAGEM_PRINCIPAL = max(1, int(os.environ.get('CNES_TENTATIVAS_PASSAGEM_PRINCIPAL', '1')))
+CONCORRENCIA_REPESCAGEM = int(os.environ.get('CNES_CONCORRENCIA_REPESCAGEM', '10'))
+TENTATIVAS_REPESCAGEM = int(os.environ.get('CNES_TENTATIVAS_REPESCAGEM', '4'))
+
+def falha_definitiva(falha):
+    """
+    True se a falha ({'status', 'tentativas'}) daria o mesmo resultado em qualquer
+    execução: 404 (código inexistente na API) e os demais 4xx, menos 408 e 429. Essas
+    não vão para a fila de falhas, que é consultada de novo a cada execução.
+    """
+    status = falha['status']
+    return status is not None and 400 <= status < 500 and status not in STATUS_REPETIR | {408}
+
+def ler_retry_after(valor):
+    """
+    Converte o cabeçalho Retry-After (segundos ou data HTTP) em segundos de espera.
+    Retorna None se ausente ou inválido.
+    """
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def calcular_espera(tentativa, retry_after=None):
+    """
+    Tempo de espera antes da próxima tentativa: o Retry-After do servidor, se houver,
+    ou backoff exponencial com jitter completo (sorteado entre 0 e o teto da tentativa).
+    """
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_TETO)
+    return random.uniform(0, min(BACKOFF_TETO, BACKOFF_BASE * 2 ** tentativa))
+
+def registrar_resposta(origem, latencia, status):
+    """
+    Registra nas métricas da execução o status (None para erro de conexão/timeout) e a
+    latência de uma requisição à API; origem é 'estabelecimento' ou 'listagem'
+    """
+    metricas.contar('respostas_http', origem=origem, status='falha_conexao' if status is None else status)
+    metricas.observar('latencia_requisicao_segundos', latencia, origem=origem)
+
+def espera_nova_tentativa(origem, tentativa, retry_after=None):
+    """
+    calcular_espera, registrando a repetição e o tempo de espera nas métricas da execução
+    """
+    espera = calcular_espera(tentativa, retry_after)
+    metricas.contar('tentativas_repetidas', origem=origem)
+    metricas.contar('espera_backoff_segundos', espera, origem=origem)
+    return espera
+
+class ControleConcorrencia:
+    """
+    Controle adaptativo (AIMD) do número de requisições simultâneas no modo assíncrono.
+    Até o primeiro corte o limite sobe 1 por resposta saudável (dobra a cada rodada);
+    depois sobe 1 a cada 'limite' respostas saudáveis. É reduzido quando o servidor
+    responde 429/503 (pela metade, com pausa global se houver Retry-After), quando há
+    erros 5xx/de conexão ou quando a latência passa de tolerancia_latencia vezes a
+    latência de referência (redução de 10%).
+    """
+
+    def __init__(self, inicial=CONCORRENCIA_INICIAL, minimo=1, maximo=MAX_CONCORRENCIA, tolerancia_latencia=2.0):
+        self.limite = float(min(inicial, maximo))
+        self.minimo = minimo
+        self.maximo = maximo
+        self.tolerancia_latencia = tolerancia_latencia
+        self.em_andamento = 0
+        self.latencia_base = None
+        self.saudaveis = 0
+        self.partida_lenta = True
+        self.ultimo_corte = 0.0
+        self.pausa_ate = 0.0
+        self.limite_maximo_atingido = int(self.limite)
+        self.sobrecargas = 0
+        self._condicao = asyncio.Condition()
+
+    async def __aenter__(self):
+        while True:
+            espera = self.pausa_ate - time.monotonic()
+            if espera > 0:
+                await asyncio.sleep(espera)
+                continue
+            async with self._condicao:
+                await self._condicao.wait_for(lambda: self.em_andamento < int(self.limite))
+                if time.monotonic() >= self.pausa_ate:
+                    self.em_andamento += 1
+                    return self
+
+    async def __aexit__(self, *exc):
+        async with self._condicao:
+            self.em_andamento -= 1
+            self._condicao.notify_all()
+
+    def _reduzir(self, fator, latencia):
+        agora = time.monotonic()
+        # No máximo um corte por "rodada" de requisições, para uma rajada de erros não zerar o limite
+        if agora - self.ultimo_corte >= latencia:
+            self.limite = max(self.minimo, self.limite * fator)
+            self.ultimo_corte = agora
+            self.saudaveis = 0
+            self.partida_lenta = False
+
+    def registrar(self, latencia, status, retry_after=None):
+        """
+        Registra o resultado de uma requisição (status None para erro de conexão/timeout)
+        """
+        if status in STATUS_SOBRECARGA:
+            self.sobrecargas += 1
+            self._reduzir(0.5, latencia)
+            if retry_after:
+                self.pausa_ate = max(self.pausa_ate, time.monotonic() + min(retry_after, BACKOFF_TETO))
+            return
+        if status is None or status >= 500:
+            self._reduzir(0.9, latencia)
+            return
+
+        # Latência de referência: a menor observada, subindo devagar para acompanhar o servidor
+        if self.latencia_base is None or latencia < self.latencia_base:
+            self.latencia_base = latencia
+        else:
+            self.latencia_base *= 1.001
+        if latencia > self.tolerancia_latencia * self.latencia_base:
+            self._reduzir(0.9, latencia)
+            return
+
+        self.saudaveis += 1
+        if (self.partida_lenta or self.saudaveis >= self.limite) and self.limite < self.maximo:
+            self.limite = min(self.maximo, self.limite + 1)
+            self.limite_maximo_atingido = max(self.limite_maximo_atingido, int(self.limite))
+            self.saudaveis = 0
+
+def percentis_latencia(latencias, percentis=(50, 90, 95, 99)):
+    """
+    Percentis (método do posto mais próximo) e máximo de uma lista de latências em segundos.
+    Retorna {'p50': ..., 'max': ...} em milissegundos, ou {} se a lista estiver vazia.
+    """
+    if not latencias:
+        return {}
+    ordenadas = sorted(latencias)
+    resultado = {f'p{p}': round(1000 * ordenadas[max(0, -(-p * len(ordenadas) // 100) - 1)], 1)
+                 for p in percentis}
+    resultado['max'] = round(1000 * ordenadas[-1], 1)
+    return resultado
+
+class ControleHedge:
+    """
+    Registra a latência de cada tentativa do modo assíncrono (percentis das últimas
+    AMOSTRA_LATENCIAS no resumo da busca) e, com orcamento > 0, duplica as tentativas
+    lentas: se a resposta não chega até o p95 das últimas 'janela' latências (que
+    acompanha a latência atual do servidor), uma cópia da requisição é enviada e vale
+    a que responder primeiro (a outra é cancelada). As cópias não passam de 'orcamento'
+    vezes o número de tentativas, nem começam antes de 'minimo_amostras' latências.
+    """
+
+    def __init__(self, orcamento=ORCAMENTO_HEDGE, janela=1000, minimo_amostras=100):
+        self.orcamento = orcamento
+        self.minimo_amostras = minimo_amostras
+        self.latencias = collections.deque(maxlen=AMOSTRA_LATENCIAS)
+        self.registradas = 0
+        self.tentativas = 0
+        self.duplicadas = 0
+        self.vencidas_pela_copia = 0
+        self._recentes = collections.deque(maxlen=janela)
+        self._limiar = None
+
+    def registrar(self, latencia):
+        self.latencias.append(latencia)
+        self._recentes.append(latencia)
+        self.registradas += 1
+        # O p95 das últimas 'janela' latências é recalculado a cada 50, não a cada tentativa
+        if len(self._recentes) >= self.minimo_amostras and self.registradas % 50 == 0:
+            ordenadas = sorted(self._recentes)
+            self._limiar = ordenadas[int(0.95 * (len(ordenadas) - 1))]
+
+    def _pode_duplicar(self):
+        return self._limiar is not None and self.duplicadas < self.orcamento * self.tentativas
+
+    async def executar(self, fabrica):
+        """
+        Executa a corrotina criada por fabrica() e, se ela passar do limiar, uma cópia;
+        retorna o resultado da primeira que terminar sem exceção (ou levanta a da última)
+        """
+        self.tentativas += 1
+        primeira = asyncio.ensure_future(fabrica())
+        pendentes = {primeira}
+        try:
+            if self.orcamento > 0 and self._limiar is not None:
+                await asyncio.wait(pendentes, timeout=self._limiar)
+                if not primeira.done() and self._pode_duplicar():
+                    self.duplicadas += 1
+                    metricas.contar('requisicoes_duplicadas')
+                    pendentes.add(asyncio.ensure_future(fabrica()))
+            while True:
+                concluidas, pendentes = await asyncio.wait(pendentes, return_when=asyncio.FIRST_COMPLETED)
+                # exception() é lido de todas as concluídas, para nenhuma ficar sem tratamento
+                sem_erro = [tarefa for tarefa in concluidas if tarefa.exception() is None]
+                if sem_erro:
+                    if sem_erro[0] is not primeira:
+                        self.vencidas_pela_copia += 1
+                    return sem_erro[0].result()
+                if not pendentes:
+                    raise concluidas.pop().exception()
+        finally:
+            for tarefa in pendentes:
+                tarefa.cancel()
+
+    def resumo(self):
+        return {'latencia_ms': percentis_latencia(self.latencias), 'tentativas': self.tentativas,
+                'duplicadas': self.duplicadas, 'vencidas_pela_copia': self.vencidas_pela_copia}
 
 def ler_codigos_cnes(caminho_csv):
     """
@@ -13,74 +284,640 @@ def ler_codigos_cnes(caminho_csv):
         codigos = conteudo.strip().split(',')
     return codigos
 
-def requisicao_cnes(codigo_cnes, max_retries=3):
-        url = f'https://apidadosabertos.saude.gov.br/cnes/estabelecimentos/{codigo_cnes}'
+def requisicao_cnes(codigo_cnes, max_retries=3, url_base=URL_API_CNES, cache=None, falhas=None):
+        url = f'{url_base}/cnes/estabelecimentos/{codigo_cnes}'
         headers = {'accept': 'application/json'}
+
+        # Consulta o cache em disco antes de ir à rede; entradas vencidas são revalidadas
+        entrada = cache.obter(codigo_cnes) if cache else None
+        if entrada and entrada['fresco']:
+            return entrada['dados']
+        headers.update(cabecalhos_condicionais(entrada))
         
+        # Ao menos uma tentativa, também com max_retries <= 0
+        max_retries = max(1, max_retries)
         for tentativa in range(max_retries):
+            retry_after = None
+            status = None
+            inicio = time.monotonic()
             try:
                 response = requests.get(url, headers=headers, timeout=30)
+                status = response.status_code
+                registrar_resposta('estabelecimento', time.monotonic() - inicio, response.status_code)
                 if response.status_code == 200:
-                    return response.json()
+                    dados = response.json()
+                    if cache:
+                        cache.gravar(codigo_cnes, dados, response.headers.get('ETag'),
+                                     response.headers.get('Last-Modified'))
+                    return dados
+                elif response.status_code == 304 and entrada:
+                    cache.renovar(codigo_cnes)
+                    return entrada['dados']
                 elif response.status_code == 404:
                     print(f'CNES {codigo_cnes} não encontrado')
-                    return None
+                    break
                 else:
                     print(f'Erro HTTP {response.status_code} para CNES {codigo_cnes}')
+                    if response.status_code not in STATUS_REPETIR:
+                        break
+                    retry_after = ler_retry_after(response.headers.get('Retry-After'))
             except requests.exceptions.RequestException as e:
+                registrar_resposta('estabelecimento', time.monotonic() - inicio, None)
                 print(f'Tentativa {tentativa + 1} falhou para CNES {codigo_cnes}: {e}')
-                if tentativa < max_retries - 1:
-                    time.sleep(2)  # Aguardar antes de tentar novamente
-                
+            if tentativa < max_retries - 1:
+                # Aguardar antes de tentar novamente
+                time.sleep(espera_nova_tentativa('estabelecimento', tentativa, retry_after))
+
+        if falhas is not None:
+            falhas[codigo_cnes] = {'status': status, 'tentativas': tentativa + 1}
         return None
 
-def consultar_lista_cnes_api(lista_codigos, pasta_downloads='downloads', max_workers=20, caminho_csv=None):
+async def requisicao_cnes_async(session, codigo_cnes, max_retries=3, url_base=URL_API_CNES, controle=None, cache=None,
+                                hedge=None, falhas=None):
+    """
+    Versão assíncrona de requisicao_cnes, usando uma sessão aiohttp compartilhada
+    (conexões keep-alive reaproveitadas do pool). Cada tentativa ocupa uma vaga do
+    ControleConcorrencia e informa a ele a latência e o status obtidos; a espera
+    entre tentativas acontece fora da vaga. Com hedge (ControleHedge), a latência de
+    cada tentativa é registrada e as tentativas lentas podem ganhar uma cópia, que
+    usa a mesma vaga. Se falhas for um dicionário, cada falha é anotada nele como
+    falhas[codigo] = {'status': último status (None para erro de conexão), 'tentativas'}.
+    """
+    import aiohttp
+    url = f'{url_base}/cnes/estabelecimentos/{codigo_cnes}'
+    controle = controle or ControleConcorrencia()
+
+    # Consulta o cache em disco antes de ir à rede; entradas vencidas são revalidadas
+    entrada = cache.obter(codigo_cnes) if cache else None
+    if entrada and entrada['fresco']:
+        return entrada['dados']
+    headers = cabecalhos_condicionais(entrada)
+    # Ao menos uma tentativa, também com max_retries <= 0
+    max_retries = max(1, max_retries)
+
+    async def requisitar():
+        async with session.get(url, headers=headers) as response:
+            dados = etag = last_modified = None
+            if response.status == 200:
+                dados = await response.json()
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+            return (response.status, dados, etag, last_modified,
+                    ler_retry_after(response.headers.get('Retry-After')))
+
+    for tentativa in range(max_retries):
+        retry_after = None
+        async with controle:
+            inicio = time.monotonic()
+            try:
+                if hedge is not None:
+                    status, dados, etag, last_modified, retry_after = await hedge.executar(requisitar)
+                else:
+                    status, dados, etag, last_modified, retry_after = await requisitar()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = None
+                print(f'Tentativa {tentativa + 1} falhou para CNES {codigo_cnes}: {e}')
+            latencia = time.monotonic() - inicio
+            controle.registrar(latencia, status, retry_after)
+            registrar_resposta('estabelecimento', latencia, status)
+            if hedge is not None:
+                hedge.registrar(latencia)
+
+        if status == 200:
+            if cache:
+                cache.gravar(codigo_cnes, dados, etag, last_modified)
+            return dados
+        elif status == 304 and entrada:
+            cache.renovar(codigo_cnes)
+            return entrada['dados']
+        elif status == 404:
+            print(f'CNES {codigo_cnes} não encontrado')
+            break
+        elif status is not None:
+            print(f'Erro HTTP {status} para CNES {codigo_cnes}')
+            if status not in STATUS_REPETIR:
+                break
+        if tentativa < max_retries - 1:
+            # Aguardar antes de tentar novamente
+            await asyncio.sleep(espera_nova_tentativa('estabelecimento', tentativa, retry_after))
+
+    if falhas is not None:
+        falhas[codigo_cnes] = {'status': status, 'tentativas': tentativa + 1}
+    return None
+
+async def consultar_cnes_async(lista_codigos, max_concorrencia=MAX_CONCORRENCIA, max_retries=3, url_base=URL_API_CNES,
+                               controle=None, cache=None, ao_concluir=None, hedge=None, falhas=None):
+    """
+    Consulta todos os códigos em uma única thread, com o número de requisições em
+    andamento ajustado pelo ControleConcorrencia (até max_concorrencia) e as latências
+    registradas no ControleHedge (que também duplica as requisições lentas, se tiver orçamento).
+    Se ao_concluir for informado, chama ao_concluir(codigo, resultado) a cada requisição
+    concluída e não acumula nada (se ela devolver um awaitable, o trabalhador o aguarda
+    antes do próximo código); senão retorna a lista de resultados (None para as que falharam).
+    As falhas são anotadas em falhas, se informado (ver requisicao_cnes_async).
+    """
+    import aiohttp
+    controle = controle or ControleConcorrencia(maximo=max_concorrencia)
+    hedge = hedge or ControleHedge()
+    # O pool de conexões tem folga para as cópias do hedge, que usam a vaga da original
+    conector = aiohttp.TCPConnector(limit=max_concorrencia + int(max_concorrencia * hedge.orcamento) + 1,
+                                    keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=30)
+    headers = {'accept': 'application/json', 'accept-encoding': 'gzip, deflate'}
+    pendentes = iter(lista_codigos)
+    resultados = []
+    if ao_concluir is None:
+        ao_concluir = lambda codigo, resultado: resultados.append(resultado)
+
+    async with aiohttp.ClientSession(connector=conector, timeout=timeout, headers=headers) as session:
+        async def trabalhador():
+            # Cada trabalhador consome o mesmo iterador até esgotar os códigos
+            for codigo in pendentes:
+                entrega = ao_concluir(codigo, await requisicao_cnes_async(session, codigo, max_retries, url_base,
+                                                                          controle, cache, hedge, falhas))
+                if inspect.isawaitable(entrega):
+                    await entrega
+
+        await asyncio.gather(*(trabalhador() for _ in range(max_concorrencia)))
+    print(f'Concorrência: limite final {int(controle.limite)}, máximo atingido {controle.limite_maximo_atingido}, '
+          f'respostas de sobrecarga (429/503): {controle.sobrecargas}')
+    if hedge.duplicadas:
+        print(f'Hedge: {hedge.duplicadas} requisições duplicadas de {hedge.tentativas} tentativas, '
+              f'{hedge.vencidas_pela_copia} respondidas primeiro pela cópia')
+    return resultados
+
+async def requisicao_pagina_async(session, uf, offset, limite, max_retries=3, url_base=URL_API_CNES, controle=None):
+    """
+    Busca uma página da listagem de estabelecimentos da UF, com as mesmas regras de
+    repetição e controle de concorrência de requisicao_cnes_async.
+    Retorna a lista de estabelecimentos da página ([] depois do fim) ou None se falhou.
+    """
+    import aiohttp
+    url = f'{url_base}/cnes/estabelecimentos'
+    params = {'codigo_uf': int(uf), 'limit': limite, 'offset': offset}
+    controle = controle or ControleConcorrencia()
+
+    for tentativa in range(max_retries):
+        retry_after = None
+        async with controle:
+            inicio = time.monotonic()
+            try:
+                async with session.get(url, params=params) as response:
+                    status = response.status
+                    if status == 200:
+                        corpo = await response.json()
+                    retry_after = ler_retry_after(response.headers.get('Retry-After'))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status = None
+                print(f'Tentativa {tentativa + 1} falhou para a página {offset} da listagem: {e}')
+            latencia = time.monotonic() - inicio
+            controle.registrar(latencia, status, retry_after)
+            registrar_resposta('listagem', latencia, status)
+
+        if status == 200:
+            # A API envolve a lista em {"estabelecimentos": [...]}
+            return corpo.get('estabelecimentos', []) if isinstance(corpo, dict) else corpo
+        elif status == 404:
+            return []
+        elif status is not None:
+            print(f'Erro HTTP {status} para a página {offset} da listagem')
+            if status not in STATUS_REPETIR:
+                return None
+        if tentativa < max_retries - 1:
+            # Aguardar antes de tentar novamente
+            await asyncio.sleep(espera_nova_tentativa('listagem', tentativa, retry_after))
+
+    return None
+
+async def consultar_listagem_async(uf, ao_estabelecimento, tamanho_pagina=TAMANHO_PAGINA,
+                                   max_concorrencia=MAX_CONCORRENCIA, max_retries=3, url_base=URL_API_CNES,
+                                   controle=None):
+    """
+    Percorre a listagem paginada dos estabelecimentos da UF com várias páginas (faixas de
+    offset) em andamento ao mesmo tempo, ajustadas pelo ControleConcorrencia, e chama
+    ao_estabelecimento(registro) uma vez por codigo_cnes recebido (se ela devolver um
+    awaitable, ele é aguardado antes de seguir, sem bloquear o loop de eventos).
+    A primeira página define o tamanho de página efetivo; a listagem termina na primeira
+    página incompleta ou sem nenhum código novo (as páginas já pedidas além do fim voltam
+    vazias). Páginas que falharam são apenas contadas: seus códigos ficam para a
+    consulta individual.
+    Retorna {'paginas', 'falhas', 'registros'}.
+    """
+    import aiohttp
+    controle = controle or ControleConcorrencia(maximo=max_concorrencia)
+    conector = aiohttp.TCPConnector(limit=max_concorrencia, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=60)
+    headers = {'accept': 'application/json', 'accept-encoding': 'gzip, deflate'}
+    contagem = {'paginas': 0, 'falhas': 0, 'registros': 0}
+    vistos = set()
+
+    async with aiohttp.ClientSession(connector=conector, timeout=timeout, headers=headers) as session:
+        async def buscar(offset, limite):
+            # Retorna (tamanho da página, códigos novos) ou None se a página falhou
+            contagem['paginas'] += 1
+            pagina = await requisicao_pagina_async(session, uf, offset, limite, max_retries, url_base, controle)
+            if pagina is None:
+                contagem['falhas'] += 1
+                return None
+            novos = 0
+            for registro in pagina:
+                codigo = registro.get('codigo_cnes')
+                if codigo is None or int(codigo) in vistos:
+                    continue
+                vistos.add(int(codigo))
+                novos += 1
+                entrega = ao_estabelecimento(registro)
+                if inspect.isawaitable(entrega):
+                    await entrega
+            contagem['registros'] += novos
+            return len(pagina), novos
+
+        primeira = await buscar(0, tamanho_pagina)
+        if primeira and primeira[0]:
+            passo = primeira[0]
+            offsets = itertools.count(passo, passo)
+            fim = [float('inf')]
+
+            async def trabalhador():
+                # Cada trabalhador pega o próximo offset até alguém encontrar o fim da listagem
+                for offset in offsets:
+                    if offset >= fim[0]:
+                        return
+                    resultado = await buscar(offset, passo)
+                    # Página incompleta, ou só com códigos repetidos (offset ignorado pelo servidor)
+                    if resultado is not None and (resultado[0] < passo or not resultado[1]):
+                        fim[0] = min(fim[0], offset + passo)
+
+            await asyncio.gather(*(trabalhador() for _ in range(max_concorrencia)))
+    print(f'Listagem da UF {uf}: {contagem["registros"]} estabelecimentos em {contagem["paginas"]} páginas '
+          f'({contagem["falhas"]} com erro)')
+    return contagem
+
+def consultar_cnes_threads(lista_codigos, max_workers=20, max_retries=3, url_base=URL_API_CNES, cache=None,
+                           ao_concluir=None, falhas=None):
+    """
+    Consulta todos os códigos com um ThreadPoolExecutor (uma conexão por requisição).
+    Se ao_concluir for informado, chama ao_concluir(codigo, resultado) (na thread principal)
+    a cada requisição concluída; senão retorna a lista de resultados (None para as que falharam).
+    """
+    resultados = []
+    if ao_concluir is None:
+        ao_concluir = lambda codigo, resultado: resultados.append(resultado)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_codigo = {executor.submit(requisicao_cnes, codigo, max_retries, url_base, cache, falhas): codigo
+                            for codigo in lista_codigos}
+        for future in as_completed(future_to_codigo):
+            ao_concluir(future_to_codigo[future], future.result())
+    return resultados
+
+class GravadorResultados:
+    """
+    Grava os resultados da API em JSON Lines (um registro compacto por linha) à medida que
+    chegam, com fsync a cada intervalo_registros registros ou intervalo_segundos segundos,
+    e mantém um checkpoint com os códigos já concluídos. Se o processo for interrompido,
+    uma nova execução reabre os arquivos e consulta apenas os códigos que faltam.
+    """
+
+    def __init__(self, caminho_jsonl, caminho_checkpoint, intervalo_registros=500, intervalo_segundos=5.0,
+                 ao_sincronizar=None):
+        self.caminho_jsonl = caminho_jsonl
+        self.caminho_checkpoint = caminho_checkpoint
+        self.intervalo_registros = intervalo_registros
+        self.intervalo_segundos = intervalo_segundos
+        self.ao_sincronizar = ao_sincronizar
+        for caminho in (caminho_jsonl, caminho_checkpoint):
+            descartar_linha_incompleta(caminho)
+        self._jsonl = open(caminho_jsonl, 'a', encoding='utf-8')
+        self._checkpoint = open(caminho_checkpoint, 'a', encoding='utf-8')
+        self._nao_sincronizados = 0
+        self._ultima_sincronizacao = time.monotonic()
+
+    def gravar(self, codigo_cnes, registro=None):
+        """
+        Marca o código como concluído e, se informado, acrescenta o registro ao JSONL
+        """
+        if registro is not None:
+            self._jsonl.write(json.dumps(registro, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._checkpoint.write(f'{codigo_cnes}\n')
+        self._nao_sincronizados += 1
+        if (self._nao_sincronizados >= self.intervalo_registros
+                or time.monotonic() - self._ultima_sincronizacao >= self.intervalo_segundos):
+            self.sincronizar()
+
+    def sincronizar(self):
+        # O JSONL vai para o disco antes do checkpoint: um código no checkpoint sempre tem seu registro gravado
+        for arquivo in (self._jsonl, self._checkpoint):
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        if self.ao_sincronizar:
+            self.ao_sincronizar()
+        self._nao_sincronizados = 0
+        self._ultima_sincronizacao = time.monotonic()
+
+    def fechar(self):
+        self.sincronizar()
+        self._jsonl.close()
+        self._checkpoint.close()
+
+def descartar_linha_incompleta(caminho):
+    """
+    Remove do fim do arquivo uma linha gravada pela metade (processo interrompido no meio da escrita)
+    """
+    if not os.path.exists(caminho):
+        return
+    with open(caminho, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        tamanho = f.tell()
+        if tamanho == 0:
+            return
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b'\n':
+            return
+        # Procura o último '\n' em blocos, do fim para o começo
+        posicao = tamanho
+        while posicao > 0:
+            inicio = max(0, posicao - 65536)
+            f.seek(inicio)
+            bloco = f.read(posicao - inicio)
+            indice = bloco.rfind(b'\n')
+            if indice >= 0:
+                f.truncate(inicio + indice + 1)
+                return
+            posicao = inicio
+        f.truncate(0)
+
+def ler_checkpoint(caminho_checkpoint):
+    """
+    Retorna o conjunto de códigos já concluídos em uma execução anterior interrompida
+    """
+    if not os.path.exists(caminho_checkpoint):
+        return set()
+    with open(caminho_checkpoint, 'r', encoding='utf-8') as f:
+        return {linha.strip() for linha in f if linha.endswith('\n') and linha.strip()}
+
+def ler_resultados_jsonl(caminho_jsonl):
+    """
+    Lê o arquivo JSON Lines de resultados como um fluxo, um registro por vez.
+    Ignora linhas incompletas e registros repetidos do mesmo codigo_cnes.
+    """
+    vistos = set()
+    with open(caminho_jsonl, 'r', encoding='utf-8') as f:
+        for linha in f:
+            try:
+                registro = json.loads(linha)
+            except json.JSONDecodeError:
+                continue
+            codigo = registro.get('codigo_cnes')
+            if codigo in vistos:
+                continue
+            vistos.add(codigo)
+            yield registro
+
+def consultar_lista_cnes_api(lista_codigos, pasta_downloads=None, max_workers=20, caminho_csv=None,
+                             modo='async', max_concorrencia=MAX_CONCORRENCIA, url_base=URL_API_CNES,
+                             incremental=True, amostra=None, usar_cache=True, ao_registro=None, ao_consultado=None,
+                             uf=UF_PADRAO, listagem=USAR_LISTAGEM, tamanho_pagina=TAMANHO_PAGINA,
+                             orcamento_hedge=ORCAMENTO_HEDGE, max_retries=TENTATIVAS_PASSAGEM_PRINCIPAL,
+                             tentativas_repescagem=TENTATIVAS_REPESCAGEM,
+                             concorrencia_repescagem=CONCORRENCIA_REPESCAGEM):
     """
     Recebe uma lista de códigos CNES, consulta a API pública para cada um deles em paralelo
-    e salva todos os resultados em um único arquivo JSON na pasta downloads, como uma lista de objetos.
+    e grava os resultados, à medida que chegam, em cnes_resultados.jsonl na pasta de trabalho
+    pasta_downloads (padrão: a da UF, ver pasta_uf), um objeto JSON por linha, com checkpoint dos códigos concluídos em
+    cnes_resultados.checkpoint. Se uma execução anterior foi interrompida, apenas os
+    códigos que faltam são consultados.
+    No modo 'async' (padrão) usa asyncio com conexões keep-alive reaproveitadas e até
+    max_concorrencia requisições simultâneas; no modo 'threads' usa max_workers threads.
+    Com incremental=True só consulta os códigos novos ou alterados no dump, mais uma amostra
+    rotativa dos demais (ver EstadoIncrementalCnes), e só grava no JSONL os registros cujo
+    conteúdo mudou desde a última carga confirmada.
+    Com usar_cache=True as respostas são lidas/gravadas no cache em disco (CacheApiCnes),
+    o que torna quase instantâneas as reexecuções no mesmo dia.
+    Se ao_registro for informado, cada registro alterado é entregue a ao_registro(registro)
+    em vez de ir para o JSONL (sem checkpoint), para uso em memória pelo PipelineCnes.
+    ao_registro pode bloquear (fila cheia de quem consome): no modo 'async' ela roda em
+    uma thread de entrega, e só o trabalhador que entregou espera, não o loop de eventos.
+    Se ao_consultado for informado, recebe todo registro obtido da API, alterado ou não
+    (ex.: o coletor do snapshot, que precisa da UF inteira).
+    Com listagem=True, os estabelecimentos da UF vêm antes da listagem paginada
+    (consultar_listagem_async, tamanho_pagina por requisição) e só os códigos que faltarem
+    nela são consultados um a um. A listagem só é usada se os códigos a consultar forem
+    mais numerosos que as páginas estimadas para a UF.
+    No modo 'async', orcamento_hedge > 0 liga as requisições duplicadas para as tentativas
+    mais lentas que o p95 (ver ControleHedge), e o resumo inclui os percentis de latência.
+    Cada código é tentado max_retries vezes na passagem principal; os que falharam por erro
+    transitório são repetidos no fim, na repescagem (concorrencia_repescagem requisições
+    simultâneas, até tentativas_repescagem tentativas; 0 desliga). As falhas que sobrarem
+    ficam na fila de falhas da UF, e os códigos da fila que estiverem em lista_codigos
+    são consultados de novo na execução seguinte; as definitivas (404 e outros 4xx, ver
+    falha_definitiva) não entram na fila.
     Imprime no console o total de requisições, quantas deram certo e quantas deram erro.
-    Se todas as requisições foram processadas (sucesso + erro == total), exclui o arquivo CSV inicial.
-    Não retorna nada.
+    Se nenhuma consulta ficou com erro, exclui o arquivo CSV inicial.
+    Retorna um dicionário com total, sucesso, erro, alterados, repescados e recuperados.
     """
+    if pasta_downloads is None:
+        pasta_downloads = pasta_uf(uf)
     os.makedirs(pasta_downloads, exist_ok=True)
-    resultados = []
+    arquivo_jsonl = os.path.join(pasta_downloads, 'cnes_resultados.jsonl')
+    arquivo_checkpoint = os.path.join(pasta_downloads, 'cnes_resultados.checkpoint')
+    from EstadoIncrementalCnes import (
+        AMOSTRA_NAO_ALTERADOS, conectar_estado, selecionar_codigos_para_consulta, registrar_consulta,
+        listar_falhas, registrar_falhas, remover_falhas
+    )
+    conn_estado = None
+    total_codigos = len(lista_codigos)
+    # Falhas de execuções anteriores, só as dos códigos desta busca (um shard não pega as dos outros)
+    conn_falhas = conectar_estado(pasta_downloads)
+    codigos_entrada = {str(codigo) for codigo in lista_codigos}
+    falhas_anteriores = {codigo: falha for codigo, falha in listar_falhas(conn_falhas).items()
+                         if codigo in codigos_entrada}
+    if incremental:
+        conn_estado = conn_falhas
+        lista_codigos, alterados = selecionar_codigos_para_consulta(
+            conn_estado, lista_codigos, AMOSTRA_NAO_ALTERADOS if amostra is None else amostra)
+        print(f'Busca incremental: {alterados} códigos novos/alterados e '
+              f'{len(lista_codigos) - alterados} da amostra de não alterados, de {total_codigos} no total')
+        selecionados = set(lista_codigos)
+        lista_codigos.extend(codigo for codigo in falhas_anteriores if codigo not in selecionados)
+    if falhas_anteriores:
+        print(f'Fila de falhas: {len(falhas_anteriores)} códigos que falharam em execuções anteriores '
+              f'serão consultados de novo')
+
+    # Retoma uma execução interrompida: pula os códigos que já estão no checkpoint
+    concluidos = ler_checkpoint(arquivo_checkpoint) if ao_registro is None else set()
+    if concluidos:
+        lista_codigos = [codigo for codigo in lista_codigos if str(codigo) not in concluidos]
+        print(f'Retomando execução anterior: {len(concluidos)} códigos já concluídos, {len(lista_codigos)} restantes')
+
     total = len(lista_codigos)
-    sucesso = 0
-    erro = 0
-    max_retries = 3  # Número de tentativas para cada requisição
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_codigo = {executor.submit(requisicao_cnes, codigo, max_retries): codigo for codigo in lista_codigos}
-        for future in as_completed(future_to_codigo):
-            resultado = future.result()
-            if resultado:
-                resultados.append(resultado)
-                sucesso += 1
+    contagem = {'sucesso': 0, 'alterados': 0, 'paginas_listagem': 0}
+    commit_estado = {'pendentes': 0, 'ultimo': time.monotonic()}
+    falhas = {}
+    recuperados_da_fila = []
+    cache = CacheRespostasCnes() if usar_cache else None
+    hedge = ControleHedge(orcamento_hedge)
+    gravador = None
+    if ao_registro is None:
+        gravador = GravadorResultados(arquivo_jsonl, arquivo_checkpoint,
+                                      ao_sincronizar=conn_estado.commit if conn_estado else None)
+
+    # Uma thread só, para os registros chegarem a ao_registro um de cada vez
+    entrega = ThreadPoolExecutor(max_workers=1, thread_name_prefix='entrega-cnes') if ao_registro else None
+
+    def entregar(resultado):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            ao_registro(resultado)
+            return None
+        # Dentro do loop de eventos: quem chamou aguarda a entrega sem bloquear as outras requisições
+        return loop.run_in_executor(entrega, ao_registro, resultado)
+
+    def ao_concluir(codigo, resultado):
+        if not resultado:
+            return None
+        contagem['sucesso'] += 1
+        if str(codigo) in falhas_anteriores:
+            recuperados_da_fila.append(codigo)
+        alterado = conn_estado is None or registrar_consulta(conn_estado, resultado['codigo_cnes'], resultado)
+        if alterado:
+            contagem['alterados'] += 1
+        if ao_consultado is not None:
+            ao_consultado(resultado)
+        if gravador is not None:
+            gravador.gravar(codigo, resultado if alterado else None)
+            return None
+        entrega_pendente = entregar(resultado) if alterado else None
+        # Sem o gravador, o estado é gravado a cada INTERVALO_COMMIT_ESTADO consultas ou
+        # INTERVALO_COMMIT_ESTADO_SEGUNDOS: a transação aberta segura a escrita no banco, e
+        # outros processos (shards) que usam o mesmo banco ficam esperando
+        if conn_estado is not None:
+            commit_estado['pendentes'] += 1
+            if (commit_estado['pendentes'] >= INTERVALO_COMMIT_ESTADO
+                    or time.monotonic() - commit_estado['ultimo'] >= INTERVALO_COMMIT_ESTADO_SEGUNDOS):
+                conn_estado.commit()
+                commit_estado['pendentes'] = 0
+                commit_estado['ultimo'] = time.monotonic()
+        return entrega_pendente
+
+    try:
+        # A listagem traz tamanho_pagina estabelecimentos por requisição, mas percorre a UF
+        # inteira (cerca de total_codigos / tamanho_pagina páginas): só compensa quando a
+        # busca é maior que isso (carga inicial, recarga, muitos códigos alterados)
+        if listagem and lista_codigos and len(lista_codigos) > total_codigos / tamanho_pagina:
+            pendentes = {int(codigo): codigo for codigo in lista_codigos}
+
+            def ao_estabelecimento(registro):
+                codigo = pendentes.pop(int(registro['codigo_cnes']), None)
+                if codigo is None:
+                    return  # Fora da lista a consultar (ou já recebido)
+                if cache:
+                    cache.gravar(codigo, registro)
+                return ao_concluir(codigo, registro)
+
+            resumo_listagem = asyncio.run(consultar_listagem_async(uf, ao_estabelecimento, tamanho_pagina,
+                                                                   max_concorrencia, TENTATIVAS_PAGINA, url_base))
+            contagem['paginas_listagem'] = resumo_listagem['paginas']
+            lista_codigos = list(pendentes.values())
+            print(f'Listagem: {total - len(lista_codigos)} códigos obtidos, '
+                  f'{len(lista_codigos)} serão consultados individualmente')
+
+        if modo == 'threads':
+            consultar_cnes_threads(lista_codigos, max_workers, max_retries, url_base, cache=cache,
+                                   ao_concluir=ao_concluir, falhas=falhas)
+        else:
+            asyncio.run(consultar_cnes_async(lista_codigos, max_concorrencia, max_retries, url_base,
+                                             cache=cache, ao_concluir=ao_concluir, hedge=hedge, falhas=falhas))
+
+        # Repescagem: só erros transitórios; 404 e outros 4xx dariam o mesmo resultado agora
+        repescaveis = [codigo for codigo, falha in falhas.items()
+                       if falha['status'] is None or falha['status'] in STATUS_REPETIR]
+        contagem['repescados'] = len(repescaveis) if tentativas_repescagem > 0 else 0
+        if contagem['repescados']:
+            print(f'🔁 Repescagem: {len(repescaveis)} códigos com falha transitória, '
+                  f'{concorrencia_repescagem} por vez, até {tentativas_repescagem} tentativas')
+            falhas_principal = {codigo: falhas.pop(codigo) for codigo in repescaveis}
+            sucesso_antes = contagem['sucesso']
+            if modo == 'threads':
+                consultar_cnes_threads(repescaveis, concorrencia_repescagem, tentativas_repescagem, url_base,
+                                       cache=cache, ao_concluir=ao_concluir, falhas=falhas)
             else:
-                erro += 1
-    arquivo_json = os.path.join(pasta_downloads, 'cnes_resultados.json')
-    with open(arquivo_json, 'w', encoding='utf-8') as f:
-        json.dump(resultados, f, ensure_ascii=False, indent=2)
-    print(f'Resultados salvos em: {arquivo_json}')
+                controle_repescagem = ControleConcorrencia(inicial=concorrencia_repescagem,
+                                                           maximo=concorrencia_repescagem)
+                asyncio.run(consultar_cnes_async(repescaveis, concorrencia_repescagem, tentativas_repescagem,
+                                                 url_base, controle=controle_repescagem, cache=cache,
+                                                 ao_concluir=ao_concluir, falhas=falhas))
+            for codigo, falha in falhas_principal.items():
+                if codigo in falhas:
+                    falhas[codigo]['tentativas'] += falha['tentativas']
+            contagem['recuperados'] = contagem['sucesso'] - sucesso_antes
+            print(f"🔁 Repescagem: {contagem['recuperados']} de {len(repescaveis)} recuperados")
+
+        # As falhas transitórias que sobraram vão para a fila; as que deram certo saem dela,
+        # e as definitivas (404 etc.) também: consultá-las de novo daria o mesmo resultado
+        definitivas = [codigo for codigo, falha in falhas.items() if falha_definitiva(falha)]
+        for codigo in definitivas:
+            del falhas[codigo]
+        registrar_falhas(conn_falhas, falhas)
+        remover_falhas(conn_falhas, recuperados_da_fila + definitivas)
+    finally:
+        if entrega is not None:
+            entrega.shutdown()
+        if gravador is not None:
+            gravador.fechar()
+        conn_falhas.commit()
+        conn_falhas.close()
+        if cache:
+            cache.fechar()
+    sucesso = contagem['sucesso']
+    erro = total - sucesso
+    if gravador is not None:
+        print(f'Resultados salvos em: {arquivo_jsonl}')
+    if conn_estado is not None:
+        print(f'Registros com conteúdo alterado: {contagem["alterados"]}')
+    if contagem['paginas_listagem']:
+        print(f'Páginas da listagem: {contagem["paginas_listagem"]}')
     print(f'Total de requisições: {total}')
     print(f'Requisições bem-sucedidas: {sucesso}')
     print(f'Requisições com erro: {erro}')
+    if falhas:
+        print(f'Fila de falhas: {len(falhas)} códigos ficam para a próxima execução')
+    if definitivas:
+        print(f'Falhas definitivas (404 e outros 4xx): {len(definitivas)} códigos, fora da fila de falhas')
+    metricas.contar('fila_falhas', len(falhas), resultado='pendente')
+    metricas.contar('fila_falhas', len(definitivas), resultado='definitiva')
+    metricas.contar('fila_falhas', len(recuperados_da_fila), resultado='recuperada')
+    resumo_hedge = hedge.resumo()
+    if resumo_hedge['latencia_ms']:
+        print(f"Latência das requisições (ms): {resumo_hedge['latencia_ms']}")
+    if cache:
+        print(cache.resumo())
+        for resultado, quantidade in (('acerto', cache.acertos), ('revalidado', cache.revalidados),
+                                      ('falha', cache.falhas)):
+            metricas.contar('cache_api', quantidade, resultado=resultado)
     
-    # Exclui o arquivo CSV inicial se todas as requisições foram processadas
-    if caminho_csv and (sucesso + erro == total):
+    # Exclui o arquivo CSV inicial só se nenhuma consulta ficou com erro
+    if caminho_csv and erro == 0:
         try:
             os.remove(caminho_csv)
         except Exception as e:
             print(f'Erro ao remover o arquivo CSV: {e}')
+    return {'total': total, 'sucesso': sucesso, 'erro': erro, 'alterados': contagem['alterados'],
+            'paginas_listagem': contagem['paginas_listagem'], 'latencia_ms': resumo_hedge['latencia_ms'],
+            'hedge_duplicadas': resumo_hedge['duplicadas'], 'repescados': contagem.get('repescados', 0),
+            'recuperados': contagem.get('recuperados', 0), 'falhas_pendentes': len(falhas),
+            'falhas_definitivas': len(definitivas)}
 
 def main():
-    # Define o caminho do arquivo CSV
-    caminho_csv = os.path.join('downloads', 'cnes_ro.csv')
+    for uf in UFS:
+        # Define o caminho do arquivo CSV da UF
+        caminho_csv = caminho_codigos_uf(uf)
 
-    # Lê os códigos CNES
-    cnes_codigos = ler_codigos_cnes(caminho_csv)
+        # Lê os códigos CNES
+        cnes_codigos = ler_codigos_cnes(caminho_csv)
 
-    # Consultar o CNES da lista e salvar todos os resultados em um único arquivo JSON
-    consultar_lista_cnes_api(cnes_codigos, caminho_csv=caminho_csv)
+        # Consultar o CNES da lista e gravar os resultados em JSON Lines na pasta da UF
+        consultar_lista_cnes_api(cnes_codigos, caminho_csv=caminho_csv, uf=uf)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from EstabelecimentosCsvDownload import download_dir
+
+# Pasta do cache de respostas da API (índice SQLite + objetos JSON endereçados pelo conteúdo)
+PASTA_CACHE = os.path.join(download_dir, 'cache_api')
+
+# Validade de cada entrada (segundos) e tamanho máximo do cache em disco (bytes)
+CACHE_TTL = int(os.environ.get('CNES_CACHE_TTL', str(12 * 60 * 60)))
+CACHE_TAMANHO_MAXIMO = int(os.environ.get('CNES_CACHE_TAMANHO_MAXIMO', str(200 * 1024 * 1024)))
+
+# O tamanho do cache é mantido em memória a cada gravação e remoção, sem somar o índice
+# inteiro; a soma exata é refeita a cada INTERVALO_RECONTAGEM gravações (outros processos,
+# como os shards, gravam no mesmo cache) e antes de remover entradas. Ao passar do limite,
+# remove até FRACAO_APOS_LIMPEZA do limite, para a limpeza não se repetir a cada gravação
+INTERVALO_RECONTAGEM = 10000
+FRACAO_APOS_LIMPEZA = 0.9
+
+# Os acertos não gravam o último acesso na hora (a busca assíncrona consulta o cache dentro
+# do loop de eventos): os acessos são acumulados e gravados juntos a cada INTERVALO_ACESSOS,
+# na próxima gravação ou renovação e ao fechar o cache
+INTERVALO_ACESSOS = 500
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS entradas (
+    codigo_cnes TEXT PRIMARY KEY,
+    hash_conteudo TEXT NOT NULL,
+    tamanho INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    gravado_em REAL NOT NULL,
+    ultimo_acesso REAL NOT NULL
+)
+"""
+
+
+def cabecalhos_condicionais(entrada):
+    """
+    Cabeçalhos If-None-Match / If-Modified-Since para revalidar uma entrada vencida
+    """
+    headers = {}
+    if entrada:
+        if entrada['etag']:
+            headers['If-None-Match'] = entrada['etag']
+        if entrada['last_modified']:
+            headers['If-Modified-Since'] = entrada['last_modified']
+    return headers
+
+
+class CacheRespostasCnes:
+    """
+    Cache em disco das respostas de /cnes/estabelecimentos/{codigo}.
+    O índice (SQLite) liga cada código ao hash do seu conteúdo; o conteúdo fica em
+    objetos/<hash[:2]>/<hash>.json, compartilhado entre códigos com a mesma resposta.
+    Entradas valem por 'ttl' segundos; acima de 'tamanho_maximo' bytes as menos
+    usadas recentemente são removidas. Pode ser usado por várias threads.
+    Contadores: acertos (entrada válida), falhas (consulta sem entrada ou com entrada
+    vencida), revalidados (entrada vencida confirmada pelo servidor com 304).
+    """
+
+    def __init__(self, pasta=PASTA_CACHE, ttl=CACHE_TTL, tamanho_maximo=CACHE_TAMANHO_MAXIMO):
+        self.pasta = pasta
+        self.ttl = ttl
+        self.tamanho_maximo = tamanho_maximo
+        self.acertos = 0
+        self.revalidados = 0
+        self.falhas = 0
+        self.removidos = 0
+        os.makedirs(os.path.join(pasta, 'objetos'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(pasta, 'indice.sqlite3'), timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(ESQUEMA)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_entradas_acesso ON entradas (ultimo_acesso)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_entradas_hash ON entradas (hash_conteudo)')
+        self._tamanho = self._tamanho_total()
+        self._gravacoes = 0
+        self._acessos = []
+
+    def _caminho_objeto(self, hash_conteudo):
+        return os.path.join(self.pasta, 'objetos', hash_conteudo[:2], f'{hash_conteudo}.json')
+
+    def obter(self, codigo_cnes):
+        """
+        Retorna {'dados', 'etag', 'last_modified', 'fresco'} ou None se o código não estiver no cache
+        """
+        with self._lock:
+            linha = self._conn.execute(
+                'SELECT hash_conteudo, etag, last_modified, gravado_em FROM entradas WHERE codigo_cnes = ?',
+                (str(codigo_cnes),),
+            ).fetchone()
+            if linha is None:
+                self.falhas += 1
+                return None
+            hash_conteudo, etag, last_modified, gravado_em = linha
+            try:
+                with open(self._caminho_objeto(hash_conteudo), 'r', encoding='utf-8') as f:
+                    dados = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.falhas += 1
+                self._conn.execute('DELETE FROM entradas WHERE codigo_cnes = ?', (str(codigo_cnes),))
+                self._conn.commit()
+                return None
+            agora = time.time()
+            fresco = agora - gravado_em < self.ttl
+            if fresco:
+                self.acertos += 1
+                self._acessos.append((agora, str(codigo_cnes)))
+                if len(self._acessos) >= INTERVALO_ACESSOS:
+                    self._gravar_acessos()
+                    self._conn.commit()
+            else:
+                self.falhas += 1
+        return {'dados': dados, 'etag': etag, 'last_modified': last_modified, 'fresco': fresco}
+
+    def renovar(self, codigo_cnes):
+        """
+        Marca uma entrada vencida como válida novamente (servidor respondeu 304)
+        """
+        with self._lock:
+            agora = time.time()
+            self.revalidados += 1
+            self._gravar_acessos()
+            self._conn.execute('UPDATE entradas SET gravado_em = ?, ultimo_acesso = ? WHERE codigo_cnes = ?',
+                               (agora, agora, str(codigo_cnes)))
+            self._conn.commit()
+
+    def gravar(self, codigo_cnes, dados, etag=None, last_modified=None):
+        """
+        Grava a resposta recebida da API e remove as entradas mais antigas se o cache passar do limite
+        """
+        conteudo = json.dumps(dados, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        hash_conteudo = hashlib.sha256(conteudo).hexdigest()
+        caminho = self._caminho_objeto(hash_conteudo)
+        if not os.path.exists(caminho):
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            temporario = f'{caminho}.{threading.get_ident()}.tmp'
+            with open(temporario, 'wb') as f:
+                f.write(conteudo)
+            os.replace(temporario, caminho)
+
+        with self._lock:
+            agora = time.time()
+            self._gravacoes += 1
+            # A ordem de uso das entradas precisa estar em dia antes de uma eventual limpeza
+            self._gravar_acessos()
+            anterior = self._conn.execute('SELECT hash_conteudo, tamanho FROM entradas WHERE codigo_cnes = ?',
+                                          (str(codigo_cnes),)).fetchone()
+            objeto_novo = not self._conn.execute('SELECT 1 FROM entradas WHERE hash_conteudo = ? LIMIT 1',
+                                                 (hash_conteudo,)).fetchone()
+            self._conn.execute(
+                """INSERT OR REPLACE INTO entradas
+                   (codigo_cnes, hash_conteudo, tamanho, etag, last_modified, gravado_em, ultimo_acesso)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (str(codigo_cnes), hash_conteudo, len(conteudo), etag, last_modified, agora, agora),
+            )
+            if objeto_novo:
+                self._tamanho += len(conteudo)
+            if anterior and anterior[0] != hash_conteudo:
+                self._remover_objeto_sem_referencia(*anterior)
+            self._aplicar_limite()
+            self._conn.commit()
+
+    def _gravar_acessos(self):
+        if self._acessos:
+            self._conn.executemany('UPDATE entradas SET ultimo_acesso = ? WHERE codigo_cnes = ?', self._acessos)
+            self._acessos = []
+
+    def _remover_objeto_sem_referencia(self, hash_conteudo, tamanho):
+        em_uso = self._conn.execute('SELECT 1 FROM entradas WHERE hash_conteudo = ? LIMIT 1',
+                                    (hash_conteudo,)).fetchone()
+        if not em_uso:
+            self._tamanho -= tamanho
+            try:
+                os.remove(self._caminho_objeto(hash_conteudo))
+            except FileNotFoundError:
+                pass
+
+    def _tamanho_total(self):
+        return self._conn.execute(
+            'SELECT COALESCE(SUM(tamanho), 0) FROM (SELECT DISTINCT hash_conteudo, tamanho FROM entradas)'
+        ).fetchone()[0]
+
+    def _aplicar_limite(self):
+        if self._tamanho <= self.tamanho_maximo and self._gravacoes % INTERVALO_RECONTAGEM:
+            return
+        self._tamanho = self._tamanho_total()
+        if self._tamanho <= self.tamanho_maximo:
+            return
+        # Remove as entradas menos usadas recentemente, em grupos, até ficar abaixo do alvo
+        alvo = self.tamanho_maximo * FRACAO_APOS_LIMPEZA
+        while self._tamanho > alvo:
+            linhas = self._conn.execute(
+                'SELECT codigo_cnes, hash_conteudo, tamanho FROM entradas ORDER BY ultimo_acesso LIMIT 500').fetchall()
+            if not linhas:
+                break
+            for codigo, hash_conteudo, tamanho in linhas:
+                self._conn.execute('DELETE FROM entradas WHERE codigo_cnes = ?', (codigo,))
+                self._remover_objeto_sem_referencia(hash_conteudo, tamanho)
+                self.removidos += 1
+                if self._tamanho <= alvo:
+                    break
+
+    def resumo(self):
+        return (f'Cache: {self.acertos} acertos, {self.falhas} falhas (sem entrada ou vencida), '
+                f'{self.revalidados} revalidados (304), {self.removidos} entradas removidas por tamanho')
+
+    def fechar(self):
+        with self._lock:
+            self._gravar_acessos()
+            self._conn.commit()
+            self._conn.close()
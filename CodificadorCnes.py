@@ -0,0 +1,374 @@
+import functools
+import io
+import operator
+import threading
+
+from GerarScriptSQLCnes import CAMPOS
+from MetricasCnes import metricas
+
+# Codificador dos registros da API para a carga no banco: montado uma vez a partir da
+# lista de campos e do tipo de cada um, converte um bloco de registros de uma vez em
+# colunas Arrow tipadas (com coerção e validação vetorizadas) e delas gera as linhas do
+# COPY (CSV) ou as linhas de VALUES dos UPSERTs, no lugar de formatar cada valor em Python.
+# Registros com valor inválido são rejeitados antes de chegar ao banco e os seus códigos
+# ficam em rejeicoes, de onde o pipeline os leva para a fila de falhas da UF. Sem pyarrow, a
+# carga volta à formatação valor a valor de GerarScriptSQLCnes, sem validação.
+
+# Tipo de cada campo de CAMPOS (alias do Arrow); os que não estão aqui são texto
+TIPOS_CAMPOS = {
+    'codigo_cnes': 'int64',
+    'codigo_tipo_unidade': 'int64',
+    'latitude_estabelecimento_decimo_grau': 'float64',
+    'longitude_estabelecimento_decimo_grau': 'float64',
+    'codigo_uf': 'int64',
+    'codigo_municipio': 'int64',
+    'estabelecimento_possui_centro_cirurgico': 'int8',
+    'estabelecimento_possui_centro_obstetrico': 'int8',
+    'estabelecimento_possui_centro_neonatal': 'int8',
+    'estabelecimento_possui_atendimento_hospitalar': 'int8',
+    'estabelecimento_possui_servico_apoio': 'int8',
+    'estabelecimento_possui_atendimento_ambulatorial': 'int8',
+}
+
+# Campos que não podem ser nulos (chave primária de unidade_saude)
+CAMPOS_OBRIGATORIOS = ('codigo_cnes', 'codigo_uf')
+
+# Faixa válida (inclusive) dos campos numéricos
+FAIXAS_CAMPOS = {
+    'latitude_estabelecimento_decimo_grau': (-90, 90),
+    'longitude_estabelecimento_decimo_grau': (-180, 180),
+    'estabelecimento_possui_centro_cirurgico': (0, 1),
+    'estabelecimento_possui_centro_obstetrico': (0, 1),
+    'estabelecimento_possui_centro_neonatal': (0, 1),
+    'estabelecimento_possui_atendimento_hospitalar': (0, 1),
+    'estabelecimento_possui_servico_apoio': (0, 1),
+    'estabelecimento_possui_atendimento_ambulatorial': (0, 1),
+}
+
+# Coerção de campos de texto antes da validação: (expressão regular, substituição)
+COERCOES_CAMPOS = {
+    # CEP só com os dígitos (76.800-000 -> 76800000)
+    'codigo_cep_estabelecimento': (r'\D', ''),
+    # Data no formato brasileiro para ISO (05/01/2024 -> 2024-01-05)
+    'data_atualizacao': (r'^(\d{2})/(\d{2})/(\d{4})', r'\3-\2-\1'),
+}
+
+# Formato dos campos de texto preenchidos, depois da coerção
+FORMATOS_CAMPOS = {
+    'codigo_cep_estabelecimento': r'^\d{8}$',
+}
+
+# Campos de data: os 10 primeiros caracteres precisam ser uma data AAAA-MM-DD válida
+CAMPOS_DATA = ('data_atualizacao',)
+
+# Texto aceito para cada tipo numérico quando o valor não vem no tipo (ex.: "36", "-8,76")
+PADRAO_INTEIRO = r'^[+-]?\d{1,18}$'
+PADRAO_DECIMAL = r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$'
+
+# Registros convertidos de uma vez pelo codificador na carga via COPY
+REGISTROS_POR_BLOCO = 5000
+
+# Rejeições listadas uma a uma na saída por bloco; as demais só são contadas
+REJEICOES_LISTADAS = 10
+
+
+def esquema_campos(campos=CAMPOS):
+    import pyarrow as pa
+
+    return pa.schema([pa.field(campo, pa.type_for_alias(TIPOS_CAMPOS.get(campo, 'string'))) for campo in campos])
+
+
+def _nulo_se(mascara, valores):
+    import pyarrow.compute as pc
+
+    return pc.if_else(pc.fill_null(mascara, False), None, valores)
+
+
+class CodificadorRegistros:
+    """
+    Codificador para uma lista de campos (ver obter_codificador). tabela(registros)
+    devolve a tabela Arrow tipada dos registros válidos e a lista de rejeitados
+    (codigo_cnes, campo, valor); linhas_copy e valores_sql partem dela.
+    """
+
+    def __init__(self, campos=CAMPOS):
+        import pyarrow as pa
+
+        self.campos = list(campos)
+        self.esquema = esquema_campos(self.campos)
+        self._struct = pa.struct(list(self.esquema))
+        self._extrair = operator.itemgetter(*self.campos)
+        self._coercoes = [(campo, COERCOES_CAMPOS[campo]) for campo in self.campos if campo in COERCOES_CAMPOS]
+        # Cada validação é (campo, função que devolve a máscara dos valores inválidos)
+        self._validacoes = []
+        for campo in self.campos:
+            if campo in CAMPOS_OBRIGATORIOS:
+                self._validacoes.append((campo, self._ausentes))
+            if campo in FAIXAS_CAMPOS:
+                self._validacoes.append((campo, functools.partial(self._fora_da_faixa, *FAIXAS_CAMPOS[campo])))
+            if campo in FORMATOS_CAMPOS:
+                self._validacoes.append((campo, functools.partial(self._fora_do_formato, FORMATOS_CAMPOS[campo])))
+            if campo in CAMPOS_DATA:
+                self._validacoes.append((campo, self._datas_invalidas))
+
+    def _colunas(self, registros):
+        """
+        Valores de cada campo dos registros. Caminho rápido com itemgetter; se algum
+        registro não tem um dos campos, ele vale None, como em formatar_linha_copy.
+        """
+        try:
+            linhas = list(map(self._extrair, registros))
+        except KeyError:
+            linhas = [tuple(registro.get(campo) for campo in self.campos) for registro in registros]
+        if len(self.campos) == 1:
+            # itemgetter de um só campo devolve o valor, não uma tupla
+            return [linhas]
+        return list(zip(*linhas)) if linhas else [() for _ in self.campos]
+
+    def _converter(self, valores, campo, tipo):
+        """
+        Converte os valores de um campo no seu tipo e devolve (array, máscara dos
+        inválidos ou None). Valores fora do tipo passam por texto e são convertidos
+        em operações vetorizadas; os que nem assim servem ficam nulos na máscara.
+        """
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        try:
+            return pa.array(valores, type=tipo), None
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            pass
+        textos = pa.array([None if valor is None else str(valor) for valor in valores], type=pa.string())
+        if pa.types.is_string(tipo):
+            return textos, None
+
+        textos = pc.utf8_trim_whitespace(textos)
+        # Texto vazio em campo numérico é nulo
+        textos = _nulo_se(pc.equal(textos, ''), textos)
+        if pa.types.is_floating(tipo):
+            textos = pc.replace_substring(textos, ',', '.')
+            padrao = PADRAO_DECIMAL
+        else:
+            # Booleanos e números inteiros escritos como decimais (36.0) também são aceitos
+            textos = pc.replace_substring_regex(pc.replace_substring_regex(textos, '^True$', '1'), '^False$', '0')
+            textos = pc.replace_substring_regex(textos, r'^([+-]?\d+)\.0*$', r'\1')
+            padrao = PADRAO_INTEIRO
+        aceitos = pc.fill_null(pc.match_substring_regex(textos, padrao), False)
+        invalidos = pc.and_(pc.is_valid(textos), pc.invert(aceitos))
+        convertidos = pc.cast(_nulo_se(invalidos, textos), pa.float64() if pa.types.is_floating(tipo) else pa.int64())
+        if convertidos.type != tipo:
+            # Inteiros menores (int8): o que não cabe no tipo também é inválido
+            informacoes = np.iinfo(tipo.to_pandas_dtype())
+            fora = pc.or_(pc.less(convertidos, informacoes.min), pc.greater(convertidos, informacoes.max))
+            invalidos = pc.or_(invalidos, pc.fill_null(fora, False))
+            convertidos = pc.cast(_nulo_se(fora, convertidos), tipo)
+        return convertidos, invalidos
+
+    @staticmethod
+    def _ausentes(coluna):
+        import pyarrow.compute as pc
+
+        return pc.is_null(coluna)
+
+    @staticmethod
+    def _fora_da_faixa(minimo, maximo, coluna):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        fora = pc.or_(pc.less(coluna, minimo), pc.greater(coluna, maximo))
+        if pa.types.is_floating(coluna.type):
+            fora = pc.or_(fora, pc.invert(pc.is_finite(coluna)))
+        return pc.fill_null(fora, False)
+
+    @staticmethod
+    def _fora_do_formato(padrao, coluna):
+        import pyarrow.compute as pc
+
+        preenchidos = pc.fill_null(pc.not_equal(coluna, ''), False)
+        return pc.and_(preenchidos, pc.invert(pc.fill_null(pc.match_substring_regex(coluna, padrao), False)))
+
+    @staticmethod
+    def _datas_invalidas(coluna):
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        inicio = pc.utf8_slice_codeunits(coluna, 0, 10)
+        preenchidos = pc.fill_null(pc.not_equal(coluna, ''), False)
+        try:
+            # Caminho rápido: o cast para data é estrito, mas falha no bloco inteiro
+            pc.cast(inicio.filter(preenchidos), pa.date32())
+            return pa.array(np.zeros(len(coluna), dtype=bool))
+        except pa.ArrowInvalid:
+            pass
+        # strptime aceita 2024-02-30 (vira 2024-03-01): a data formatada de volta precisa ser a mesma
+        datas = pc.strptime(inicio, format='%Y-%m-%d', unit='s', error_is_null=True)
+        validas = pc.fill_null(pc.equal(pc.strftime(datas, format='%Y-%m-%d'), inicio), False)
+        return pc.and_(preenchidos, pc.invert(validas))
+
+    def tabela(self, registros):
+        """
+        Converte os registros (lista de dicionários) em uma tabela Arrow com o tipo de
+        cada campo, só com os registros válidos. Retorna (tabela, rejeitados), com
+        rejeitados como [(codigo_cnes, campo, valor)], um por registro rejeitado.
+        """
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        if not isinstance(registros, list):
+            registros = list(registros)
+        invalidos = {}
+        try:
+            # Caminho rápido: os dicionários viram uma coluna de structs em uma só chamada ao
+            # Arrow (campo ausente é nulo); serve quando todos os valores estão no tipo
+            tabela = pa.Table.from_struct_array(pa.array(registros, type=self._struct))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            colunas = []
+            for valores, campo in zip(self._colunas(registros), self.esquema):
+                coluna, mascara = self._converter(valores, campo.name, campo.type)
+                colunas.append(coluna)
+                if mascara is not None:
+                    invalidos[campo.name] = mascara
+            tabela = pa.Table.from_arrays(colunas, schema=self.esquema)
+        for campo, (padrao, substituicao) in self._coercoes:
+            indice = tabela.schema.get_field_index(campo)
+            tabela = tabela.set_column(indice, campo, pc.replace_substring_regex(tabela[campo], padrao, substituicao))
+        for campo, validacao in self._validacoes:
+            mascara = validacao(tabela[campo])
+            invalidos[campo] = pc.or_(invalidos[campo], mascara) if campo in invalidos else mascara
+
+        rejeitar = np.zeros(len(registros), dtype=bool)
+        por_campo = []
+        for campo, mascara in invalidos.items():
+            mascara = np.asarray(pc.fill_null(mascara, False))
+            if mascara.any():
+                por_campo.append((campo, mascara))
+                rejeitar |= mascara
+        if not rejeitar.any():
+            return tabela, []
+        # Só os registros rejeitados são percorridos em Python, para apontar o campo
+        rejeitados = []
+        for indice in np.flatnonzero(rejeitar).tolist():
+            campo = next(campo for campo, mascara in por_campo if mascara[indice])
+            registro = registros[indice]
+            rejeitados.append((registro.get('codigo_cnes'), campo, registro.get(campo)))
+        return tabela.filter(pa.array(~rejeitar)), rejeitados
+
+    def linhas_copy(self, registros):
+        """
+        Registros válidos em CSV para COPY ... WITH (FORMAT csv): nulo é o campo vazio
+        sem aspas e texto vazio é "". Retorna (bytes, quantidade de linhas, rejeitados).
+        """
+        import pyarrow.csv as pcsv
+
+        tabela, rejeitados = self.tabela(registros)
+        saida = io.BytesIO()
+        if tabela.num_rows:
+            pcsv.write_csv(tabela, saida, pcsv.WriteOptions(include_header=False, quoting_style='needed'))
+        return saida.getvalue(), tabela.num_rows, rejeitados
+
+    def valores_sql(self, registros):
+        """
+        Linhas de VALUES dos registros válidos, no formato de formatar_registro.
+        Retorna (linhas, rejeitados).
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        tabela, rejeitados = self.tabela(registros)
+        if not tabela.num_rows:
+            return [], rejeitados
+        literais = []
+        for coluna in tabela.columns:
+            if pa.types.is_string(coluna.type):
+                # Aspas simples duplicadas, como em formatar_valor
+                coluna = pc.binary_join_element_wise("'", pc.replace_substring(coluna, "'", "''"), "'", '')
+            else:
+                coluna = pc.cast(coluna, pa.string())
+            literais.append(pc.fill_null(coluna, 'NULL'))
+        linhas = pc.binary_join_element_wise('  (', pc.binary_join_element_wise(*literais, ', '), ')', '')
+        return linhas.to_pylist(), rejeitados
+
+
+@functools.lru_cache(maxsize=None)
+def _codificador(campos):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("⚠️ pyarrow não instalado: registros formatados valor a valor, sem validação")
+        return None
+    return CodificadorRegistros(campos)
+
+
+def blocos_copy(registros, campos=CAMPOS, registros_por_bloco=REGISTROS_POR_BLOCO):
+    """
+    Consome os registros como fluxo e gera o CSV do COPY de cada bloco de
+    registros_por_bloco registros (ver CodificadorRegistros.linhas_copy), informando
+    os rejeitados de cada bloco
+    """
+    import itertools
+
+    codificador = obter_codificador(campos)
+    registros = iter(registros)
+    while True:
+        bloco = list(itertools.islice(registros, registros_por_bloco))
+        if not bloco:
+            return
+        dados, _, rejeitados = codificador.linhas_copy(bloco)
+        informar_rejeitados(rejeitados)
+        yield dados
+
+
+def obter_codificador(campos=CAMPOS):
+    """
+    Codificador dos campos, montado na primeira chamada e reaproveitado nas seguintes
+    (None sem pyarrow)
+    """
+    return _codificador(tuple(campos))
+
+
+class RegistroRejeicoes:
+    """
+    Códigos dos registros rejeitados desde a última retirada, por qualquer thread de carga
+    do processo, com o campo inválido. Quem confirma o estado incremental os retira antes
+    (ver rejeitar_consultas em EstadoIncrementalCnes), para que a impressão deles não seja
+    confirmada e a consulta seja repetida.
+    """
+
+    def __init__(self):
+        self._codigos = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, rejeitados):
+        with self._lock:
+            for codigo, campo, _ in rejeitados:
+                self._codigos[str(codigo)] = campo
+
+    def retirar(self):
+        """
+        Retorna {codigo: campo} dos rejeitados e esvazia o registro
+        """
+        with self._lock:
+            codigos, self._codigos = self._codigos, {}
+        return codigos
+
+
+rejeicoes = RegistroRejeicoes()
+
+
+def informar_rejeitados(rejeitados):
+    """
+    Informa os registros rejeitados por um bloco, os soma nas métricas da execução e
+    guarda os seus códigos em rejeicoes
+    """
+    if not rejeitados:
+        return
+    rejeicoes.registrar(rejeitados)
+    for codigo, campo, valor in rejeitados[:REJEICOES_LISTADAS]:
+        print(f"⚠️ Registro CNES {codigo} rejeitado: valor inválido em {campo}: {valor!r}")
+    if len(rejeitados) > REJEICOES_LISTADAS:
+        print(f"⚠️ ... e mais {len(rejeitados) - REJEICOES_LISTADAS} registros rejeitados")
+    for _, campo, _ in rejeitados:
+        metricas.contar('registros_rejeitados', campo=campo)
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import sys
+import requests
+
+from EstabelecimentosCsvDownload import (
+    URL_OPENDATASUS, UF_PADRAO, UFS, SIGLAS_UF, pasta_uf, obter_recurso_cnes, calcular_hash
+)
+
+# Arquivo, na pasta de trabalho de cada UF, com a assinatura do último dump processado com sucesso
+NOME_ESTADO = 'estado_cnes.json'
+
+# Código de saída usado quando o dump não mudou desde a última execução
+CODIGO_SEM_ATUALIZACAO = 3
+
+
+def caminho_estado(uf=UF_PADRAO):
+    return os.path.join(pasta_uf(uf), NOME_ESTADO)
+
+
+def carregar_estado(uf=UF_PADRAO):
+    """
+    Lê o arquivo de estado da última execução da UF. Retorna {} se não existir.
+    """
+    try:
+        with open(caminho_estado(uf), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def salvar_estado(estado, uf=UF_PADRAO):
+    """
+    Grava o arquivo de estado da UF de forma atômica (arquivo temporário + rename)
+    """
+    caminho = caminho_estado(uf)
+    temporario = caminho + '.tmp'
+    with open(temporario, 'w', encoding='utf-8') as f:
+        json.dump(estado, f, ensure_ascii=False, indent=2)
+    os.replace(temporario, caminho)
+
+
+def obter_assinatura_recurso(url_base=URL_OPENDATASUS):
+    """
+    Monta a assinatura do recurso publicado no OpenDataSUS sem baixá-lo:
+    URL, tamanho e hash informados pelo CKAN, mais ETag e Last-Modified de um HEAD.
+    """
+    recurso = obter_recurso_cnes(url_base)
+    if recurso is None:
+        return None
+    response = requests.head(recurso['url'], allow_redirects=True, timeout=30)
+    tamanho = response.headers.get('Content-Length')
+    return {
+        'url': recurso['url'],
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'tamanho': recurso['tamanho'] or (int(tamanho) if tamanho else None),
+        'hash': recurso['hash'],
+    }
+
+
+def recurso_mudou(assinatura, estado):
+    """
+    Compara a assinatura atual com a registrada. Na dúvida (sem assinatura,
+    sem estado anterior ou sem nenhum campo para comparar) considera que mudou.
+    """
+    anterior = estado.get('recurso')
+    if not assinatura or not anterior:
+        return True
+    campos = ['etag', 'last_modified', 'tamanho', 'hash']
+    if not any(assinatura.get(campo) for campo in campos):
+        return True
+    return any(assinatura.get(campo) != anterior.get(campo) for campo in campos + ['url'])
+
+
+def csv_filtrado_mudou(caminho_csv, estado):
+    """
+    Retorna (mudou, hash) comparando o hash do arquivo de códigos da UF (ex.: cnes_ro.csv) com o registrado
+    """
+    hash_csv = calcular_hash(caminho_csv)
+    return hash_csv != estado.get('codigos_sha256'), hash_csv
+
+
+def codigos_filtrados_mudaram(codigos, estado):
+    """
+    Mesmo que csv_filtrado_mudou, mas a partir da lista de códigos em memória
+    (o hash é igual ao do arquivo de códigos da UF com esses códigos)
+    """
+    conteudo = ','.join(str(codigo) for codigo in codigos).encode('utf-8')
+    hash_codigos = hashlib.sha256(conteudo).hexdigest()
+    return hash_codigos != estado.get('codigos_sha256'), hash_codigos
+
+
+def main():
+    from SnapshotCnes import snapshot_ausente
+
+    try:
+        assinatura = obter_assinatura_recurso()
+    except Exception as e:
+        print(f"Não foi possível verificar o recurso, seguindo com a execução: {e}")
+        return
+    # Basta uma das UFs configuradas ter processado um dump diferente do atual ou ainda
+    # não ter o primeiro snapshot (mesma condição de main.py e ShardsCnes)
+    ufs_desatualizadas = [SIGLAS_UF[uf] for uf in UFS
+                          if recurso_mudou(assinatura, carregar_estado(uf)) or snapshot_ausente(uf)]
+    if ufs_desatualizadas:
+        print(f"Dump do CNES atualizado (ou snapshot ausente) desde a última execução das UFs: "
+              f"{', '.join(ufs_desatualizadas)}.")
+    else:
+        print("Dump do CNES não mudou desde a última execução.")
+        sys.exit(CODIGO_SEM_ATUALIZACAO)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,279 @@
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.chrome.service import Service
+import hashlib
 import time
 import zipfile
 import os
+import requests
 
+from MetricasCnes import metricas
 
-# Caminho absoluto para a pasta 'download' dentro da pasta do script
-download_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), "downloads")
+
+# Caminho absoluto para a pasta 'download' dentro da pasta do script. Pode ser
+# sobrescrito pela variável de ambiente CNES_PASTA_DOWNLOADS (ex.: benchmark isolado)
+download_dir = os.environ.get('CNES_PASTA_DOWNLOADS',
+                              os.path.join(os.path.abspath(os.path.dirname(__file__)), "downloads"))
 os.makedirs(download_dir, exist_ok=True)  # Cria a pasta se não existir
 
+# Quantidade de linhas do CSV lidas por vez na filtragem
+TAMANHO_CHUNK = 100_000
+
+# Códigos IBGE das UFs (CO_UF no dump) e suas siglas
+SIGLAS_UF = {
+    11: 'RO', 12: 'AC', 13: 'AM', 14: 'RR', 15: 'PA', 16: 'AP', 17: 'TO',
+    21: 'MA', 22: 'PI', 23: 'CE', 24: 'RN', 25: 'PB', 26: 'PE', 27: 'AL', 28: 'SE', 29: 'BA',
+    31: 'MG', 32: 'ES', 33: 'RJ', 35: 'SP',
+    41: 'PR', 42: 'SC', 43: 'RS',
+    50: 'MS', 51: 'MT', 52: 'GO', 53: 'DF',
+}
+
+# UF usada quando nenhuma é informada (scripts isolados, execução padrão)
+UF_PADRAO = 11
+
+
+def ler_ufs(valor):
+    """
+    Converte a configuração de UFs ("11,12", "RO,AC" ou "todas") em uma lista de códigos IBGE
+    """
+    if valor.strip().lower() == 'todas':
+        return sorted(SIGLAS_UF)
+    codigos_por_sigla = {sigla: codigo for codigo, sigla in SIGLAS_UF.items()}
+    ufs = []
+    for item in valor.split(','):
+        item = item.strip().upper()
+        if not item:
+            continue
+        uf = int(item) if item.isdigit() else codigos_por_sigla.get(item)
+        if uf not in SIGLAS_UF:
+            raise ValueError(f'UF desconhecida: {item}')
+        if uf not in ufs:
+            ufs.append(uf)
+    return ufs
+
+
+# UFs processadas pela automação (variável de ambiente CNES_UFS, padrão só Rondônia)
+UFS = ler_ufs(os.environ.get('CNES_UFS', str(UF_PADRAO)))
+
+
+def pasta_uf(uf):
+    """
+    Pasta de trabalho de uma UF dentro de downloads/: arquivos intermediários e estado
+    de cada UF ficam separados, para que uma UF possa ser processada ou recarregada sem
+    interferir nas demais. O dump do OpenDataSUS (nacional) continua em downloads/.
+    """
+    pasta = os.path.join(download_dir, f'uf_{uf}')
+    os.makedirs(pasta, exist_ok=True)
+    return pasta
+
+
+def caminho_codigos_uf(uf):
+    """
+    Arquivo com os códigos CNES filtrados da UF (ex.: uf_11/cnes_ro.csv)
+    """
+    return os.path.join(pasta_uf(uf), f'cnes_{SIGLAS_UF[uf].lower()}.csv')
+
+# Colunas de metadados de atualização do dump (DT_ATUALIZACAO, DT_ATU_GEO, ...) usadas
+# na impressão digital de cada estabelecimento para a busca incremental
+def coluna_de_atualizacao(nome):
+    return 'DT_ATU' in nome.upper()
+
+# Endereço do portal OpenDataSUS (CKAN) e identificador do conjunto de dados do CNES.
+# Pode ser sobrescrito pela variável de ambiente OPENDATASUS_URL (ex.: servidor local de testes)
+URL_OPENDATASUS = os.environ.get('OPENDATASUS_URL', 'https://opendatasus.saude.gov.br')
+DATASET_CNES = 'cnes-cadastro-nacional-de-estabelecimentos-de-saude'
+
+# Tamanho dos blocos gravados em disco durante o download (1 MiB)
+TAMANHO_BLOCO_DOWNLOAD = 1024 * 1024
+
+
+class DownloadInvalidoError(Exception):
+    """Arquivo baixado não confere com o tamanho ou checksum esperado"""
+
+
+def obter_recurso_cnes(url_base=URL_OPENDATASUS, dataset=DATASET_CNES):
+    """
+    Consulta os metadados do conjunto de dados na API do CKAN (package_show) e
+    retorna o recurso .zip de estabelecimentos como um dicionário com as chaves
+    'url', 'tamanho' e 'hash' (as duas últimas podem ser None).
+    """
+    url = f'{url_base.rstrip("/")}/api/3/action/package_show'
+    response = requests.get(url, params={'id': dataset}, timeout=30)
+    response.raise_for_status()
+    recursos = response.json()['result']['resources']
+
+    zips = [r for r in recursos
+            if (r.get('format') or '').lower() == 'zip' or (r.get('url') or '').lower().endswith('.zip')]
+    if not zips:
+        return None
+    # Preferir o recurso de estabelecimentos, caso o conjunto tenha mais de um .zip
+    preferidos = [r for r in zips
+                  if 'estabelecimento' in f"{r.get('name') or ''} {r.get('url')}".lower()]
+    recurso = (preferidos or zips)[0]
+    return {
+        'url': recurso['url'],
+        'tamanho': int(recurso['size']) if recurso.get('size') else None,
+        'hash': recurso.get('hash') or None,
+    }
+
+
+def calcular_hash(caminho, algoritmo='sha256'):
+    """
+    Calcula o hash de um arquivo lendo-o em blocos
+    """
+    h = hashlib.new(algoritmo)
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(TAMANHO_BLOCO_DOWNLOAD), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def verificar_hash(caminho, hash_esperado):
+    """
+    Confere o arquivo com o hash informado pelo CKAN. Aceita o formato
+    'algoritmo:hex' ou apenas o hex (algoritmo deduzido pelo tamanho).
+    """
+    if ':' in hash_esperado:
+        algoritmo, valor = hash_esperado.split(':', 1)
+    else:
+        algoritmo = {32: 'md5', 40: 'sha1', 64: 'sha256'}.get(len(hash_esperado))
+        valor = hash_esperado
+        if algoritmo is None:
+            print(f"Formato de hash desconhecido, verificação ignorada: {hash_esperado}")
+            return True
+    return calcular_hash(caminho, algoritmo.lower()) == valor.lower()
+
+
+def descartar_parcial(parcial):
+    """
+    Exclui o arquivo parcial de um download e o seu validador (ver baixar_arquivo)
+    """
+    for caminho in (parcial, parcial + '.validador'):
+        if os.path.exists(caminho):
+            os.remove(caminho)
+
+
+def baixar_arquivo(url, destino, tamanho_esperado=None, hash_esperado=None, max_tentativas=5):
+    """
+    Baixa um arquivo via HTTP gravando em blocos em '<destino>.part'.
+    Se o download for interrompido, a próxima tentativa continua de onde parou
+    usando o cabeçalho Range, com If-Range (ETag ou Last-Modified da resposta que
+    começou o .part, guardado em '<destino>.part.validador'): se o arquivo mudou no
+    servidor desde então, ele responde com o arquivo novo inteiro e o download recomeça.
+    Um .part sem validador não é retomado. Ao final confere tamanho e checksum e só
+    então renomeia o arquivo parcial para o destino.
+    """
+    parcial = destino + '.part'
+    arquivo_validador = parcial + '.validador'
+    tamanho_informado = tamanho_esperado
+
+    for tentativa in range(max_tentativas):
+        ja_baixado = os.path.getsize(parcial) if os.path.exists(parcial) else 0
+        validador = None
+        if ja_baixado and os.path.exists(arquivo_validador):
+            with open(arquivo_validador, 'r', encoding='utf-8') as f:
+                validador = f.read().strip() or None
+        if ja_baixado and validador is None:
+            print('Download parcial sem ETag/Last-Modified para conferir a versão: recomeçando do zero')
+            ja_baixado = 0
+        headers = {'Range': f'bytes={ja_baixado}-', 'If-Range': validador} if ja_baixado else {}
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 416:
+                    # Nada a baixar além do que já temos: o .part já está completo
+                    pass
+                else:
+                    response.raise_for_status()
+                    if response.status_code == 206:
+                        modo = 'ab'
+                        # Content-Range: bytes inicio-fim/total
+                        total = response.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+                        if total.isdigit() and tamanho_esperado is None:
+                            tamanho_esperado = int(total)
+                    else:
+                        # Servidor ignorou o Range ou o arquivo mudou (If-Range): recomeça do zero
+                        modo = 'wb'
+                        # O tamanho lido de um Content-Range anterior era o do arquivo antigo
+                        if tamanho_informado is None:
+                            tamanho = response.headers.get('Content-Length')
+                            tamanho_esperado = int(tamanho) if tamanho else None
+                        # ETag fraca não vale para If-Range: usa Last-Modified
+                        etag = response.headers.get('ETag')
+                        validador = (etag if etag and not etag.startswith('W/')
+                                     else response.headers.get('Last-Modified'))
+                        if validador:
+                            with open(arquivo_validador, 'w', encoding='utf-8') as f:
+                                f.write(validador)
+                        elif os.path.exists(arquivo_validador):
+                            os.remove(arquivo_validador)
+                    with open(parcial, modo) as f:
+                        for bloco in response.iter_content(chunk_size=TAMANHO_BLOCO_DOWNLOAD):
+                            f.write(bloco)
+                            metricas.contar('bytes_baixados', len(bloco))
+            tamanho_final = os.path.getsize(parcial)
+            if tamanho_esperado is None or tamanho_final == tamanho_esperado:
+                break
+            if tamanho_final > tamanho_esperado:
+                descartar_parcial(parcial)
+                raise DownloadInvalidoError(
+                    f'Tamanho do download ({tamanho_final}) maior que o esperado ({tamanho_esperado})')
+            print(f'Download incompleto ({tamanho_final}/{tamanho_esperado} bytes), retomando...')
+        except requests.exceptions.RequestException as e:
+            print(f'Tentativa {tentativa + 1} de download falhou: {e}')
+            if tentativa == max_tentativas - 1:
+                raise
+            metricas.contar('tentativas_repetidas', origem='download')
+            time.sleep(2 ** tentativa)
+    else:
+        raise DownloadInvalidoError(
+            f'Download incompleto após {max_tentativas} tentativas ({tamanho_final}/{tamanho_esperado} bytes)')
+    if hash_esperado and not verificar_hash(parcial, hash_esperado):
+        descartar_parcial(parcial)
+        raise DownloadInvalidoError(f'Checksum do download não confere com {hash_esperado}')
+
+    os.replace(parcial, destino)
+    if os.path.exists(arquivo_validador):
+        os.remove(arquivo_validador)
+    print(f"Download concluído: {destino} ({tamanho_final} bytes)")
+    return destino
+
+
+def baixar_cnes_direto(url_base=URL_OPENDATASUS):
+    """
+    Localiza o .zip de estabelecimentos pelos metadados do CKAN e baixa direto
+    para a pasta de downloads, sem abrir navegador.
+    """
+    recurso = obter_recurso_cnes(url_base)
+    if recurso is None:
+        print("Recurso .zip não encontrado nos metadados do conjunto de dados!")
+        return None
+    print(f"Recurso encontrado: {recurso['url']}")
+    nome_arquivo = os.path.basename(recurso['url'].split('?', 1)[0]) or 'cnes_estabelecimentos.zip'
+    destino = os.path.join(download_dir, nome_arquivo)
+    return baixar_arquivo(recurso['url'], destino, recurso['tamanho'], recurso['hash'])
+
+
 # Entrar no site e baixar arquivo csv
-def acessar_opendatasus():
+def acessar_opendatasus(url_base=URL_OPENDATASUS):
+    """
+    Baixa o .zip de estabelecimentos do OpenDataSUS por HTTP direto.
+    O Selenium é usado apenas como alternativa, se o download direto falhar.
+    """
+    try:
+        if baixar_cnes_direto(url_base):
+            return
+    except Exception as e:
+        print(f"Erro no download direto: {e}")
+    print("Tentando download pelo navegador...")
+    acessar_opendatasus_selenium(url_base)
+
+
+def acessar_opendatasus_selenium(url_base=URL_OPENDATASUS):
     """
     Função básica para acessar o site do OpenDataSUS
     """
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.by import By
+    from webdriver_manager.chrome import ChromeDriverManager
+    from selenium.webdriver.chrome.service import Service
     
     # Configurar opções do Chrome
     chrome_options = Options()
@@ -54,7 +311,7 @@ def acessar_opendatasus():
         print("Abrindo navegador...")
         
         # URL do site
-        url = "https://opendatasus.saude.gov.br/dataset/cnes-cadastro-nacional-de-estabelecimentos-de-saude"
+        url = f"{url_base.rstrip('/')}/dataset/{DATASET_CNES}"
         
         print(f"Acessando: {url}")
         
@@ -85,24 +342,12 @@ def acessar_opendatasus():
         zip_files = [f for f in files if f.endswith('.zip')]
 
         if zip_files:
-            zip_file = os.path.join(download_dir, zip_files[0])  # Caminho completo do primeiro .zip
+            # O .zip é mantido compactado: filtrar_estabelecimentos lê o CSV direto dele
+            print(f"Arquivo .zip baixado: {os.path.join(download_dir, zip_files[0])}")
         else:
             print("Arquivo .zip não encontrado!")
             return
         
-        # Extrair arquivo baixado
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            zip_ref.extractall(download_dir)
-            print("Arquivo extraído com sucesso!")
-        # Exclui o arquivo .zip após extração
-        try:
-            os.remove(zip_file)
-            print(f"Arquivo .zip removido: {zip_file}")
-        except Exception as e:
-            print(f"Erro ao remover o arquivo .zip: {e}")
-        
-        
-        
     except Exception as e:
         print(f"Erro ao acessar o site: {e}")
         
@@ -112,37 +357,152 @@ def acessar_opendatasus():
         driver.quit()
 
 
+def localizar_csv_no_zip(zip_ref):
+    """
+    Retorna o nome do primeiro membro .csv dentro do arquivo .zip
+    """
+    for nome in zip_ref.namelist():
+        if nome.lower().endswith('.csv'):
+            return nome
+    return None
+
+
 # Filtrar arquivo csv baixado
-def filtrar_estabelecimentos():
+def iterar_codigos_por_uf(ufs=UFS, tamanho_chunk=TAMANHO_CHUNK, remover_origem=True):
+    """
+    Gerador de pares (uf, código CNES) de várias UFs em uma única leitura do CSV do
+    OpenDataSUS, em blocos e direto de dentro do .zip baixado (sem extrair para o disco).
+    Apenas as colunas CO_CNES, CO_UF e as de data de atualização são lidas, de modo
+    que o consumo de memória e disco não cresce com o tamanho do arquivo. Os códigos
+    de cada UF saem sem repetição, como int, e a impressão digital das datas de
+    atualização de cada um é registrada no estado incremental da UF
+    (EstadoIncrementalCnes, na pasta_uf). Ao final, o arquivo original é removido se remover_origem.
+    """
     import pandas as pd
-    # Encontrar o arquivo CSV extraído
+    from EstadoIncrementalCnes import conectar_estado, iniciar_impressoes_dump, registrar_impressoes_dump
+    ufs = list(ufs)
+    # Encontrar o arquivo baixado (.zip, ou um .csv já extraído)
     files = os.listdir(download_dir)
-    csv_files = [f for f in files if f.endswith('.csv')]
-    if not csv_files:
-        print('Arquivo CSV não encontrado no diretório de downloads!')
-        return
-    csv_path = os.path.join(download_dir, csv_files[0])
+    zip_files = [f for f in files if f.endswith('.zip')]
+    csv_files = [f for f in files if f.endswith('.csv') and not f.startswith('cnes_')]
 
-    # Ler o CSV
-    df = pd.read_csv(csv_path, sep=';', encoding='latin1')
-    
-    # Filtrar apenas estabelecimentos de RO (CO_UF == 11)
-    df_ro = df[df['CO_UF'] == 11]
-    
-    # Selecionar apenas a coluna CO_CNES
-    cnes_list = df_ro['CO_CNES'].drop_duplicates()
-    
-    # Salvar em novo arquivo, apenas os códigos CNES separados por vírgula, sem cabeçalho
-    output_path = os.path.join(download_dir, 'cnes_ro.csv')
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(','.join(str(cnes) for cnes in cnes_list))
-    print(f'Arquivo filtrado salvo em: {output_path}')
-    # Excluir o arquivo CSV original
+    zip_ref = None
+    if zip_files:
+        origem_path = os.path.join(download_dir, zip_files[0])
+        zip_ref = zipfile.ZipFile(origem_path, 'r')
+        membro = localizar_csv_no_zip(zip_ref)
+        if membro is None:
+            zip_ref.close()
+            raise FileNotFoundError(f'Arquivo CSV não encontrado dentro de {origem_path}!')
+        arquivo = zip_ref.open(membro)
+    elif csv_files:
+        origem_path = os.path.join(download_dir, csv_files[0])
+        arquivo = open(origem_path, 'rb')
+    else:
+        raise FileNotFoundError('Arquivo CSV não encontrado no diretório de downloads!')
+
+    vistos = {uf: set() for uf in ufs}
+    total_linhas = 0
+    conexoes = {uf: conectar_estado(pasta_uf(uf)) for uf in ufs}
     try:
-        os.remove(csv_path)
-        print(f"Arquivo CSV original removido: {csv_path}")
-    except Exception as e:
-        print(f"Erro ao remover o arquivo CSV original: {e}")
+        # Ler o CSV em blocos, apenas com as colunas necessárias
+        leitor = pd.read_csv(
+            arquivo,
+            sep=';',
+            encoding='latin1',
+            usecols=lambda coluna: coluna in ('CO_CNES', 'CO_UF') or coluna_de_atualizacao(coluna),
+            dtype=str,
+            chunksize=tamanho_chunk,
+        )
+        for conn in conexoes.values():
+            iniciar_impressoes_dump(conn)
+        for chunk in leitor:
+            total_linhas += len(chunk)
+            metricas.contar('linhas_dump_lidas', len(chunk))
+            uf_chunk = pd.to_numeric(chunk['CO_UF'], errors='coerce')
+            chunk = chunk[uf_chunk.isin(ufs)]
+            colunas_atualizacao = [c for c in chunk.columns if coluna_de_atualizacao(c)]
+            # Separar o bloco por UF (CO_UF == 11 para RO)
+            for uf, chunk_uf in chunk.groupby(uf_chunk.loc[chunk.index].astype(int), sort=False):
+                chunk_uf = chunk_uf.drop_duplicates('CO_CNES')
+                codigos = pd.to_numeric(chunk_uf['CO_CNES'], errors='coerce').dropna().astype('int64')
+                if colunas_atualizacao:
+                    impressoes = pd.util.hash_pandas_object(chunk_uf[colunas_atualizacao], index=False)
+                    impressoes = impressoes.loc[codigos.index].map('{:016x}'.format)
+                else:
+                    impressoes = pd.Series('', index=codigos.index)
+
+                novos = []
+                for cnes, impressao in zip(codigos, impressoes):
+                    if cnes in vistos[uf]:
+                        continue
+                    vistos[uf].add(cnes)
+                    novos.append((cnes, impressao))
+                registrar_impressoes_dump(conexoes[uf], novos)
+                metricas.contar('codigos_filtrados', len(novos), uf=SIGLAS_UF[uf])
+                for cnes, _ in novos:
+                    yield uf, int(cnes)
+        for conn in conexoes.values():
+            conn.commit()
+    finally:
+        for conn in conexoes.values():
+            conn.close()
+        arquivo.close()
+        if zip_ref is not None:
+            zip_ref.close()
+
+    encontrados = ', '.join(f'{SIGLAS_UF[uf]}: {len(vistos[uf])}' for uf in ufs)
+    print(f'{total_linhas} linhas processadas, códigos CNES encontrados por UF: {encontrados}')
+    if remover_origem:
+        # Excluir o arquivo original (.zip ou CSV)
+        try:
+            os.remove(origem_path)
+            print(f"Arquivo original removido: {origem_path}")
+        except Exception as e:
+            print(f"Erro ao remover o arquivo original: {e}")
+
+
+def iterar_codigos_uf(uf=UF_PADRAO, tamanho_chunk=TAMANHO_CHUNK, remover_origem=True):
+    """
+    Gerador com os códigos CNES (int, sem repetição) de uma única UF (ver iterar_codigos_por_uf)
+    """
+    for _, cnes in iterar_codigos_por_uf([uf], tamanho_chunk, remover_origem):
+        yield cnes
+
+
+def separar_codigos_por_uf(ufs=UFS, tamanho_chunk=TAMANHO_CHUNK, remover_origem=True):
+    """
+    Lê o dump uma única vez e retorna {uf: [códigos CNES]} para as UFs informadas
+    """
+    codigos = {uf: [] for uf in ufs}
+    for uf, cnes in iterar_codigos_por_uf(ufs, tamanho_chunk, remover_origem):
+        codigos[uf].append(cnes)
+    return codigos
+
+
+def filtrar_estabelecimentos(ufs=UFS, tamanho_chunk=TAMANHO_CHUNK):
+    """
+    Filtra os códigos CNES das UFs (ver iterar_codigos_por_uf) e os grava, à medida que
+    cada bloco é processado, no arquivo de códigos de cada UF (caminho_codigos_uf).
+    """
+    arquivos = {uf: open(caminho_codigos_uf(uf), 'w', encoding='utf-8') for uf in ufs}
+    escritos = {uf: 0 for uf in ufs}
+    try:
+        # Salvar apenas os códigos CNES separados por vírgula, sem cabeçalho
+        for uf, cnes in iterar_codigos_por_uf(ufs, tamanho_chunk):
+            arquivos[uf].write(f',{cnes}' if escritos[uf] else str(cnes))
+            escritos[uf] += 1
+    except FileNotFoundError as e:
+        for uf, f in arquivos.items():
+            f.close()
+            os.remove(caminho_codigos_uf(uf))
+        print(e)
+        return
+    finally:
+        for f in arquivos.values():
+            f.close()
+    for uf in ufs:
+        print(f'Arquivo filtrado salvo em: {caminho_codigos_uf(uf)}')
     
 
 
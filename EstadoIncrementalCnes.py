@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from EstabelecimentosCsvDownload import UF_PADRAO, pasta_uf
+
+# Banco SQLite com a impressão digital (hash) de cada estabelecimento entre execuções,
+# um por UF, dentro da pasta de trabalho da UF
+NOME_BANCO_ESTADO = 'estado_incremental.sqlite3'
+
+# Quantidade de códigos sem alteração consultados a cada execução (amostra rotativa,
+# sempre os consultados há mais tempo), para corrigir mudanças que o dump não acusa
+AMOSTRA_NAO_ALTERADOS = int(os.environ.get('CNES_AMOSTRA_NAO_ALTERADOS', '200'))
+
+# Colunas *_pendente guardam o resultado da busca atual; só viram definitivas em
+# confirmar_consultas, depois que a carga no banco terminou com sucesso
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS estabelecimentos (
+    codigo_cnes TEXT PRIMARY KEY,
+    impressao_dump_atual TEXT,
+    impressao_dump TEXT,
+    impressao_api TEXT,
+    ultima_consulta REAL,
+    impressao_dump_pendente TEXT,
+    impressao_api_pendente TEXT,
+    consulta_pendente REAL
+)
+"""
+
+# Fila de falhas (dead letter): códigos cuja consulta à API falhou mesmo depois da
+# repescagem, com o último status HTTP (nulo para erro de conexão/timeout) e as tentativas
+# acumuladas. Entram de novo na busca da execução seguinte e saem quando dão certo.
+# Também recebe, com STATUS_REJEITADO, os registros obtidos que a carga rejeitou.
+ESQUEMA_FALHAS = """
+CREATE TABLE IF NOT EXISTS falhas_consulta (
+    codigo_cnes TEXT PRIMARY KEY,
+    status INTEGER,
+    tentativas INTEGER NOT NULL,
+    execucoes INTEGER NOT NULL,
+    primeira_falha REAL NOT NULL,
+    ultima_falha REAL NOT NULL
+)
+"""
+
+
+# Status na fila de falhas de um registro obtido da API mas rejeitado pelo codificador
+# da carga (CodificadorCnes): fora de STATUS_REPETIR, não entra na repescagem
+STATUS_REJEITADO = 422
+
+
+def conectar_estado(pasta=None):
+    """
+    Abre (criando se necessário) o banco de estado incremental da pasta de trabalho
+    informada (padrão: a de UF_PADRAO). Vários processos (shards) podem usá-lo ao
+    mesmo tempo: quem encontra o banco ocupado espera. O banco fica em modo WAL, em que
+    as leituras não esperam pela escrita de outro processo e cada commit é mais barato.
+    """
+    if pasta is None:
+        pasta = pasta_uf(UF_PADRAO)
+    conn = sqlite3.connect(os.path.join(pasta, NOME_BANCO_ESTADO), timeout=120)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(ESQUEMA)
+    conn.execute(ESQUEMA_FALHAS)
+    return conn
+
+
+def calcular_impressao(dados):
+    """
+    Hash estável de um payload da API (independe da ordem das chaves)
+    """
+    texto = json.dumps(dados, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(texto.encode('utf-8')).hexdigest()
+
+
+def iniciar_impressoes_dump(conn):
+    """
+    Limpa as impressões do dump anterior, antes de registrar as do dump novo.
+    Códigos que saíram do dump ficam com impressao_dump_atual nula.
+    """
+    conn.execute("UPDATE estabelecimentos SET impressao_dump_atual = NULL")
+
+
+def registrar_impressoes_dump(conn, pares):
+    """
+    Registra pares (codigo_cnes, impressão da linha do dump) lidos do arquivo do OpenDataSUS
+    """
+    conn.executemany(
+        """INSERT INTO estabelecimentos (codigo_cnes, impressao_dump_atual) VALUES (?, ?)
+           ON CONFLICT (codigo_cnes) DO UPDATE SET impressao_dump_atual = excluded.impressao_dump_atual""",
+        ((str(codigo), impressao) for codigo, impressao in pares),
+    )
+
+
+def contar_alterados_no_dump(conn):
+    """
+    Quantidade de códigos presentes no dump atual que são novos ou cuja linha mudou
+    desde a última consulta confirmada
+    """
+    return conn.execute(
+        """SELECT COUNT(*) FROM estabelecimentos
+           WHERE impressao_dump_atual IS NOT NULL
+             AND (impressao_dump IS NULL OR impressao_dump != impressao_dump_atual)"""
+    ).fetchone()[0]
+
+
+def selecionar_codigos_para_consulta(conn, lista_codigos, amostra=AMOSTRA_NAO_ALTERADOS):
+    """
+    Filtra a lista de códigos deixando apenas os que precisam ir à API: novos, com linha
+    do dump alterada e uma amostra rotativa dos não alterados (os consultados há mais tempo).
+    Retorna (codigos, quantidade_de_novos_ou_alterados).
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS lista_codigos (codigo_cnes TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM lista_codigos")
+    conn.executemany("INSERT OR IGNORE INTO lista_codigos VALUES (?)", ((str(c),) for c in lista_codigos))
+
+    alterados = [linha[0] for linha in conn.execute(
+        """SELECT l.codigo_cnes FROM lista_codigos l
+           LEFT JOIN estabelecimentos e ON e.codigo_cnes = l.codigo_cnes
+           WHERE e.impressao_api IS NULL
+              OR e.impressao_dump IS NULL
+              OR e.impressao_dump != COALESCE(e.impressao_dump_atual, e.impressao_dump)"""
+    )]
+    nao_alterados = [linha[0] for linha in conn.execute(
+        """SELECT l.codigo_cnes FROM lista_codigos l
+           JOIN estabelecimentos e ON e.codigo_cnes = l.codigo_cnes
+           WHERE e.impressao_api IS NOT NULL
+             AND e.impressao_dump = COALESCE(e.impressao_dump_atual, e.impressao_dump)
+           ORDER BY e.ultima_consulta ASC
+           LIMIT ?""",
+        (amostra,),
+    )]
+    return alterados + nao_alterados, len(alterados)
+
+
+def registrar_consulta(conn, codigo_cnes, dados):
+    """
+    Guarda como pendente a impressão do payload recebido da API.
+    Retorna True se o payload mudou em relação à última consulta confirmada.
+    """
+    impressao = calcular_impressao(dados)
+    conn.execute(
+        """INSERT INTO estabelecimentos (codigo_cnes) VALUES (?) ON CONFLICT (codigo_cnes) DO NOTHING""",
+        (str(codigo_cnes),),
+    )
+    conn.execute(
+        """UPDATE estabelecimentos
+           SET impressao_dump_pendente = impressao_dump_atual, impressao_api_pendente = ?, consulta_pendente = ?
+           WHERE codigo_cnes = ?""",
+        (impressao, time.time(), str(codigo_cnes)),
+    )
+    anterior = conn.execute(
+        "SELECT impressao_api FROM estabelecimentos WHERE codigo_cnes = ?", (str(codigo_cnes),)
+    ).fetchone()[0]
+    return anterior != impressao
+
+
+def confirmar_consultas(conn):
+    """
+    Torna definitivas as consultas pendentes. Deve ser chamada após a carga no banco.
+    """
+    cursor = conn.execute(
+        """UPDATE estabelecimentos
+           SET impressao_dump = impressao_dump_pendente, impressao_api = impressao_api_pendente,
+               ultima_consulta = consulta_pendente,
+               impressao_dump_pendente = NULL, impressao_api_pendente = NULL, consulta_pendente = NULL
+           WHERE consulta_pendente IS NOT NULL"""
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def rejeitar_consultas(conn, codigos):
+    """
+    Descarta as consultas pendentes dos códigos cujos registros a carga rejeitou (a
+    impressão deles não é confirmada por confirmar_consultas) e os põe na fila de
+    falhas, para serem consultados de novo na próxima execução
+    """
+    conn.executemany(
+        """UPDATE estabelecimentos
+           SET impressao_dump_pendente = NULL, impressao_api_pendente = NULL, consulta_pendente = NULL
+           WHERE codigo_cnes = ?""",
+        ((str(codigo),) for codigo in codigos),
+    )
+    registrar_falhas(conn, {codigo: {'status': STATUS_REJEITADO, 'tentativas': 1} for codigo in codigos})
+
+
+def registrar_falhas(conn, falhas):
+    """
+    Grava na fila de falhas os códigos de falhas ({codigo: {'status', 'tentativas'}}),
+    somando as tentativas e execuções aos registros que já estavam lá
+    """
+    agora = time.time()
+    conn.executemany(
+        """INSERT INTO falhas_consulta (codigo_cnes, status, tentativas, execucoes, primeira_falha, ultima_falha)
+           VALUES (?, ?, ?, 1, ?, ?)
+           ON CONFLICT (codigo_cnes) DO UPDATE SET
+               status = excluded.status, tentativas = tentativas + excluded.tentativas,
+               execucoes = execucoes + 1, ultima_falha = excluded.ultima_falha""",
+        ((str(codigo), falha['status'], falha['tentativas'], agora, agora) for codigo, falha in falhas.items()),
+    )
+    conn.commit()
+
+
+def listar_falhas(conn):
+    """
+    Fila de falhas como {codigo: {'status', 'tentativas', 'execucoes'}}
+    """
+    return {codigo: {'status': status, 'tentativas': tentativas, 'execucoes': execucoes}
+            for codigo, status, tentativas, execucoes in conn.execute(
+                "SELECT codigo_cnes, status, tentativas, execucoes FROM falhas_consulta")}
+
+
+def remover_falhas(conn, codigos):
+    """
+    Tira da fila de falhas os códigos consultados com sucesso
+    """
+    conn.executemany("DELETE FROM falhas_consulta WHERE codigo_cnes = ?", ((str(codigo),) for codigo in codigos))
+    conn.commit()
@@ -1,4 +1,41 @@
-import json
+import os
+import time
+
+# Registros por comando UPSERT no script gerado
+TAMANHO_LOTE = int(os.environ.get('CNES_TAMANHO_LOTE', '1000'))
+
+# Marcador gravado após cada comando no script, usado pelo carregador para separar os lotes
+MARCADOR_FIM_LOTE = '-- fim do lote'
+
+# Lista dos campos na ordem correta
+CAMPOS = [
+    'codigo_cnes', 'numero_cnpj_entidade', 'nome_razao_social', 'nome_fantasia',
+    'natureza_organizacao_entidade', 'tipo_gestao', 'descricao_nivel_hierarquia',
+    'descricao_esfera_administrativa', 'codigo_tipo_unidade', 'codigo_cep_estabelecimento',
+    'endereco_estabelecimento', 'numero_estabelecimento', 'bairro_estabelecimento',
+    'numero_telefone_estabelecimento', 'latitude_estabelecimento_decimo_grau',
+    'longitude_estabelecimento_decimo_grau', 'endereco_email_estabelecimento',
+    'numero_cnpj', 'codigo_identificador_turno_atendimento', 'descricao_turno_atendimento',
+    'estabelecimento_faz_atendimento_ambulatorial_sus', 'codigo_estabelecimento_saude',
+    'codigo_uf', 'codigo_municipio', 'descricao_natureza_juridica_estabelecimento',
+    'codigo_motivo_desabilitacao_estabelecimento', 'estabelecimento_possui_centro_cirurgico',
+    'estabelecimento_possui_centro_obstetrico', 'estabelecimento_possui_centro_neonatal',
+    'estabelecimento_possui_atendimento_hospitalar', 'estabelecimento_possui_servico_apoio',
+    'estabelecimento_possui_atendimento_ambulatorial', 'codigo_atividade_ensino_unidade',
+    'codigo_natureza_organizacao_unidade', 'codigo_nivel_hierarquia_unidade',
+    'codigo_esfera_administrativa_unidade', 'data_atualizacao'
+]
+
+# Chave primária de unidade_saude, particionada por codigo_uf (a chave de uma tabela
+# particionada precisa conter a coluna de particionamento)
+CHAVE_PRIMARIA = ('codigo_cnes', 'codigo_uf')
+
+def nome_particao(uf):
+    """
+    Partição de unidade_saude de uma UF. As cargas vão direto para a partição: só ela
+    é tocada, e o RETURNING (xmax = 0) não é aceito na tabela particionada (só nas partições)
+    """
+    return f"unidade_saude_uf_{int(uf)}"
 
 def formatar_valor(valor):
     """Converte um valor Python para formato SQL"""
@@ -11,89 +48,155 @@ def formatar_valor(valor):
     else:
         return str(valor)
 
-def gerar_upsert_cnes(dados_json):
-    """Gera um único comando UPSERT otimizado para dados do CNES"""
-    
-    # Lista dos campos na ordem correta
-    campos = [
-        'codigo_cnes', 'numero_cnpj_entidade', 'nome_razao_social', 'nome_fantasia',
-        'natureza_organizacao_entidade', 'tipo_gestao', 'descricao_nivel_hierarquia',
-        'descricao_esfera_administrativa', 'codigo_tipo_unidade', 'codigo_cep_estabelecimento',
-        'endereco_estabelecimento', 'numero_estabelecimento', 'bairro_estabelecimento',
-        'numero_telefone_estabelecimento', 'latitude_estabelecimento_decimo_grau',
-        'longitude_estabelecimento_decimo_grau', 'endereco_email_estabelecimento',
-        'numero_cnpj', 'codigo_identificador_turno_atendimento', 'descricao_turno_atendimento',
-        'estabelecimento_faz_atendimento_ambulatorial_sus', 'codigo_estabelecimento_saude',
-        'codigo_uf', 'codigo_municipio', 'descricao_natureza_juridica_estabelecimento',
-        'codigo_motivo_desabilitacao_estabelecimento', 'estabelecimento_possui_centro_cirurgico',
-        'estabelecimento_possui_centro_obstetrico', 'estabelecimento_possui_centro_neonatal',
-        'estabelecimento_possui_atendimento_hospitalar', 'estabelecimento_possui_servico_apoio',
-        'estabelecimento_possui_atendimento_ambulatorial', 'codigo_atividade_ensino_unidade',
-        'codigo_natureza_organizacao_unidade', 'codigo_nivel_hierarquia_unidade',
-        'codigo_esfera_administrativa_unidade', 'data_atualizacao'
-    ]
-    
+def formatar_valor_copy(valor):
+    """Converte um valor Python para o formato texto do COPY (\\N para nulo)"""
+    if valor is None:
+        return "\\N"
+    texto = str(valor)
+    # Escapa barra invertida, tabulação e quebras de linha (str.replace é bem mais rápido que translate)
+    if '\\' in texto:
+        texto = texto.replace('\\', '\\\\')
+    if '\t' in texto or '\n' in texto or '\r' in texto:
+        texto = texto.replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return texto
+
+def formatar_linha_copy(registro, campos=CAMPOS):
+    """Converte um registro em uma linha do COPY (campos separados por tabulação)"""
+    return '\t'.join(formatar_valor_copy(registro.get(campo)) for campo in campos) + '\n'
+
+def formatar_registro(registro, campos=CAMPOS):
+    """Converte um registro na linha de VALUES correspondente"""
+    return f"  ({', '.join(formatar_valor(registro.get(campo)) for campo in campos)})"
+
+def formatar_registros(registros, campos=CAMPOS):
+    """
+    Linhas de VALUES de uma lista de registros: pelo codificador tipado (CodificadorCnes),
+    que converte o lote de uma vez e rejeita os registros inválidos, ou, sem pyarrow,
+    registro a registro com formatar_registro
+    """
+    from CodificadorCnes import informar_rejeitados, obter_codificador
+
+    codificador = obter_codificador(campos)
+    if codificador is None:
+        return [formatar_registro(registro, campos) for registro in registros]
+    linhas, rejeitados = codificador.valores_sql(registros)
+    informar_rejeitados(rejeitados)
+    return linhas
+
+def clausula_conflito(campos=CAMPOS, tabela='unidade_saude'):
+    """
+    Parte ON CONFLICT do UPSERT: só atualiza a linha existente se algum campo mudou,
+    evitando nova versão da tupla, WAL e trabalho de vacuum para linhas idênticas
+    """
     # Campos para UPDATE (todos exceto a chave primária)
-    campos_update = [campo for campo in campos if campo != 'codigo_cnes']
+    campos_update = [campo for campo in campos if campo not in CHAVE_PRIMARIA]
+    
+    # Monta a parte do UPDATE
+    updates = [f"  {campo} = EXCLUDED.{campo}" for campo in campos_update]
+    updates_str = ",\n".join(updates)
+    atuais_str = ", ".join(f"{tabela}.{campo}" for campo in campos_update)
+    novos_str = ", ".join(f"EXCLUDED.{campo}" for campo in campos_update)
     
-    # Coleta todos os VALUES
-    lista_valores = []
-    for registro in dados_json:
-        valores = []
-        for campo in campos:
-            valor = registro.get(campo)
-            valores.append(formatar_valor(valor))
-        lista_valores.append(f"  ({', '.join(valores)})")
+    return f"""ON CONFLICT ({', '.join(CHAVE_PRIMARIA)}) DO UPDATE SET
+{updates_str}
+WHERE ({atuais_str})
+  IS DISTINCT FROM ({novos_str})"""
+
+def montar_upsert(lista_valores, campos=CAMPOS, tabela='unidade_saude'):
+    """
+    Monta o comando UPSERT para uma lista de linhas de VALUES já formatadas.
+    O RETURNING devolve uma linha por registro inserido (true) ou atualizado (false);
+    registros sem alteração não aparecem.
+    """
     
     # Monta o comando SQL único
     campos_str = ", ".join(campos)
     valores_str = ",\n".join(lista_valores)
     
-    # Monta a parte do UPDATE
-    updates = [f"  {campo} = EXCLUDED.{campo}" for campo in campos_update]
-    updates_str = ",\n".join(updates)
-    
-    # Comando UPSERT único e compacto
-    sql = f"""INSERT INTO unidade_saude ({campos_str})
+    # Comando UPSERT único e compacto (xmax = 0 identifica as linhas recém-inseridas)
+    sql = f"""INSERT INTO {tabela} ({campos_str})
 VALUES
 {valores_str}
-ON CONFLICT (codigo_cnes) DO UPDATE SET
-{updates_str};"""
+{clausula_conflito(campos, tabela)}
+RETURNING (xmax = 0) AS inserido;"""
     
     return sql
 
+def gerar_upsert_cnes(dados_json, tabela='unidade_saude'):
+    """
+    Gera um único comando UPSERT otimizado para dados do CNES (vazio se não houver registros).
+    dados_json pode ser qualquer iterável de registros, inclusive um gerador.
+    """
+    lista_valores = formatar_registros(list(dados_json))
+    if not lista_valores:
+        return ""
+    return montar_upsert(lista_valores, tabela=tabela)
+
+def gerar_upserts_em_lotes(registros, tamanho_lote=TAMANHO_LOTE, tabela='unidade_saude'):
+    """
+    Consome os registros como fluxo e gera um comando UPSERT a cada tamanho_lote registros.
+    Produz tuplas (comando_sql, quantidade_de_registros, segundos_para_gerar); a memória
+    usada é a de um lote, independente do total.
+    """
+    lote = []
+    inicio = time.perf_counter()
+    for registro in registros:
+        lote.append(registro)
+        if len(lote) >= tamanho_lote:
+            lista_valores = formatar_registros(lote)
+            # Um lote só com registros rejeitados não gera comando
+            if lista_valores:
+                yield montar_upsert(lista_valores, tabela=tabela), len(lista_valores), time.perf_counter() - inicio
+            lote = []
+            inicio = time.perf_counter()
+    lista_valores = formatar_registros(lote) if lote else []
+    if lista_valores:
+        yield montar_upsert(lista_valores, tabela=tabela), len(lista_valores), time.perf_counter() - inicio
+
 def main():
-    # Configurações
-    arquivo_json = "downloads/cnes_resultados.json"
-    arquivo_sql = "downloads/cnes_upserts.sql"
-    
-    try:
-        # Carrega o arquivo JSON
-        print(f"Lendo arquivo: {arquivo_json}")
-        with open(arquivo_json, 'r', encoding='utf-8') as f:
-            dados = json.load(f)
+    from EstabelecimentosCsvDownload import UFS
+    for uf in UFS:
+        gerar_script_uf(uf)
 
-        total = len(dados)
-        print(f"Encontrados {total} registros")
+def gerar_script_uf(uf):
+    from BuscarCnesApiOficial import ler_resultados_jsonl
+    from EstabelecimentosCsvDownload import pasta_uf
 
-        comando_sql = gerar_upsert_cnes(dados)
+    # Configurações (arquivos na pasta de trabalho da UF)
+    arquivo_jsonl = os.path.join(pasta_uf(uf), "cnes_resultados.jsonl")
+    arquivo_checkpoint = os.path.join(pasta_uf(uf), "cnes_resultados.checkpoint")
+    arquivo_sql = os.path.join(pasta_uf(uf), "cnes_upserts.sql")
+    
+    try:
+        # Lê o arquivo JSON Lines como fluxo e grava um comando UPSERT por lote
+        print(f"Lendo arquivo: {arquivo_jsonl}")
+        if not os.path.exists(arquivo_jsonl):
+            raise FileNotFoundError(arquivo_jsonl)
+        total = 0
+        lotes = 0
+        inicio = time.perf_counter()
         with open(arquivo_sql, 'w', encoding='utf-8') as f:
-            f.write("-- Comando UPSERT otimizado para tabela unidade_saude\n")
-            f.write(f"-- Gerado automaticamente a partir dos dados do CNES (total de registros: {total})\n\n")
-            f.write(comando_sql)
-        print(f"Arquivo SQL criado: {arquivo_sql} ({total} registros)")
-        # Exclui o arquivo JSON após gerar o SQL
-        import os
-        try:
-            os.remove(arquivo_json)
-            print(f"Arquivo {arquivo_json} excluído com sucesso.")
-        except Exception as e:
-            print(f"Não foi possível excluir {arquivo_json}: {e}")
+            f.write("-- Comandos UPSERT para tabela unidade_saude\n")
+            f.write(f"-- Gerado automaticamente a partir dos dados do CNES, em lotes de até {TAMANHO_LOTE} registros\n\n")
+            for comando_sql, quantidade, segundos in gerar_upserts_em_lotes(ler_resultados_jsonl(arquivo_jsonl),
+                                                                          tabela=nome_particao(uf)):
+                lotes += 1
+                total += quantidade
+                f.write(comando_sql)
+                f.write(f"\n{MARCADOR_FIM_LOTE} {lotes} ({quantidade} registros)\n\n")
+                print(f"Lote {lotes}: {quantidade} registros gerados em {segundos:.3f}s")
+        print(f"Arquivo SQL criado: {arquivo_sql} ({total} registros em {lotes} lotes, "
+              f"{time.perf_counter() - inicio:.2f}s)")
+        # Exclui o JSONL e o checkpoint da busca após gerar o SQL
+        for arquivo in (arquivo_jsonl, arquivo_checkpoint):
+            try:
+                os.remove(arquivo)
+                print(f"Arquivo {arquivo} excluído com sucesso.")
+            except Exception as e:
+                print(f"Não foi possível excluir {arquivo}: {e}")
 
     except FileNotFoundError:
-        print(f"Erro: Arquivo {arquivo_json} não encontrado!")
-    except json.JSONDecodeError:
-        print("Erro: Arquivo JSON inválido!")
+        print(f"Erro: Arquivo {arquivo_jsonl} não encontrado!")
     except Exception as e:
         print(f"Erro inesperado: {e}")
 
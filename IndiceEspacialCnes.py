@@ -0,0 +1,449 @@
+import argparse
+import heapq
+import importlib
+import json
+import math
+import os
+import sys
+import time
+from datetime import datetime
+
+from EstabelecimentosCsvDownload import SIGLAS_UF, download_dir
+
+# Índice espacial dos estabelecimentos para consultas de leitura ("estabelecimento mais
+# próximo do tipo X", "estabelecimentos em um raio"), montado a partir do snapshot mais
+# recente de cada UF (SnapshotCnes), sem consultar unidade_saude. Os pontos viram
+# coordenadas 3D na esfera unitária (a distância em linha reta é monotônica na distância
+# sobre a superfície) e cada tipo de unidade, além de todos juntos, tem uma árvore KD
+# implícita: os pontos de cada nó são um trecho contíguo e só as caixas dos nós são
+# guardadas. Os pontos também ficam ordenados por município e tipo, para as consultas
+# restritas a um município. Tudo é gravado em um único arquivo binário, aberto com
+# mmap: abrir o índice só lê o cabeçalho.
+NOME_INDICE = 'indice_espacial_cnes.bin'
+CAMINHO_INDICE = os.environ.get('CNES_INDICE_ESPACIAL', os.path.join(download_dir, NOME_INDICE))
+
+# Pontos por folha da árvore: as folhas são comparadas de uma vez com numpy
+PONTOS_POR_FOLHA = 32
+
+RAIO_TERRA_KM = 6371.0088
+
+# Formato do arquivo: assinatura, tamanho do cabeçalho JSON (8 bytes, little-endian),
+# cabeçalho e os arrays, cada um alinhado a ALINHAMENTO bytes
+ASSINATURA = b'CNESIDX1'
+ALINHAMENTO = 64
+
+# Segmento com os pontos de todos os tipos
+TODOS_OS_TIPOS = -1
+
+# Chave de ordenação por município e tipo: municipio * MULTIPLICADOR_MUNICIPIO + tipo
+MULTIPLICADOR_MUNICIPIO = 1000
+
+COLUNAS_INDICE = ('codigo_cnes', 'latitude_estabelecimento_decimo_grau', 'longitude_estabelecimento_decimo_grau',
+                  'codigo_municipio', 'codigo_tipo_unidade')
+
+
+def coordenadas_3d(latitudes, longitudes):
+    """
+    Pontos (n, 3) na esfera unitária, em float32
+    """
+    import numpy as np
+
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_latitudes = np.cos(latitudes)
+    return np.column_stack((cos_latitudes * np.cos(longitudes), cos_latitudes * np.sin(longitudes),
+                            np.sin(latitudes))).astype(np.float32)
+
+
+def corda_para_km(corda):
+    return 2 * RAIO_TERRA_KM * math.asin(min(1.0, corda / 2))
+
+
+def km_para_corda(km):
+    return 2 * math.sin(min(math.pi, km / RAIO_TERRA_KM) / 2)
+
+
+def montar_arvore(coordenadas, indices, pontos_por_folha=PONTOS_POR_FOLHA):
+    """
+    Reordena indices (no lugar) como uma árvore KD implícita sobre coordenadas[indices]:
+    cada nó divide o seu trecho ao meio pelo eixo de maior extensão, até as folhas terem
+    no máximo pontos_por_folha pontos, todas na mesma profundidade. O nó i (em ordem de
+    heap, filhos 2i+1 e 2i+2) não guarda o trecho, que é refeito na consulta.
+    Retorna (profundidade, caixas), com caixas (nós, 2, 3): mínimo e máximo de cada nó.
+    """
+    import numpy as np
+
+    quantidade = len(indices)
+    profundidade = max(0, math.ceil(math.log2(quantidade / pontos_por_folha))) if quantidade else 0
+    trechos = [(0, quantidade)]
+    for _ in range(profundidade):
+        proximos = []
+        for inicio, fim in trechos:
+            meio = (inicio + fim) // 2
+            if meio > inicio:
+                trecho = indices[inicio:fim]
+                pontos = coordenadas[trecho]
+                eixo = int(np.argmax(pontos.max(axis=0) - pontos.min(axis=0)))
+                indices[inicio:fim] = trecho[np.argpartition(pontos[:, eixo], meio - inicio)]
+            proximos += [(inicio, meio), (meio, fim)]
+        trechos = proximos
+
+    primeira_folha = 2 ** profundidade - 1
+    caixas = np.empty((2 * primeira_folha + 1, 2, 3), dtype=np.float32)
+    # Folha vazia: caixa invertida, sempre a uma distância infinita
+    caixas[:, 0], caixas[:, 1] = np.inf, -np.inf
+    for posicao, (inicio, fim) in enumerate(trechos):
+        if fim > inicio:
+            pontos = coordenadas[indices[inicio:fim]]
+            caixas[primeira_folha + posicao] = pontos.min(axis=0), pontos.max(axis=0)
+    for nivel in range(profundidade - 1, -1, -1):
+        nos = np.arange(2 ** nivel - 1, 2 ** (nivel + 1) - 1)
+        caixas[nos, 0] = np.minimum(caixas[2 * nos + 1, 0], caixas[2 * nos + 2, 0])
+        caixas[nos, 1] = np.maximum(caixas[2 * nos + 1, 1], caixas[2 * nos + 2, 1])
+    return profundidade, caixas
+
+
+def construir_indice(codigos, latitudes, longitudes, municipios, tipos, caminho=CAMINHO_INDICE,
+                     pontos_por_folha=PONTOS_POR_FOLHA, origem=None):
+    """
+    Monta o índice dos estabelecimentos (arrays de mesmo tamanho) e o grava em caminho
+    de forma atômica. Pontos sem coordenada, fora da faixa ou em (0, 0) ficam de fora.
+    Retorna o resumo com as quantidades, o tamanho do arquivo e os tempos.
+    """
+    import numpy as np
+
+    inicio = time.perf_counter()
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    validos = (np.isfinite(latitudes) & np.isfinite(longitudes) & (np.abs(latitudes) <= 90)
+               & (np.abs(longitudes) <= 180) & ~((latitudes == 0) & (longitudes == 0)))
+    municipios = np.nan_to_num(np.asarray(municipios, dtype=np.float64)[validos]).astype(np.int32)
+    tipos = np.nan_to_num(np.asarray(tipos, dtype=np.float64)[validos]).astype(np.int32)
+    # Pontos base ordenados por município e tipo: as consultas por município são um trecho
+    chaves = municipios.astype(np.int64) * MULTIPLICADOR_MUNICIPIO + tipos
+    ordem = np.argsort(chaves, kind='stable')
+    base = {
+        'codigos': np.asarray(codigos)[validos][ordem].astype(np.int32),
+        'latitudes': latitudes[validos][ordem].astype(np.float32),
+        'longitudes': longitudes[validos][ordem].astype(np.float32),
+        'municipios': municipios[ordem],
+        'tipos': tipos[ordem].astype(np.int16),
+        'chaves': chaves[ordem],
+    }
+    base['coordenadas'] = coordenadas_3d(base['latitudes'], base['longitudes'])
+
+    # Uma árvore por tipo e uma com todos; os trechos de pontos e de caixas vão um após o outro
+    segmentos = {}
+    partes_pontos, partes_caixas = [], []
+    inicio_pontos = inicio_caixas = 0
+    valores_tipo = np.unique(base['tipos']).tolist()
+    for tipo in [TODOS_OS_TIPOS] + valores_tipo:
+        indices = (np.arange(len(base['tipos']), dtype=np.int32) if tipo == TODOS_OS_TIPOS
+                   else np.flatnonzero(base['tipos'] == tipo).astype(np.int32))
+        profundidade, caixas = montar_arvore(base['coordenadas'], indices, pontos_por_folha)
+        segmentos[str(tipo)] = [inicio_pontos, len(indices), profundidade, inicio_caixas]
+        partes_pontos.append(indices)
+        partes_caixas.append(caixas)
+        inicio_pontos += len(indices)
+        inicio_caixas += len(caixas)
+    arrays = dict(base, pontos=np.concatenate(partes_pontos), caixas=np.concatenate(partes_caixas))
+    segundos_montagem = time.perf_counter() - inicio
+
+    cabecalho = {'versao': 1, 'gerado_em': datetime.now().isoformat(timespec='seconds'),
+                 'registros': len(base['codigos']), 'descartados': int(np.count_nonzero(~validos)),
+                 'pontos_por_folha': pontos_por_folha, 'segmentos': segmentos, 'origem': origem or [], 'arrays': {}}
+    deslocamento = 0
+    for nome, array in arrays.items():
+        cabecalho['arrays'][nome] = [array.dtype.str, list(array.shape), deslocamento]
+        deslocamento += -(-array.nbytes // ALINHAMENTO) * ALINHAMENTO
+    texto_cabecalho = json.dumps(cabecalho).encode('utf-8')
+    # Os arrays começam em uma posição alinhada depois do cabeçalho
+    inicio_dados = -(-(len(ASSINATURA) + 8 + len(texto_cabecalho)) // ALINHAMENTO) * ALINHAMENTO
+
+    os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+    temporario = f'{caminho}.{os.getpid()}.tmp'
+    with open(temporario, 'wb') as f:
+        f.write(ASSINATURA)
+        f.write(len(texto_cabecalho).to_bytes(8, 'little'))
+        f.write(texto_cabecalho)
+        for nome, array in arrays.items():
+            f.seek(inicio_dados + cabecalho['arrays'][nome][2])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(inicio_dados + deslocamento)
+    os.replace(temporario, caminho)
+    return {'registros': cabecalho['registros'], 'descartados': cabecalho['descartados'],
+            'tipos': len(valores_tipo), 'bytes': os.path.getsize(caminho),
+            'montagem_segundos': round(segundos_montagem, 3), 'caminho': caminho}
+
+
+def ler_pontos_snapshots(ufs):
+    """
+    Colunas do índice no snapshot mais recente de cada UF (as que não têm snapshot são
+    puladas). Retorna (tabela Arrow, caminhos dos snapshots lidos).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from SnapshotCnes import listar_snapshots
+
+    tabelas, caminhos = [], []
+    for uf in ufs:
+        snapshots = listar_snapshots(uf)
+        if not snapshots:
+            print(f"⚠️ {SIGLAS_UF[uf]}: nenhum snapshot, UF fora do índice espacial")
+            continue
+        tabelas.append(pq.read_table(snapshots[-1], columns=list(COLUNAS_INDICE)))
+        caminhos.append(snapshots[-1])
+    if not tabelas:
+        raise Exception("Nenhuma UF com snapshot para montar o índice espacial")
+    return pa.concat_tables(tabelas), caminhos
+
+
+def construir_indice_ufs(ufs, caminho=CAMINHO_INDICE):
+    """
+    Monta o índice espacial com os estabelecimentos dos snapshots das UFs
+    """
+    tabela, caminhos = ler_pontos_snapshots(ufs)
+    colunas = [tabela[coluna].to_numpy(zero_copy_only=False) for coluna in COLUNAS_INDICE]
+    resumo = construir_indice(*colunas, caminho=caminho, origem=[os.path.basename(c) for c in caminhos])
+    print(f"🧭 Índice espacial com {resumo['registros']} estabelecimentos de {len(caminhos)} UFs "
+          f"({resumo['tipos']} tipos, {resumo['descartados']} sem coordenada válida, "
+          f"{resumo['bytes'] / 1024 / 1024:.1f} MB) em {resumo['montagem_segundos']}s: {caminho}")
+    return resumo
+
+
+class IndiceEspacial:
+    """
+    Índice gravado por construir_indice, aberto com mmap (ver abrir_indice).
+    mais_proximos e no_raio devolvem listas de dicionários com codigo_cnes, distancia_km,
+    latitude, longitude, codigo_tipo_unidade e codigo_municipio, da menor distância
+    para a maior.
+    """
+
+    def __init__(self, caminho=CAMINHO_INDICE):
+        import numpy as np
+
+        with open(caminho, 'rb') as f:
+            if f.read(len(ASSINATURA)) != ASSINATURA:
+                raise Exception(f"{caminho} não é um índice espacial do CNES")
+            tamanho = int.from_bytes(f.read(8), 'little')
+            self.cabecalho = json.loads(f.read(tamanho))
+        inicio_dados = -(-(len(ASSINATURA) + 8 + tamanho) // ALINHAMENTO) * ALINHAMENTO
+        self._mapa = np.memmap(caminho, dtype=np.uint8, mode='r')
+        arrays = {nome: np.ndarray(tuple(forma), dtype=np.dtype(tipo), buffer=self._mapa,
+                                   offset=inicio_dados + deslocamento)
+                  for nome, (tipo, forma, deslocamento) in self.cabecalho['arrays'].items()}
+        self.caminho = caminho
+        self.codigos = arrays['codigos']
+        self.latitudes = arrays['latitudes']
+        self.longitudes = arrays['longitudes']
+        self.municipios = arrays['municipios']
+        self.tipos = arrays['tipos']
+        self.chaves = arrays['chaves']
+        self.coordenadas = arrays['coordenadas']
+        self.pontos = arrays['pontos']
+        self.caixas = arrays['caixas']
+        self.segmentos = {int(tipo): segmento for tipo, segmento in self.cabecalho['segmentos'].items()}
+
+    def __len__(self):
+        return self.cabecalho['registros']
+
+    def _resultado(self, indice, distancia2):
+        return {
+            'codigo_cnes': int(self.codigos[indice]),
+            'distancia_km': round(corda_para_km(math.sqrt(distancia2)), 3),
+            'latitude': round(float(self.latitudes[indice]), 6),
+            'longitude': round(float(self.longitudes[indice]), 6),
+            'codigo_tipo_unidade': int(self.tipos[indice]),
+            'codigo_municipio': int(self.municipios[indice]),
+        }
+
+    def _trecho_municipio(self, municipio, tipo):
+        """
+        Trecho dos pontos base do município (e do tipo, se informado)
+        """
+        import numpy as np
+
+        primeira = municipio * MULTIPLICADOR_MUNICIPIO + (0 if tipo is None else tipo)
+        ultima = municipio * MULTIPLICADOR_MUNICIPIO + (MULTIPLICADOR_MUNICIPIO - 1 if tipo is None else tipo)
+        inicio = int(np.searchsorted(self.chaves, primeira, side='left'))
+        fim = int(np.searchsorted(self.chaves, ultima, side='right'))
+        return inicio, fim
+
+    def _municipio(self, consulta, k, limite2, tipo, municipio):
+        """
+        Poucos pontos por município: comparação direta com o trecho, vetorizada
+        """
+        import numpy as np
+
+        inicio, fim = self._trecho_municipio(int(municipio), None if tipo is None else int(tipo))
+        diferencas = self.coordenadas[inicio:fim] - consulta
+        distancias2 = np.einsum('ij,ij->i', diferencas, diferencas)
+        dentro = np.flatnonzero(distancias2 <= limite2)
+        if k is not None and len(dentro) > k:
+            dentro = dentro[np.argpartition(distancias2[dentro], k - 1)[:k]]
+        return sorted(zip(distancias2[dentro].tolist(), (dentro + inicio).tolist()))
+
+    def _caixa(self, no, qx, qy, qz, maxima=False):
+        """
+        Distância ao quadrado do ponto até a caixa do nó; com maxima=True, também até o
+        ponto mais distante da caixa
+        """
+        (x0, y0, z0), (x1, y1, z1) = self.caixas[no].tolist()
+        dx = x0 - qx if qx < x0 else (qx - x1 if qx > x1 else 0.0)
+        dy = y0 - qy if qy < y0 else (qy - y1 if qy > y1 else 0.0)
+        dz = z0 - qz if qz < z0 else (qz - z1 if qz > z1 else 0.0)
+        if not maxima:
+            return dx * dx + dy * dy + dz * dz
+        ex, ey, ez = max(qx - x0, x1 - qx), max(qy - y0, y1 - qy), max(qz - z0, z1 - qz)
+        return dx * dx + dy * dy + dz * dz, ex * ex + ey * ey + ez * ez
+
+    def _buscar(self, latitude, longitude, k, limite2, tipo, municipio):
+        """
+        Até k pontos (todos com k=None) a uma distância em corda ao quadrado de no máximo
+        limite2, como [(distancia2, indice)] ordenados
+        """
+        import numpy as np
+
+        consulta = coordenadas_3d([latitude], [longitude])[0].astype(np.float64)
+        if municipio is not None:
+            return self._municipio(consulta, k, limite2, tipo, municipio)
+
+        segmento = self.segmentos.get(TODOS_OS_TIPOS if tipo is None else int(tipo))
+        if segmento is None or not segmento[1]:
+            return []
+        inicio_pontos, quantidade, profundidade, inicio_caixas = segmento
+        qx, qy, qz = consulta.tolist()
+        primeira_folha = 2 ** profundidade - 1
+        pontos, coordenadas = self.pontos[inicio_pontos:inicio_pontos + quantidade], self.coordenadas
+
+        if k is None:
+            # Raio: busca em profundidade; os nós com a caixa inteira dentro do raio entram
+            # sem comparação, os de fora são podados, e as folhas são filtradas com numpy
+            inteiros, parciais = [], []
+            pilha = [(0, 0, quantidade)]
+            while pilha:
+                no, inicio, fim = pilha.pop()
+                minima, maxima = self._caixa(inicio_caixas + no, qx, qy, qz, maxima=True)
+                if minima > limite2:
+                    continue
+                if maxima <= limite2:
+                    inteiros.append(pontos[inicio:fim])
+                elif no >= primeira_folha:
+                    parciais.append(pontos[inicio:fim])
+                else:
+                    meio = (inicio + fim) // 2
+                    for filho, inicio_filho, fim_filho in ((2 * no + 1, inicio, meio), (2 * no + 2, meio, fim)):
+                        if fim_filho > inicio_filho:
+                            pilha.append((filho, inicio_filho, fim_filho))
+            if not inteiros and not parciais:
+                return []
+            indices = np.concatenate(inteiros + parciais)
+            diferencas = coordenadas[indices] - consulta
+            distancias2 = np.einsum('ij,ij->i', diferencas, diferencas)
+            dentro = distancias2 <= limite2
+            indices, distancias2 = indices[dentro], distancias2[dentro]
+            ordem = np.argsort(distancias2, kind='stable')
+            return list(zip(distancias2[ordem].tolist(), indices[ordem].tolist()))
+
+        # k mais próximos: busca pelo melhor primeiro, com a fila de nós pela distância até
+        # a caixa; a cada folha, os melhores (heap de máximo, com a distância negativa) são
+        # atualizados com os pontos mais próximos que o pior deles
+        melhores = []
+        fila = [(0.0, 0, 0, quantidade)]
+        while fila:
+            distancia_caixa, no, inicio, fim = heapq.heappop(fila)
+            pior = -melhores[0][0] if len(melhores) == k else limite2
+            if distancia_caixa > pior:
+                break
+            if no >= primeira_folha:
+                indices = pontos[inicio:fim]
+                diferencas = coordenadas[indices] - consulta
+                distancias2 = np.einsum('ij,ij->i', diferencas, diferencas)
+                candidatos = np.flatnonzero(distancias2 <= pior)
+                for distancia2, indice in zip(distancias2[candidatos].tolist(), indices[candidatos].tolist()):
+                    if len(melhores) < k:
+                        heapq.heappush(melhores, (-distancia2, indice))
+                    elif distancia2 < -melhores[0][0]:
+                        heapq.heapreplace(melhores, (-distancia2, indice))
+                continue
+            meio = (inicio + fim) // 2
+            for filho, inicio_filho, fim_filho in ((2 * no + 1, inicio, meio), (2 * no + 2, meio, fim)):
+                if fim_filho > inicio_filho:
+                    minima = self._caixa(inicio_caixas + filho, qx, qy, qz)
+                    if minima <= pior:
+                        heapq.heappush(fila, (minima, filho, inicio_filho, fim_filho))
+        return sorted((-distancia2, indice) for distancia2, indice in melhores)
+
+    def mais_proximos(self, latitude, longitude, k=1, tipo=None, municipio=None, raio_maximo_km=None):
+        """
+        Os k estabelecimentos mais próximos do ponto, opcionalmente só de um tipo de
+        unidade, de um município e até raio_maximo_km
+        """
+        limite2 = math.inf if raio_maximo_km is None else km_para_corda(raio_maximo_km) ** 2
+        return [self._resultado(indice, distancia2)
+                for distancia2, indice in self._buscar(latitude, longitude, k, limite2, tipo, municipio)]
+
+    def no_raio(self, latitude, longitude, raio_km, tipo=None, municipio=None):
+        """
+        Todos os estabelecimentos a até raio_km do ponto
+        """
+        limite2 = km_para_corda(raio_km) ** 2
+        return [self._resultado(indice, distancia2)
+                for distancia2, indice in self._buscar(latitude, longitude, None, limite2, tipo, municipio)]
+
+
+def abrir_indice(caminho=CAMINHO_INDICE):
+    """
+    Abre o índice gravado: só o cabeçalho é lido; os arrays são páginas do arquivo
+    mapeadas em memória, compartilhadas entre os processos que abrem o mesmo índice
+    """
+    return IndiceEspacial(caminho)
+
+
+def main():
+    from EstabelecimentosCsvDownload import UFS, ler_ufs
+
+    parser = argparse.ArgumentParser(description='Índice espacial dos estabelecimentos do CNES')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    parser_construir = subparsers.add_parser('construir', help='Monta o índice a partir dos snapshots das UFs')
+    parser_construir.add_argument('--ufs', type=ler_ufs, default=UFS,
+                                  help='UFs do índice, ex.: "11,12", "RO,AC" ou "todas" (padrão: CNES_UFS)')
+    parser_construir.add_argument('--caminho', default=CAMINHO_INDICE)
+    parser_consultar = subparsers.add_parser('consultar', help='Estabelecimentos mais próximos de um ponto')
+    parser_consultar.add_argument('--latitude', type=float, required=True, help='Ex.: --latitude=-10.5')
+    parser_consultar.add_argument('--longitude', type=float, required=True, help='Ex.: --longitude=-63.0')
+    parser_consultar.add_argument('-k', type=int, default=5, help='Quantidade de estabelecimentos')
+    parser_consultar.add_argument('--raio', type=float, help='Todos os estabelecimentos até este raio (km)')
+    parser_consultar.add_argument('--tipo', type=int, help='codigo_tipo_unidade')
+    parser_consultar.add_argument('--municipio', type=int, help='codigo_municipio')
+    parser_consultar.add_argument('--caminho', default=CAMINHO_INDICE)
+    args = parser.parse_args()
+
+    if args.comando == 'construir':
+        try:
+            construir_indice_ufs(args.ufs, args.caminho)
+        except Exception as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        return
+
+    # numpy é carregado antes, para que o tempo de abertura meça só a leitura do índice
+    importlib.import_module('numpy')
+
+    inicio = time.perf_counter()
+    indice = abrir_indice(args.caminho)
+    segundos_abertura = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    if args.raio is not None:
+        resultados = indice.no_raio(args.latitude, args.longitude, args.raio, args.tipo, args.municipio)
+    else:
+        resultados = indice.mais_proximos(args.latitude, args.longitude, args.k, args.tipo, args.municipio)
+    segundos_consulta = time.perf_counter() - inicio
+    for resultado in resultados:
+        print(json.dumps(resultado, ensure_ascii=False))
+    print(f"🧭 {len(resultados)} estabelecimentos de {len(indice)} (índice aberto em {segundos_abertura * 1000:.2f} ms, "
+          f"consulta em {segundos_consulta * 1000:.3f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+
+# Relatório JSON da execução, gravado ao final de main.py e de cada etapa do ShardsCnes.py
+# (padrão: na pasta de downloads). CNES_RELATORIO define o arquivo (o DAG usa um por
+# tarefa, para enviar ao XCom)
+ARQUIVO_RELATORIO = os.environ.get('CNES_RELATORIO', '')
+NOME_RELATORIO_PADRAO = 'relatorio_execucao.json'
+
+# Se definido, as métricas também são exportadas neste arquivo no formato texto do
+# Prometheus (coletor textfile do node_exporter)
+ARQUIVO_PROMETHEUS = os.environ.get('CNES_PROMETHEUS_TEXTFILE', '')
+
+# Intervalo (segundos) das linhas de progresso impressas durante a execução; 0 desliga
+INTERVALO_PROGRESSO = float(os.environ.get('CNES_INTERVALO_PROGRESSO', '15'))
+
+# Limites (segundos) dos intervalos do histograma de latência das requisições
+LIMITES_LATENCIA = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def pico_rss_mb():
+    # ru_maxrss é em KB no Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _chave(nome, rotulos):
+    return nome, tuple(sorted((chave, str(valor)) for chave, valor in rotulos.items()))
+
+
+class MetricasExecucao:
+    """
+    Métricas de uma execução (um processo): etapas com duração, linhas de entrada e
+    saída e pico de memória; contadores com rótulos (ex.: respostas HTTP por status,
+    bytes baixados, linhas afetadas no banco) e histogramas (ex.: latência das
+    requisições). Pode ser usado por várias threads. Um resumo é impresso a cada
+    'intervalo' segundos enquanto o progresso estiver ligado, e relatorio() devolve
+    tudo em um dicionário serializável em JSON.
+    """
+
+    def __init__(self):
+        self.inicio = time.time()
+        self.etapas = []
+        self.contadores = {}
+        self.histogramas = {}
+        self.etapas_em_andamento = []
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self._thread_progresso = None
+
+    @contextlib.contextmanager
+    def etapa(self, nome, **rotulos):
+        """
+        Mede uma etapa. O dicionário devolvido pode receber 'entrada' e 'saida'
+        (quantidade de linhas/registros) e outros campos, que vão para o relatório.
+        """
+        registro = {'etapa': nome, **rotulos, 'inicio': datetime.now().isoformat(timespec='seconds'),
+                    'entrada': None, 'saida': None}
+        inicio = time.perf_counter()
+        with self._lock:
+            self.etapas_em_andamento.append((registro, inicio))
+        try:
+            yield registro
+            registro['status'] = 'ok'
+        except BaseException:
+            registro['status'] = 'erro'
+            raise
+        finally:
+            registro['segundos'] = round(time.perf_counter() - inicio, 3)
+            registro['pico_rss_mb'] = pico_rss_mb()
+            with self._lock:
+                self.etapas_em_andamento.remove((registro, inicio))
+                self.etapas.append(registro)
+            quantidades = ''.join(f", {rotulo} {registro[campo]}" for campo, rotulo in
+                                  (('entrada', 'entrada'), ('saida', 'saída')) if registro[campo] is not None)
+            print(f"📊 {self._descrever(registro)}: {registro['segundos']}s{quantidades}, "
+                  f"pico de memória {registro['pico_rss_mb']} MB", flush=True)
+
+    def registrar_etapa(self, nome, segundos, **campos):
+        """
+        Registra uma etapa medida por outro meio (ex.: tempo acumulado da thread de carga)
+        """
+        with self._lock:
+            self.etapas.append({'etapa': nome, **campos, 'segundos': round(segundos, 3), 'status': 'ok'})
+
+    def contar(self, nome, quantidade=1, **rotulos):
+        chave = _chave(nome, rotulos)
+        with self._lock:
+            self.contadores[chave] = self.contadores.get(chave, 0) + quantidade
+
+    def observar(self, nome, valor, limites=LIMITES_LATENCIA, **rotulos):
+        chave = _chave(nome, rotulos)
+        with self._lock:
+            histograma = self.histogramas.get(chave)
+            if histograma is None:
+                histograma = self.histogramas[chave] = {'limites': list(limites), 'contagens': [0] * len(limites),
+                                                        'soma': 0.0, 'quantidade': 0}
+            for indice, limite in enumerate(histograma['limites']):
+                if valor <= limite:
+                    histograma['contagens'][indice] += 1
+            histograma['soma'] += valor
+            histograma['quantidade'] += 1
+
+    @staticmethod
+    def _descrever(registro):
+        rotulos = [str(valor) for chave, valor in registro.items()
+                   if chave not in ('etapa', 'inicio', 'entrada', 'saida', 'status', 'segundos', 'pico_rss_mb')]
+        return f"{registro['etapa']} ({', '.join(rotulos)})" if rotulos else registro['etapa']
+
+    def linha_progresso(self):
+        """
+        Resumo de uma linha: etapas em andamento e total de cada contador
+        """
+        agora = time.perf_counter()
+        with self._lock:
+            etapas = [f"{self._descrever(registro)} há {agora - inicio:.0f}s"
+                      for registro, inicio in self.etapas_em_andamento]
+            totais = {}
+            for (nome, rotulos), valor in self.contadores.items():
+                descricao = nome + (f"[{','.join(v for _, v in rotulos)}]" if rotulos else '')
+                totais[descricao] = valor
+        contadores = ', '.join(f"{nome}={valor}" for nome, valor in sorted(totais.items()))
+        return f"📈 {' > '.join(etapas) or 'sem etapa'} | {contadores or 'sem contadores'} | RSS {pico_rss_mb()} MB"
+
+    def iniciar_progresso(self, intervalo=INTERVALO_PROGRESSO):
+        """
+        Imprime linha_progresso() a cada intervalo segundos, em uma thread, até parar_progresso()
+        """
+        if intervalo <= 0 or self._thread_progresso is not None:
+            return
+
+        def imprimir():
+            while not self._parar.wait(intervalo):
+                print(self.linha_progresso(), flush=True)
+
+        self._parar.clear()
+        self._thread_progresso = threading.Thread(target=imprimir, name='progresso-cnes', daemon=True)
+        self._thread_progresso.start()
+
+    def parar_progresso(self):
+        if self._thread_progresso is not None:
+            self._parar.set()
+            self._thread_progresso.join()
+            self._thread_progresso = None
+
+    def relatorio(self):
+        with self._lock:
+            return {
+                'inicio': datetime.fromtimestamp(self.inicio).isoformat(timespec='seconds'),
+                'segundos': round(time.time() - self.inicio, 3),
+                'pico_rss_mb': pico_rss_mb(),
+                'etapas': list(self.etapas),
+                'contadores': [{'nome': nome, 'rotulos': dict(rotulos), 'valor': valor}
+                               for (nome, rotulos), valor in sorted(self.contadores.items())],
+                'histogramas': [{'nome': nome, 'rotulos': dict(rotulos), **histograma}
+                                for (nome, rotulos), histograma in sorted(self.histogramas.items())],
+            }
+
+    def gravar(self, nome_padrao=NOME_RELATORIO_PADRAO, caminho_prometheus=ARQUIVO_PROMETHEUS, **campos):
+        """
+        Grava o relatório (com os campos extras informados) em JSON, no arquivo de
+        CNES_RELATORIO ou em nome_padrao na pasta de downloads, e, se houver caminho,
+        no formato do Prometheus. Retorna o relatório.
+        """
+        from EstabelecimentosCsvDownload import download_dir
+        caminho = ARQUIVO_RELATORIO or os.path.join(download_dir, nome_padrao)
+        relatorio = dict(self.relatorio(), **campos)
+        gravar_arquivo(caminho, json.dumps(relatorio, ensure_ascii=False, indent=2))
+        print(f"📝 Relatório da execução: {caminho}", flush=True)
+        if caminho_prometheus:
+            gravar_arquivo(caminho_prometheus, formatar_prometheus(relatorio))
+        return relatorio
+
+
+def gravar_arquivo(caminho, conteudo):
+    """
+    Grava de forma atômica (arquivo temporário + rename): o coletor do Prometheus e o
+    DAG nunca leem um arquivo pela metade
+    """
+    pasta = os.path.dirname(caminho)
+    if pasta:
+        os.makedirs(pasta, exist_ok=True)
+    temporario = f'{caminho}.{os.getpid()}.tmp'
+    with open(temporario, 'w', encoding='utf-8') as f:
+        f.write(conteudo)
+    os.replace(temporario, caminho)
+
+
+def _escapar_rotulo(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _rotulos_prometheus(rotulos):
+    if not rotulos:
+        return ''
+    valores = ','.join(f'{chave}="{_escapar_rotulo(valor)}"' for chave, valor in sorted(rotulos.items()))
+    return '{' + valores + '}'
+
+
+def formatar_prometheus(relatorio, prefixo='cnes'):
+    """
+    Converte um relatório no formato texto de exposição do Prometheus
+    """
+    linhas = [f'# TYPE {prefixo}_execucao_segundos gauge', f'{prefixo}_execucao_segundos {relatorio["segundos"]}',
+              f'# TYPE {prefixo}_pico_rss_bytes gauge',
+              f'{prefixo}_pico_rss_bytes {int(relatorio["pico_rss_mb"] * 1024 * 1024)}',
+              f'# TYPE {prefixo}_ultima_execucao_timestamp_segundos gauge',
+              f'{prefixo}_ultima_execucao_timestamp_segundos {int(time.time())}',
+              f'# TYPE {prefixo}_etapa_segundos gauge']
+    # Etapas com os mesmos rótulos (ex.: a mesma etapa em vários shards) viram uma série só, somada
+    segundos_por_etapa = {}
+    for etapa in relatorio['etapas']:
+        # Só os campos de texto (etapa, uf, status...) viram rótulos; os numéricos mudam a cada execução
+        rotulos = {chave: valor for chave, valor in etapa.items() if chave != 'inicio' and isinstance(valor, str)}
+        chave = _rotulos_prometheus(rotulos)
+        segundos_por_etapa[chave] = segundos_por_etapa.get(chave, 0) + etapa['segundos']
+    for rotulos, segundos in sorted(segundos_por_etapa.items()):
+        linhas.append(f'{prefixo}_etapa_segundos{rotulos} {round(segundos, 3)}')
+    nomes = set()
+    for contador in relatorio['contadores']:
+        nome = f'{prefixo}_{contador["nome"]}_total'
+        if nome not in nomes:
+            nomes.add(nome)
+            linhas.append(f'# TYPE {nome} counter')
+        linhas.append(f'{nome}{_rotulos_prometheus(contador["rotulos"])} {contador["valor"]}')
+    for histograma in relatorio['histogramas']:
+        nome = f'{prefixo}_{histograma["nome"]}'
+        if nome not in nomes:
+            nomes.add(nome)
+            linhas.append(f'# TYPE {nome} histogram')
+        for limite, contagem in zip(histograma['limites'], histograma['contagens']):
+            rotulos = _rotulos_prometheus(dict(histograma['rotulos'], le=limite))
+            linhas.append(f'{nome}_bucket{rotulos} {contagem}')
+        rotulos = _rotulos_prometheus(dict(histograma['rotulos'], le='+Inf'))
+        linhas.append(f'{nome}_bucket{rotulos} {histograma["quantidade"]}')
+        linhas.append(f'{nome}_sum{_rotulos_prometheus(histograma["rotulos"])} {histograma["soma"]}')
+        linhas.append(f'{nome}_count{_rotulos_prometheus(histograma["rotulos"])} {histograma["quantidade"]}')
+    return '\n'.join(linhas) + '\n'
+
+
+def consolidar_relatorios(relatorios):
+    """
+    Junta relatórios de vários processos (ex.: as tarefas de um DAG) em um só:
+    etapas concatenadas, contadores e histogramas somados, maior pico de memória e
+    tempo total do início do primeiro ao fim do último.
+    """
+    contadores = {}
+    histogramas = {}
+    etapas = []
+    inicio = fim = None
+    for relatorio in relatorios:
+        etapas.extend(relatorio['etapas'])
+        comeco = datetime.fromisoformat(relatorio['inicio']).timestamp()
+        inicio = comeco if inicio is None else min(inicio, comeco)
+        fim = max(fim or 0, comeco + relatorio['segundos'])
+        for contador in relatorio['contadores']:
+            chave = _chave(contador['nome'], contador['rotulos'])
+            contadores[chave] = contadores.get(chave, 0) + contador['valor']
+        for histograma in relatorio['histogramas']:
+            chave = _chave(histograma['nome'], histograma['rotulos'])
+            atual = histogramas.get(chave)
+            if atual is None:
+                histogramas[chave] = {campo: histograma[campo] for campo in ('limites', 'soma', 'quantidade')}
+                histogramas[chave]['contagens'] = list(histograma['contagens'])
+                continue
+            atual['contagens'] = [a + b for a, b in zip(atual['contagens'], histograma['contagens'])]
+            atual['soma'] += histograma['soma']
+            atual['quantidade'] += histograma['quantidade']
+    return {
+        'inicio': datetime.fromtimestamp(inicio or time.time()).isoformat(timespec='seconds'),
+        'segundos': round((fim or 0) - (inicio or 0), 3),
+        'pico_rss_mb': max((relatorio['pico_rss_mb'] for relatorio in relatorios), default=0),
+        'processos': len(relatorios),
+        'etapas': etapas,
+        'contadores': [{'nome': nome, 'rotulos': dict(rotulos), 'valor': valor}
+                       for (nome, rotulos), valor in sorted(contadores.items())],
+        'histogramas': [{'nome': nome, 'rotulos': dict(rotulos), **histograma}
+                        for (nome, rotulos), histograma in sorted(histogramas.items())],
+    }
+
+
+# Métricas do processo atual, usadas por todos os módulos da automação
+metricas = MetricasExecucao()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Relatórios de execução da automação CNES')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+    parser_consolidar = subparsers.add_parser('consolidar', help='Junta os relatórios de vários processos')
+    parser_consolidar.add_argument('saida', help='Arquivo JSON do relatório consolidado')
+    parser_consolidar.add_argument('relatorios', nargs='+')
+    parser_consolidar.add_argument('--prometheus', default=ARQUIVO_PROMETHEUS,
+                                   help='Também exporta o consolidado no formato do Prometheus')
+    args = parser.parse_args()
+
+    relatorios = []
+    for caminho in args.relatorios:
+        try:
+            with open(caminho, 'r', encoding='utf-8') as f:
+                relatorios.append(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            print(f"⚠️ Relatório ignorado ({caminho}): {e}")
+    if not relatorios:
+        print("❌ Nenhum relatório válido para consolidar")
+        sys.exit(1)
+    consolidado = consolidar_relatorios(relatorios)
+    gravar_arquivo(args.saida, json.dumps(consolidado, ensure_ascii=False, indent=2))
+    if args.prometheus:
+        gravar_arquivo(args.prometheus, formatar_prometheus(consolidado))
+    print(f"📝 {len(relatorios)} relatórios consolidados em {args.saida}")
+
+
+if __name__ == "__main__":
+    main()
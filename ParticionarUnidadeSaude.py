@@ -0,0 +1,27 @@
+import sys
+
+from UptadeBancoDeDados import conectar, particionar_unidade_saude
+
+
+def main():
+    """
+    Migração única: converte unidade_saude em tabela particionada por codigo_uf
+    (ver particionar_unidade_saude). Pode ser executada de novo sem efeito.
+    """
+    conn = None
+    try:
+        print("Conectando ao PostgreSQL...")
+        conn = conectar()
+        if particionar_unidade_saude(conn):
+            print("✅ unidade_saude particionada por codigo_uf. Depois de conferir os dados, "
+                  "a tabela unidade_saude_nao_particionada pode ser removida.")
+    except Exception as e:
+        print(f"❌ Erro: {e}")
+        sys.exit(1)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
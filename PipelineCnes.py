@@ -0,0 +1,522 @@
+import contextlib
+import os
+import queue
+import threading
+import time
+
+from EstabelecimentosCsvDownload import (
+    UF_PADRAO, SIGLAS_UF, pasta_uf, caminho_codigos_uf, iterar_codigos_uf
+)
+from BuscarCnesApiOficial import consultar_lista_cnes_api, ler_resultados_jsonl
+from GerarScriptSQLCnes import TAMANHO_LOTE, MARCADOR_FIM_LOTE, gerar_upserts_em_lotes, nome_particao
+from UptadeBancoDeDados import (
+    MODO_CARGA, CONEXOES_CARGA, CarregadorParalelo, conectar, carregar_em_paralelo, carregar_lotes_sql,
+    carregar_via_copy, garantir_particao_uf
+)
+from MetricasCnes import metricas
+
+# Com MATERIALIZAR=1 cada etapa também grava seu arquivo intermediário na pasta da UF
+# (cnes_ro.csv, cnes_resultados.jsonl com checkpoint e cnes_upserts.sql), como nos scripts isolados
+MATERIALIZAR = os.environ.get('CNES_MATERIALIZAR', '0') == '1'
+
+# Modo em fluxo: a carga no banco acontece enquanto a busca na API continua.
+# TAMANHO_FILA limita os registros em memória entre as duas etapas (quando a fila
+# enche, a busca espera) e ESPERA_MAXIMA_LOTE é quanto um lote incompleto aguarda
+# antes de ir para o banco mesmo assim
+EM_FLUXO = os.environ.get('CNES_EM_FLUXO', '1') == '1'
+TAMANHO_FILA = int(os.environ.get('CNES_TAMANHO_FILA', '5000'))
+ESPERA_MAXIMA_LOTE = float(os.environ.get('CNES_ESPERA_MAXIMA_LOTE', '2'))
+
+FIM_DA_FILA = object()
+
+
+def filtrar_codigos(uf=UF_PADRAO, materializar=MATERIALIZAR):
+    """
+    Etapa 1: gerador dos códigos CNES da UF lidos do dump baixado.
+    Com materializar, também grava os códigos no arquivo da UF (ex.: cnes_ro.csv).
+    Para várias UFs em uma só leitura do dump, ver separar_codigos_por_uf.
+    """
+    if not materializar:
+        yield from iterar_codigos_uf(uf)
+        return
+    with open(caminho_codigos_uf(uf), 'w', encoding='utf-8') as f:
+        for indice, cnes in enumerate(iterar_codigos_uf(uf)):
+            f.write(f',{cnes}' if indice else str(cnes))
+            yield cnes
+
+
+def consultar_registros(codigos, materializar=MATERIALIZAR, resumo=None, uf=UF_PADRAO,
+                        tamanho_fila=TAMANHO_FILA, **opcoes):
+    """
+    Etapa 2: gerador dos registros da API que mudaram desde a última carga da UF.
+    Em memória por padrão: a busca roda em uma thread própria e cada registro é entregue
+    assim que chega, por uma fila de no máximo tamanho_fila registros (cheia, a busca
+    espera quem consome, sem travar o loop de eventos: ver consultar_lista_cnes_api). Com materializar, a busca passa inteira pelo
+    cnes_resultados.jsonl (com checkpoint, retomável após interrupção), que depois é lido
+    em fluxo. As opções são repassadas a consultar_lista_cnes_api; se resumo for um
+    dicionário, recebe as contagens da busca quando ela termina.
+    """
+    lista_codigos = [str(codigo) for codigo in codigos]
+    if materializar:
+        contagem = consultar_lista_cnes_api(lista_codigos, uf=uf, **opcoes)
+        if resumo is not None:
+            resumo.update(contagem)
+        yield from ler_resultados_jsonl(os.path.join(pasta_uf(uf), 'cnes_resultados.jsonl'))
+        return
+
+    fila = queue.Queue(maxsize=tamanho_fila)
+    busca = {'erro': None, 'interrompida': False}
+
+    def entregar(registro):
+        while True:
+            if busca['interrompida']:
+                raise RuntimeError('Consumo dos registros interrompido')
+            try:
+                fila.put(registro, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def buscar():
+        try:
+            contagem = consultar_lista_cnes_api(lista_codigos, uf=uf, ao_registro=entregar, **opcoes)
+            if resumo is not None:
+                resumo.update(contagem)
+        except BaseException as e:
+            busca['erro'] = e
+        finally:
+            while not busca['interrompida']:
+                try:
+                    fila.put(FIM_DA_FILA, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    thread = threading.Thread(target=buscar, name='busca-cnes', daemon=True)
+    thread.start()
+    try:
+        while True:
+            registro = fila.get()
+            if registro is FIM_DA_FILA:
+                break
+            yield registro
+    finally:
+        busca['interrompida'] = True
+        # Libera a busca se ela estiver esperando espaço na fila
+        with contextlib.suppress(queue.Empty):
+            while True:
+                fila.get_nowait()
+        thread.join()
+    if busca['erro'] is not None:
+        raise busca['erro']
+
+
+def gerar_lotes_sql(registros, tamanho_lote=TAMANHO_LOTE, materializar=MATERIALIZAR, uf=UF_PADRAO):
+    """
+    Etapa 3 (modo de carga 'sql'): gerador de (comando UPSERT, quantidade) por lote.
+    Com materializar, também grava os comandos em cnes_upserts.sql na pasta da UF.
+    """
+    arquivo = None
+    if materializar:
+        arquivo = open(os.path.join(pasta_uf(uf), 'cnes_upserts.sql'), 'w', encoding='utf-8')
+    try:
+        lotes = gerar_upserts_em_lotes(registros, tamanho_lote, nome_particao(uf))
+        for numero, (comando, quantidade, _) in enumerate(lotes, 1):
+            if arquivo:
+                arquivo.write(f"{comando}\n{MARCADOR_FIM_LOTE} {numero} ({quantidade} registros)\n\n")
+            yield comando, quantidade
+    finally:
+        if arquivo:
+            arquivo.close()
+
+
+def carregar_registros(registros, modo=MODO_CARGA, conn=None, tamanho_lote=TAMANHO_LOTE,
+                       materializar=MATERIALIZAR, uf=UF_PADRAO, conexoes=CONEXOES_CARGA):
+    """
+    Etapa 4: carrega os registros da UF na sua partição de unidade_saude (criada se
+    ainda não existir), via COPY + merge (modo 'copy') ou UPSERTs em lotes (modo 'sql').
+    Usa a conexão informada; sem ela, com conexoes > 1, carrega em paralelo com uma
+    transação por lote (ver CarregadorParalelo), senão abre uma conexão nova.
+    Retorna {'inseridos', 'atualizados', 'inalterados'}.
+    """
+    nova_conexao = conn is None
+    if nova_conexao:
+        conn = conectar()
+    try:
+        garantir_particao_uf(conn, uf)
+        # O script SQL materializado é gerado em ordem, pela carga em uma conexão só
+        if nova_conexao and conexoes > 1 and not (materializar and modo == 'sql'):
+            conn.close()
+            conn = None
+            return carregar_em_paralelo(registros, modo, conexoes, tamanho_lote, nome_particao(uf))
+        if modo == 'copy':
+            return carregar_via_copy(conn, registros, tabela=nome_particao(uf))
+        lotes, falhas, resumo = carregar_lotes_sql(conn, gerar_lotes_sql(registros, tamanho_lote, materializar, uf))
+        if falhas:
+            raise Exception(f"{falhas} de {lotes} lotes falharam")
+        return resumo
+    finally:
+        if nova_conexao and conn is not None:
+            conn.close()
+
+
+def remover_intermediarios(uf=UF_PADRAO):
+    """
+    Exclui os arquivos intermediários da busca e da carga (modo materializado) da UF
+    depois de uma carga bem-sucedida, para que a próxima execução não retome uma busca antiga
+    """
+    for nome in ('cnes_resultados.jsonl', 'cnes_resultados.checkpoint', 'cnes_upserts.sql'):
+        caminho = os.path.join(pasta_uf(uf), nome)
+        if os.path.exists(caminho):
+            os.remove(caminho)
+
+
+def medir_espera(registros, espera):
+    """
+    Repassa os registros somando em espera['segundos'] o tempo gasto esperando cada um
+    (o da etapa que os produz, quando ela corre junto com quem os consome)
+    """
+    iterador = iter(registros)
+    while True:
+        inicio = time.perf_counter()
+        try:
+            registro = next(iterador)
+        except StopIteration:
+            return
+        finally:
+            espera['segundos'] += time.perf_counter() - inicio
+        yield registro
+
+
+def executar_pipeline(uf=UF_PADRAO, codigos=None, materializar=MATERIALIZAR, modo_carga=MODO_CARGA, conn=None,
+                      coletor=None, **opcoes_busca):
+    """
+    Executa filtragem, busca na API e carga no banco no mesmo processo, passando os
+    registros de uma etapa para a outra sem arquivos intermediários (a menos que
+    materializar): a carga consome os registros à medida que a busca os entrega. Se
+    codigos for informado, a filtragem do dump é pulada; se conn for informada, a carga
+    usa essa conexão; se coletor for informado (ver SnapshotCnes), recebe cada registro
+    obtido da API, alterado ou não.
+    Retorna um dicionário com o resumo de cada etapa e o tempo gasto em cada uma
+    (cada etapa também é registrada nas métricas da execução, ver MetricasCnes).
+    """
+    tempos = {}
+    sigla = SIGLAS_UF[uf]
+
+    with metricas.etapa('filtrar_estabelecimentos', uf=sigla) as etapa:
+        if codigos is None:
+            codigos = list(filtrar_codigos(uf, materializar))
+        etapa['saida'] = len(codigos)
+    tempos['filtrar_estabelecimentos'] = etapa['segundos']
+
+    resumo_busca = {}
+    if coletor is not None:
+        opcoes_busca['ao_consultado'] = coletor.adicionar
+    # Busca e carga correm juntas: o tempo da busca é o que a carga passou esperando
+    # registros, e o da carga é o restante
+    espera = {'segundos': 0.0}
+    with metricas.etapa('busca_e_carga', uf=sigla) as etapa:
+        etapa['entrada'] = len(codigos)
+        registros = medir_espera(consultar_registros(codigos, materializar, resumo_busca, uf, **opcoes_busca),
+                                 espera)
+        resumo_carga = carregar_registros(registros, modo_carga, conn, materializar=materializar, uf=uf)
+        etapa['saida'] = resumo_carga['inseridos'] + resumo_carga['atualizados']
+    tempos['busca_e_carga'] = etapa['segundos']
+    tempos['consultar_lista_cnes_api'] = espera['segundos']
+    tempos['carga_banco'] = max(0.0, etapa['segundos'] - espera['segundos'])
+    metricas.registrar_etapa('consultar_lista_cnes_api', tempos['consultar_lista_cnes_api'], uf=sigla,
+                             entrada=len(codigos), saida=resumo_busca['alterados'])
+    metricas.registrar_etapa('carga_banco', tempos['carga_banco'], uf=sigla,
+                             entrada=resumo_busca['alterados'], saida=etapa['saida'])
+    if materializar:
+        remover_intermediarios(uf)
+
+    return {'codigos': len(codigos), 'busca': resumo_busca, 'carga': resumo_carga,
+            'tempos': {etapa: round(segundos, 3) for etapa, segundos in tempos.items()}}
+
+
+class CarregadorEmFluxo:
+    """
+    Consumidor, em uma thread própria, dos registros que a busca na API entrega por
+    enviar(registro): junta-os em lotes de até tamanho_lote (ou o que chegou em
+    espera_maxima segundos) e carrega cada lote com carregar_registros ou, sem conexão
+    informada e com conexoes > 1, com um CarregadorParalelo aberto durante toda a carga.
+    A fila tem no máximo tamanho_fila registros; cheia, enviar() bloqueia até a carga
+    liberar espaço, de modo que a memória usada não cresce com o total (a busca
+    assíncrona chama enviar() da sua thread de entrega: quem espera são os
+    trabalhadores da busca, não o loop de eventos, ver consultar_lista_cnes_api).
+    Se a carga falhar, a próxima chamada de enviar() levanta o erro e interrompe a busca.
+    """
+
+    def __init__(self, modo=MODO_CARGA, conn=None, tamanho_lote=TAMANHO_LOTE, tamanho_fila=TAMANHO_FILA,
+                 espera_maxima=ESPERA_MAXIMA_LOTE, uf=UF_PADRAO, conexoes=CONEXOES_CARGA):
+        self.modo = modo
+        self.uf = uf
+        self.conn = conn
+        self.conexoes = conexoes if conn is None else 1
+        self.tamanho_lote = tamanho_lote
+        self.espera_maxima = espera_maxima
+        self.fila = queue.Queue(maxsize=tamanho_fila)
+        self.resumo = {'inseridos': 0, 'atualizados': 0, 'inalterados': 0}
+        self.lotes = 0
+        self.segundos_carregando = 0.0
+        self.maior_fila = 0
+        self.erro = None
+        self._thread = threading.Thread(target=self._executar, name='carregador-cnes', daemon=True)
+
+    def iniciar(self):
+        self._thread.start()
+        return self
+
+    def enviar(self, registro):
+        while True:
+            if self.erro is not None:
+                raise RuntimeError(f"Carga no banco interrompida: {self.erro}") from self.erro
+            try:
+                self.fila.put(registro, timeout=1)
+                break
+            except queue.Full:
+                continue
+        self.maior_fila = max(self.maior_fila, self.fila.qsize())
+
+    def finalizar(self):
+        """
+        Aguarda a carga dos registros que ainda estão na fila. Retorna o resumo da carga.
+        """
+        if self._thread.is_alive():
+            while self.erro is None:
+                try:
+                    self.fila.put(FIM_DA_FILA, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            self._thread.join()
+        if self.erro is not None:
+            raise self.erro
+        return self.resumo
+
+    def _proximo_lote(self):
+        lote = [self.fila.get()]
+        limite = time.monotonic() + self.espera_maxima
+        while lote[-1] is not FIM_DA_FILA and len(lote) < self.tamanho_lote:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(self.fila.get(timeout=restante))
+            except queue.Empty:
+                break
+        return lote
+
+    def _executar(self):
+        if self.conexoes > 1:
+            self._executar_em_paralelo()
+            return
+        nova_conexao = self.conn is None
+        try:
+            if nova_conexao:
+                self.conn = conectar()
+            for lote in self._lotes():
+                inicio = time.perf_counter()
+                resumo = carregar_registros(lote, self.modo, self.conn, self.tamanho_lote, materializar=False,
+                                            uf=self.uf)
+                self.segundos_carregando += time.perf_counter() - inicio
+                self.lotes += 1
+                for chave in self.resumo:
+                    self.resumo[chave] += resumo[chave]
+        except Exception as e:
+            self._falhar(e)
+        finally:
+            if nova_conexao and self.conn is not None:
+                self.conn.close()
+
+    def _executar_em_paralelo(self):
+        paralelo = None
+        try:
+            conn = conectar()
+            try:
+                garantir_particao_uf(conn, self.uf)
+            finally:
+                conn.close()
+            paralelo = CarregadorParalelo(self.modo, self.conexoes, self.tamanho_lote,
+                                          nome_particao(self.uf)).iniciar()
+            for lote in self._lotes():
+                for registro in lote:
+                    paralelo.enviar(registro)
+                # Um lote incompleto vai para o banco agora, como na carga com uma conexão
+                paralelo.descarregar()
+            self.resumo = paralelo.finalizar()
+            if paralelo.lotes_com_falha:
+                raise Exception(f"{len(paralelo.lotes_com_falha)} de {paralelo.lotes} lotes falharam")
+        except Exception as e:
+            if paralelo is not None:
+                with contextlib.suppress(Exception):
+                    paralelo.finalizar()
+            self._falhar(e)
+        finally:
+            if paralelo is not None:
+                self.lotes = paralelo.lotes
+                # Tempo médio de cada conexão ocupada com a carga
+                self.segundos_carregando = paralelo.segundos_aplicando / paralelo.conexoes
+
+    def _lotes(self):
+        while True:
+            lote = self._proximo_lote()
+            fim = lote[-1] is FIM_DA_FILA
+            if fim:
+                lote.pop()
+            if lote:
+                yield lote
+            if fim:
+                return
+
+    def _falhar(self, erro):
+        self.erro = erro
+        # Esvazia a fila para não deixar a busca bloqueada em enviar()
+        with contextlib.suppress(queue.Empty):
+            while True:
+                self.fila.get_nowait()
+
+
+def executar_pipeline_em_fluxo(uf=UF_PADRAO, codigos=None, modo_carga=MODO_CARGA, conn=None,
+                               tamanho_lote=TAMANHO_LOTE, tamanho_fila=TAMANHO_FILA, coletor=None, **opcoes_busca):
+    """
+    Como executar_pipeline, mas com busca e carga sobrepostas: cada registro alterado
+    recebido da API entra na fila do CarregadorEmFluxo, que já o carrega no banco
+    enquanto as demais requisições seguem (o coletor, se informado, recebe todos os
+    registros obtidos, alterados ou não). O tempo total tende ao da etapa mais lenta,
+    em vez da soma das duas. Os registros de um lote já carregado ficam no banco mesmo
+    se a busca falhar depois; o estado incremental só é confirmado por quem chama.
+    """
+    tempos = {}
+    sigla = SIGLAS_UF[uf]
+
+    with metricas.etapa('filtrar_estabelecimentos', uf=sigla) as etapa:
+        if codigos is None:
+            codigos = list(filtrar_codigos(uf, materializar=False))
+        etapa['saida'] = len(codigos)
+    tempos['filtrar_estabelecimentos'] = etapa['segundos']
+
+    inicio = time.perf_counter()
+    carregador = CarregadorEmFluxo(modo_carga, conn, tamanho_lote, tamanho_fila, uf=uf).iniciar()
+    if coletor is not None:
+        opcoes_busca['ao_consultado'] = coletor.adicionar
+    with metricas.etapa('consultar_lista_cnes_api', uf=sigla) as etapa:
+        etapa['entrada'] = len(codigos)
+        try:
+            resumo_busca = consultar_lista_cnes_api([str(codigo) for codigo in codigos], uf=uf,
+                                                    ao_registro=carregador.enviar, **opcoes_busca)
+        except BaseException:
+            with contextlib.suppress(Exception):
+                carregador.finalizar()
+            raise
+        etapa['saida'] = resumo_busca['alterados']
+    tempos['consultar_lista_cnes_api'] = etapa['segundos']
+    resumo_carga = carregador.finalizar()
+    tempos['busca_e_carga'] = time.perf_counter() - inicio
+    tempos['carga_banco'] = carregador.segundos_carregando
+    # A carga acontece em paralelo com a busca: registra só o tempo acumulado da thread de carga
+    metricas.registrar_etapa('carga_banco', carregador.segundos_carregando, uf=sigla,
+                             entrada=resumo_busca['alterados'],
+                             saida=resumo_carga['inseridos'] + resumo_carga['atualizados'], lotes=carregador.lotes)
+
+    print(f"⏱️ busca_e_carga: {tempos['busca_e_carga']:.2f}s")
+    print(f"📦 {carregador.lotes} lotes carregados, no máximo {carregador.maior_fila} registros na fila")
+    return {'codigos': len(codigos), 'busca': resumo_busca, 'carga': resumo_carga,
+            'tempos': {etapa: round(segundos, 3) for etapa, segundos in tempos.items()}}
+
+
+def descartar_rejeitados(uf, conn_estado):
+    """
+    Leva os códigos rejeitados pelo codificador na carga da UF (CodificadorCnes.rejeicoes)
+    para a fila de falhas, sem confirmar suas consultas (ver rejeitar_consultas).
+    Retorna a quantidade de códigos.
+    """
+    from CodificadorCnes import rejeicoes
+    from EstadoIncrementalCnes import rejeitar_consultas
+
+    rejeitados = rejeicoes.retirar()
+    if rejeitados:
+        rejeitar_consultas(conn_estado, rejeitados)
+        print(f"🧾 {SIGLAS_UF[uf]}: {len(rejeitados)} registros rejeitados na carga vão para a fila de falhas "
+              f"e serão consultados de novo")
+    metricas.contar('fila_falhas', len(rejeitados), resultado='rejeitado')
+    return len(rejeitados)
+
+
+def reiniciar_estado_uf(uf):
+    """
+    Apaga o estado da UF (assinatura do último dump e estado incremental), para que a
+    próxima execução consulte e recarregue todos os seus códigos. As demais UFs não são afetadas.
+    """
+    from ControleAtualizacaoCnes import caminho_estado
+    from EstadoIncrementalCnes import NOME_BANCO_ESTADO
+
+    banco_estado = os.path.join(pasta_uf(uf), NOME_BANCO_ESTADO)
+    # O banco de estado fica em modo WAL: os arquivos -wal e -shm vão junto
+    for caminho in (caminho_estado(uf), banco_estado, f'{banco_estado}-wal', f'{banco_estado}-shm'):
+        if os.path.exists(caminho):
+            os.remove(caminho)
+    print(f"♻️ {SIGLAS_UF[uf]}: estado reiniciado, todos os códigos serão recarregados")
+
+
+def processar_uf(uf, codigos, assinatura=None, em_fluxo=EM_FLUXO, materializar=MATERIALIZAR,
+                 modo_carga=MODO_CARGA, **opcoes_busca):
+    """
+    Processa uma UF a partir dos seus códigos já filtrados do dump: pula a UF se ela já
+    processou este dump (assinatura) ou se seus códigos e datas de atualização não
+    mudaram; senão executa o pipeline (em fluxo ou em etapas) e, só depois da carga,
+    confirma o estado incremental e registra a execução na pasta da UF.
+    Retorna o resumo do pipeline, ou None se a UF foi pulada.
+    """
+    from ControleAtualizacaoCnes import carregar_estado, salvar_estado, recurso_mudou, codigos_filtrados_mudaram
+    from CodificadorCnes import rejeicoes
+    from EstadoIncrementalCnes import conectar_estado, contar_alterados_no_dump, confirmar_consultas
+
+    from SnapshotCnes import atualizar_snapshot_uf, criar_coletor, snapshot_ausente
+    from ReconciliacaoCnes import etapa_reconciliacao
+
+    estado = carregar_estado(uf)
+    sem_snapshot = snapshot_ausente(uf)
+    if assinatura and not recurso_mudou(assinatura, estado) and not sem_snapshot:
+        print(f"⏭️ {SIGLAS_UF[uf]}: este dump já foi processado. Nada a fazer.")
+        return None
+
+    mudou, hash_codigos = codigos_filtrados_mudaram(codigos, estado)
+    conn_estado = conectar_estado(pasta_uf(uf))
+    try:
+        if not mudou and not contar_alterados_no_dump(conn_estado) and not sem_snapshot:
+            print(f"⏭️ {SIGLAS_UF[uf]}: códigos CNES filtrados e suas datas de atualização não mudaram. Nada a fazer.")
+            salvar_estado({'recurso': assinatura, 'codigos_sha256': hash_codigos}, uf)
+            return None
+
+        if materializar:
+            with open(caminho_codigos_uf(uf), 'w', encoding='utf-8') as f:
+                f.write(','.join(str(codigo) for codigo in codigos))
+        coletor = criar_coletor()
+        # Rejeições de uma carga anterior no mesmo processo não são desta UF
+        rejeicoes.retirar()
+        if coletor is not None and sem_snapshot:
+            # O primeiro snapshot precisa da UF inteira: a amostra cobre todos os não alterados
+            print(f"🗂️ {SIGLAS_UF[uf]}: sem snapshot anterior, todos os {len(codigos)} códigos serão consultados")
+            opcoes_busca['amostra'] = len(codigos)
+        if em_fluxo and not materializar:
+            resumo = executar_pipeline_em_fluxo(uf, codigos, modo_carga, coletor=coletor, **opcoes_busca)
+        else:
+            resumo = executar_pipeline(uf, codigos, materializar, modo_carga, coletor=coletor, **opcoes_busca)
+        # Também antes de confirmar o estado: se o snapshot falhar, os registros são
+        # buscados de novo na próxima execução e o snapshot não fica sem eles
+        if coletor is not None:
+            resumo['snapshot'] = atualizar_snapshot_uf(uf, coletor.tabela(), codigos)
+            # Confere o banco inteiro da UF contra o snapshot (ver ReconciliacaoCnes)
+            resumo['reconciliacao'] = etapa_reconciliacao(uf, codigos)
+
+        # Os registros rejeitados na carga não chegaram ao banco: vão para a fila de falhas
+        # em vez de terem a impressão confirmada
+        resumo['rejeitados'] = descartar_rejeitados(uf, conn_estado)
+        # Estado só é registrado após a carga completa, para não pular uma carga que falhou
+        confirmar_consultas(conn_estado)
+    finally:
+        conn_estado.close()
+    salvar_estado({'recurso': assinatura, 'codigos_sha256': hash_codigos}, uf)
+    return resumo
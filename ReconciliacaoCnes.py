@@ -0,0 +1,318 @@
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+from GerarScriptSQLCnes import CAMPOS, nome_particao
+from EstabelecimentosCsvDownload import SIGLAS_UF, caminho_codigos_uf
+from MetricasCnes import metricas
+
+# Reconciliação entre o snapshot mais recente da UF (SnapshotCnes) e a sua partição de
+# unidade_saude, para descobrir se o banco se afastou da fonte (cargas parciais ou que
+# falharam) sem recarregar tudo. As linhas dos dois lados são agrupadas em até BALDES
+# faixas de codigo_cnes; cada balde tem a quantidade de linhas e a soma dos hashes do
+# conteúdo delas, calculadas no PostgreSQL com uma consulta agregada. Só os baldes que
+# diferem são abertos, linha a linha. CNES_RECONCILIAR: '0' desliga, 'verificar' só informa as
+# diferenças e 'corrigir' recarrega do snapshot as linhas divergentes e apaga do banco
+# as dos estabelecimentos que saíram do dump. Sem os códigos do dump, nenhuma linha é
+# apagada: estar fora do snapshot não quer dizer estar fora da fonte.
+RECONCILIAR = os.environ.get('CNES_RECONCILIAR', 'verificar')
+BALDES = int(os.environ.get('CNES_BALDES_RECONCILIACAO', '1024'))
+
+# Texto de cada linha para o hash: os campos como o PostgreSQL os mostra em texto,
+# separados pelo caractere de controle US e com um marcador no lugar dos nulos
+SEPARADOR = chr(31)
+MARCADOR_NULO = '\\N'
+# Dígitos hexadecimais do md5 de cada linha usados no hash (60 bits: cabe em bigint);
+# a soma de um balde é módulo 2^64 dos dois lados
+DIGITOS_HASH = 15
+MODULO_SOMA = 2 ** 64
+
+# Tipos do PostgreSQL cujo texto não coincide com o do snapshot e que são convertidos
+# antes do hash (float8 é escrito com a representação mais curta, como no Arrow)
+CONVERSOES_TIPO = {
+    'numeric': '{}::float8::text',
+    'real': '{}::float8::text',
+    'boolean': '{}::int::text',
+}
+
+
+def tipos_colunas(conn, tabela):
+    """
+    Tipo no PostgreSQL de cada coluna de CAMPOS na tabela ({} se ela não existe)
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT column_name, data_type FROM information_schema.columns "
+                       "WHERE table_name = %s AND table_schema = ANY(current_schemas(false))", (tabela,))
+        return {coluna: tipo for coluna, tipo in cursor.fetchall() if coluna in CAMPOS}
+
+
+def expressao_hash_linha(tipos):
+    """
+    Expressão SQL com o hash (DIGITOS_HASH dígitos hexadecimais do md5) do conteúdo de
+    uma linha, igual ao calculado por hashes_snapshot para o mesmo conteúdo
+    """
+    textos = [f"coalesce({CONVERSOES_TIPO.get(tipos[campo], '{}::text').format(campo)}, "
+              f"'{MARCADOR_NULO}')" for campo in CAMPOS]
+    return f"substr(md5(concat_ws(chr({ord(SEPARADOR)}), {', '.join(textos)})), 1, {DIGITOS_HASH})"
+
+
+def hashes_snapshot(tabela):
+    """
+    Códigos (int64) e hashes (uint64) das linhas de um snapshot. Os campos passam por
+    texto no Arrow (vetorizado); só o md5 de cada linha é calculado em Python.
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    textos = [pc.fill_null(pc.cast(tabela[campo], pa.string()), MARCADOR_NULO) for campo in CAMPOS]
+    linhas = pc.binary_join_element_wise(*textos, SEPARADOR)
+    hashes = np.fromiter((int(hashlib.md5(linha.encode('utf-8')).hexdigest()[:DIGITOS_HASH], 16)
+                          for linha in linhas.to_pylist()), dtype=np.uint64, count=len(linhas))
+    return tabela['codigo_cnes'].to_numpy(), hashes
+
+
+def limites_baldes(codigos, baldes=BALDES):
+    """
+    Limites das faixas de codigo_cnes: quantis dos códigos da fonte, para que os baldes
+    tenham quantidades parecidas de linhas mesmo com códigos concentrados em poucas faixas
+    (ou um código muito fora das demais)
+    """
+    import numpy as np
+
+    if not len(codigos):
+        return np.zeros(1, dtype=np.int64)
+    ordenados = np.sort(codigos)
+    passo = max(1, -(-len(ordenados) // max(baldes, 1)))
+    return np.unique(ordenados[passo::passo])
+
+
+def somar_baldes(codigos, hashes, limites):
+    """
+    {balde: (quantidade de linhas, soma dos hashes módulo 2^64)} dos códigos. O balde é
+    a quantidade de limites menores ou iguais ao código, como width_bucket no PostgreSQL.
+    """
+    import numpy as np
+
+    if not len(codigos):
+        return {}
+    baldes, inversos = np.unique(np.searchsorted(limites, codigos, side='right'), return_inverse=True)
+    quantidades = np.bincount(inversos, minlength=len(baldes))
+    somas = np.zeros(len(baldes), dtype=np.uint64)
+    # A soma em uint64 dá a volta em 2^64, como o módulo aplicado no PostgreSQL
+    np.add.at(somas, inversos, hashes)
+    return {int(balde): (int(quantidade), int(soma)) for balde, quantidade, soma in zip(baldes, quantidades, somas)}
+
+
+def reconciliar(conn, tabela, snapshot, codigos_dump=None, baldes=BALDES):
+    """
+    Compara o snapshot (tabela Arrow, ver SnapshotCnes) com a tabela do banco em duas
+    consultas: quantidade e soma dos hashes por balde, e os hashes das linhas dos baldes
+    que diferem. Com codigos_dump, as linhas do snapshot que saíram do dump também saem
+    da fonte.
+    Retorna os arrays numpy de códigos 'recarregar' (fora do banco ou com conteúdo
+    diferente), 'remover' (no banco, mas não no snapshot nem no dump; vazio sem
+    codigos_dump) e 'sem_snapshot' (no dump, ou no banco quando não há codigos_dump,
+    mas sem registro no snapshot: só uma nova busca na API resolve), além das
+    quantidades de linhas e baldes.
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    tipos = tipos_colunas(conn, tabela)
+    ausentes = [campo for campo in CAMPOS if campo not in tipos]
+    if ausentes:
+        raise Exception(f"Tabela {tabela} não encontrada ou sem as colunas {', '.join(ausentes)}")
+
+    if codigos_dump is not None:
+        dump = np.unique(np.array([int(codigo) for codigo in codigos_dump], dtype=np.int64))
+        snapshot = snapshot.filter(pc.is_in(snapshot['codigo_cnes'], value_set=pa.array(dump)))
+    codigos, hashes = hashes_snapshot(snapshot)
+    expressao = expressao_hash_linha(tipos)
+    limites = limites_baldes(codigos, baldes)
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT width_bucket(codigo_cnes::bigint, %s::bigint[]), count(*),
+                   sum(('x' || h)::bit({DIGITOS_HASH * 4})::bigint) %% {MODULO_SOMA}
+            FROM (SELECT codigo_cnes, {expressao} AS h FROM {tabela}) linhas
+            GROUP BY 1
+        """, (limites.tolist(),))
+        baldes_banco = {int(balde): (int(quantidade), int(soma)) for balde, quantidade, soma in cursor.fetchall()}
+        baldes_fonte = somar_baldes(codigos, hashes, limites)
+        divergentes = sorted(balde for balde in baldes_fonte.keys() | baldes_banco.keys()
+                             if baldes_fonte.get(balde) != baldes_banco.get(balde))
+
+        hashes_banco = {}
+        if divergentes:
+            cursor.execute(f"""
+                SELECT codigo_cnes::bigint, {expressao} FROM {tabela}
+                WHERE width_bucket(codigo_cnes::bigint, %s::bigint[]) = ANY(%s)
+            """, (limites.tolist(), divergentes))
+            hashes_banco = {codigo: int(h, 16) for codigo, h in cursor.fetchall()}
+
+    # Só as linhas da fonte dos baldes divergentes são comparadas uma a uma
+    abertas = np.isin(np.searchsorted(limites, codigos, side='right'), divergentes)
+    recarregar = np.array([codigo for codigo, h in zip(codigos[abertas].tolist(), hashes[abertas].tolist())
+                           if hashes_banco.get(codigo) != h], dtype=np.int64)
+    fora_do_snapshot = np.setdiff1d(np.fromiter(hashes_banco, dtype=np.int64, count=len(hashes_banco)), codigos)
+    if codigos_dump is not None:
+        remover = np.setdiff1d(fora_do_snapshot, dump)
+        sem_snapshot = np.setdiff1d(dump, codigos)
+    else:
+        # Sem o dump, uma linha fora do snapshot pode só não ter sido buscada (snapshot
+        # parcial, falha na busca, registro rejeitado na carga): nada é removido
+        remover = np.array([], dtype=np.int64)
+        sem_snapshot = fora_do_snapshot
+    return {
+        'recarregar': recarregar,
+        'remover': remover,
+        'sem_snapshot': sem_snapshot,
+        'linhas_fonte': len(codigos),
+        'linhas_banco': sum(quantidade for quantidade, _ in baldes_banco.values()),
+        'baldes': len(baldes_fonte.keys() | baldes_banco.keys()),
+        'baldes_divergentes': len(divergentes),
+        'linhas_abertas': int(np.count_nonzero(abertas)) + len(hashes_banco),
+    }
+
+
+def corrigir(conn, tabela, snapshot, diferencas):
+    """
+    Recarrega do snapshot as linhas a recarregar (COPY + merge, ver carregar_via_copy) e
+    apaga da tabela as linhas a remover, sem consultar a API.
+    Retorna {'recarregados', 'removidos'}.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from UptadeBancoDeDados import carregar_via_copy
+
+    recarregados = 0
+    if len(diferencas['recarregar']):
+        linhas = snapshot.filter(pc.is_in(snapshot['codigo_cnes'], value_set=pa.array(diferencas['recarregar'])))
+        resumo = carregar_via_copy(conn, linhas.select(CAMPOS).to_pylist(), tabela=tabela)
+        recarregados = resumo['inseridos'] + resumo['atualizados']
+
+    removidos = 0
+    if len(diferencas['remover']):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {tabela} WHERE codigo_cnes::bigint = ANY(%s)",
+                               (diferencas['remover'].tolist(),))
+                removidos = cursor.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return {'recarregados': recarregados, 'removidos': removidos}
+
+
+def ler_codigos_dump(uf):
+    """
+    Códigos da UF no último dump filtrado (arquivo de códigos da UF), ou None se ele
+    não foi gravado (sem CNES_MATERIALIZAR=1)
+    """
+    from BuscarCnesApiOficial import ler_codigos_cnes
+
+    caminho = caminho_codigos_uf(uf)
+    if not os.path.exists(caminho):
+        return None
+    return [codigo for codigo in ler_codigos_cnes(caminho) if codigo]
+
+
+def reconciliar_uf(uf, conn=None, codigos=None, modo=RECONCILIAR, baldes=BALDES):
+    """
+    Reconcilia a partição da UF com o seu snapshot mais recente e, no modo 'corrigir',
+    aplica as correções. Sem codigos, usa o arquivo de códigos da UF se existir.
+    Retorna o resumo (com os arrays de códigos), ou None sem snapshot da UF.
+    """
+    from SnapshotCnes import listar_snapshots, ler_snapshot
+    from UptadeBancoDeDados import conectar
+
+    sigla = SIGLAS_UF[uf]
+    snapshots = listar_snapshots(uf)
+    if not snapshots:
+        print(f"⚠️ {sigla}: nenhum snapshot para reconciliar com o banco")
+        return None
+    snapshot = ler_snapshot(snapshots[-1])
+    if codigos is None:
+        codigos = ler_codigos_dump(uf)
+    tabela = nome_particao(uf)
+
+    propria = conn is None
+    if propria:
+        conn = conectar()
+    try:
+        with metricas.etapa('reconciliacao', uf=sigla) as etapa:
+            etapa['entrada'] = snapshot.num_rows
+            inicio = time.perf_counter()
+            diferencas = reconciliar(conn, tabela, snapshot, codigos, baldes)
+            diferencas['segundos'] = round(time.perf_counter() - inicio, 3)
+            etapa['saida'] = len(diferencas['recarregar']) + len(diferencas['remover'])
+            if modo == 'corrigir':
+                diferencas.update(corrigir(conn, tabela, snapshot, diferencas))
+    finally:
+        if propria:
+            conn.close()
+
+    metricas.contar('reconciliacao_linhas', len(diferencas['recarregar']), uf=sigla, resultado='recarregar')
+    metricas.contar('reconciliacao_linhas', len(diferencas['remover']), uf=sigla, resultado='remover')
+    print(f"🔎 {sigla}: {diferencas['linhas_fonte']} linhas no snapshot x {diferencas['linhas_banco']} no banco, "
+          f"{diferencas['baldes_divergentes']} de {diferencas['baldes']} baldes divergentes "
+          f"({diferencas['linhas_abertas']} linhas abertas, {diferencas['segundos']}s): "
+          f"{len(diferencas['recarregar'])} a recarregar, {len(diferencas['remover'])} a remover, "
+          f"{len(diferencas['sem_snapshot'])} sem registro no snapshot")
+    if 'recarregados' in diferencas:
+        print(f"🔧 {sigla}: {diferencas['recarregados']} linhas recarregadas do snapshot, "
+              f"{diferencas['removidos']} removidas")
+    return diferencas
+
+
+def etapa_reconciliacao(uf, codigos=None, modo=RECONCILIAR):
+    """
+    Reconciliação ao final da execução de uma UF (processar_uf, reconciliar_shards_uf).
+    A carga já terminou: uma falha aqui é só informada e não desfaz a execução.
+    """
+    if modo not in ('verificar', 'corrigir'):
+        return None
+    try:
+        diferencas = reconciliar_uf(uf, codigos=codigos, modo=modo)
+    except Exception as e:
+        print(f"⚠️ {SIGLAS_UF[uf]}: reconciliação com o banco não concluída: {e}")
+        return None
+    if diferencas is None:
+        return None
+    return {chave: len(valor) if hasattr(valor, 'dtype') else valor for chave, valor in diferencas.items()}
+
+
+def main():
+    from EstabelecimentosCsvDownload import UFS, ler_ufs
+
+    parser = argparse.ArgumentParser(description='Reconcilia o snapshot mais recente de cada UF com o banco')
+    parser.add_argument('--ufs', type=ler_ufs, default=UFS,
+                        help='UFs a reconciliar, ex.: "11,12", "RO,AC" ou "todas" (padrão: CNES_UFS)')
+    parser.add_argument('--corrigir', action='store_true',
+                        help='Recarrega do snapshot as linhas divergentes e apaga as que saíram do dump '
+                             '(só com o arquivo de códigos da UF, CNES_MATERIALIZAR=1)')
+    parser.add_argument('--baldes', type=int, default=BALDES, help='Faixas de codigo_cnes comparadas por hash')
+    parser.add_argument('--listar', type=int, default=10, help='Códigos listados de cada tipo de diferença')
+    args = parser.parse_args()
+
+    divergencias = False
+    for uf in args.ufs:
+        diferencas = reconciliar_uf(uf, modo='corrigir' if args.corrigir else 'verificar', baldes=args.baldes)
+        if diferencas is None:
+            continue
+        for tipo in ('recarregar', 'remover', 'sem_snapshot'):
+            codigos = diferencas[tipo]
+            print(f"  {tipo}: {len(codigos)} {codigos[:args.listar].tolist()}")
+        divergencias |= not args.corrigir and bool(len(diferencas['recarregar']) or len(diferencas['remover']))
+    # Código de saída 2 quando há divergências não corrigidas, para uso em verificações agendadas
+    if divergencias:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
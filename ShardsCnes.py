@@ -0,0 +1,287 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+
+from EstabelecimentosCsvDownload import UFS, SIGLAS_UF, ler_ufs, pasta_uf
+from MetricasCnes import metricas
+
+# Pasta (dentro da pasta de trabalho de cada UF) com um arquivo de códigos por shard,
+# no mesmo formato do cnes_ro.csv, e o resumo da execução em andamento da UF.
+# Cada shard concluído troca seu .csv por um .resumo.json
+NOME_PASTA_SHARDS = 'shards'
+NOME_EXECUCAO = 'execucao.json'
+# Todos os códigos da UF no dump, para tirar do snapshot os que saíram dele
+NOME_CODIGOS_DUMP = 'codigos_dump.csv'
+
+# Quantidade padrão de shards por UF (tarefas paralelas no Airflow)
+NUMERO_SHARDS = int(os.environ.get('CNES_NUMERO_SHARDS', '4'))
+
+
+def pasta_shards(uf):
+    return os.path.join(pasta_uf(uf), NOME_PASTA_SHARDS)
+
+
+def dividir_em_shards(codigos, numero_shards=NUMERO_SHARDS):
+    """
+    Divide os códigos em até numero_shards listas de tamanho equilibrado
+    (intercaladas, para que cada shard tenha códigos de todas as faixas)
+    """
+    numero_shards = max(1, min(numero_shards, len(codigos)))
+    return [codigos[indice::numero_shards] for indice in range(numero_shards)]
+
+
+def preparar_shards_uf(uf, codigos, assinatura, numero_shards=NUMERO_SHARDS):
+    """
+    Seleciona os códigos da UF que precisam ir à API (ver EstadoIncrementalCnes) e grava
+    um arquivo por shard na pasta de shards da UF. Retorna os arquivos gravados, ou uma
+    lista vazia se a UF não tem nada a fazer.
+    """
+    from ControleAtualizacaoCnes import carregar_estado, salvar_estado, recurso_mudou, codigos_filtrados_mudaram
+    from EstadoIncrementalCnes import conectar_estado, contar_alterados_no_dump, selecionar_codigos_para_consulta
+    from SnapshotCnes import snapshot_ausente
+
+    estado = carregar_estado(uf)
+    # Sem snapshot da UF, todos os códigos vão aos shards, para o primeiro ser completo
+    sem_snapshot = snapshot_ausente(uf)
+    if assinatura and not recurso_mudou(assinatura, estado) and not sem_snapshot:
+        print(f"⏭️ {SIGLAS_UF[uf]}: este dump já foi processado. Nada a fazer.")
+        return []
+    if not codigos:
+        raise Exception(f"Nenhum código CNES de {SIGLAS_UF[uf]} encontrado no dump")
+
+    mudou, hash_codigos = codigos_filtrados_mudaram(codigos, estado)
+    conn_estado = conectar_estado(pasta_uf(uf))
+    try:
+        if not mudou and not contar_alterados_no_dump(conn_estado) and not sem_snapshot:
+            print(f"⏭️ {SIGLAS_UF[uf]}: códigos CNES filtrados e suas datas de atualização não mudaram. Nada a fazer.")
+            salvar_estado({'recurso': assinatura, 'codigos_sha256': hash_codigos}, uf)
+            return []
+        if sem_snapshot:
+            print(f"🗂️ {SIGLAS_UF[uf]}: sem snapshot anterior, todos os {len(codigos)} códigos serão consultados")
+            selecionados, alterados = selecionar_codigos_para_consulta(conn_estado, codigos, len(codigos))
+        else:
+            selecionados, alterados = selecionar_codigos_para_consulta(conn_estado, codigos)
+    finally:
+        conn_estado.close()
+    if not selecionados:
+        print(f"⏭️ {SIGLAS_UF[uf]}: nenhum código precisa ser consultado na API. Nada a fazer.")
+        salvar_estado({'recurso': assinatura, 'codigos_sha256': hash_codigos}, uf)
+        return []
+
+    # Uma preparação nova descarta os shards de uma execução anterior não reconciliada
+    pasta = pasta_shards(uf)
+    shutil.rmtree(pasta, ignore_errors=True)
+    os.makedirs(pasta)
+    caminhos = []
+    for indice, codigos_shard in enumerate(dividir_em_shards(selecionados, numero_shards)):
+        caminho = os.path.join(pasta, f'shard_{indice:03d}.csv')
+        with open(caminho, 'w', encoding='utf-8') as f:
+            f.write(','.join(codigos_shard))
+        caminhos.append(caminho)
+    with open(os.path.join(pasta, NOME_CODIGOS_DUMP), 'w', encoding='utf-8') as f:
+        f.write(','.join(str(codigo) for codigo in codigos))
+    with open(os.path.join(pasta, NOME_EXECUCAO), 'w', encoding='utf-8') as f:
+        json.dump({'uf': uf, 'recurso': assinatura, 'codigos_sha256': hash_codigos, 'shards': len(caminhos),
+                   'codigos': len(selecionados), 'alterados': alterados}, f, ensure_ascii=False, indent=2)
+    print(f"✂️ {SIGLAS_UF[uf]}: {len(selecionados)} códigos ({alterados} novos/alterados) "
+          f"divididos em {len(caminhos)} shards")
+    return caminhos
+
+
+def preparar_shards(numero_shards=NUMERO_SHARDS, ufs=UFS, recarregar=False):
+    """
+    Baixa o dump, separa os códigos das UFs em uma única leitura e prepara os shards de
+    cada UF (preparar_shards_uf). Com recarregar, o estado das UFs é descartado antes
+    (todos os códigos são consultados e carregados de novo).
+    Retorna a lista de arquivos de shard de todas as UFs, vazia se não houver nada a fazer.
+    """
+    from ControleAtualizacaoCnes import carregar_estado, obter_assinatura_recurso, recurso_mudou
+    from EstabelecimentosCsvDownload import acessar_opendatasus, separar_codigos_por_uf
+    from PipelineCnes import reiniciar_estado_uf
+    from SnapshotCnes import snapshot_ausente
+
+    if recarregar:
+        for uf in ufs:
+            reiniciar_estado_uf(uf)
+    try:
+        assinatura = obter_assinatura_recurso()
+    except Exception as e:
+        print(f"Não foi possível verificar o recurso, seguindo com a execução: {e}")
+        assinatura = None
+    if assinatura and not any(recurso_mudou(assinatura, carregar_estado(uf)) or snapshot_ausente(uf) for uf in ufs):
+        print("⏭️ Dump do CNES não mudou desde a última execução. Nada a fazer.")
+        return []
+
+    with metricas.etapa('acessar_opendatasus'):
+        acessar_opendatasus()
+    with metricas.etapa('separar_codigos_por_uf') as etapa:
+        codigos_por_uf = separar_codigos_por_uf(ufs)
+        etapa['saida'] = sum(len(codigos) for codigos in codigos_por_uf.values())
+    caminhos = []
+    for uf, codigos in codigos_por_uf.items():
+        caminhos.extend(preparar_shards_uf(uf, codigos, assinatura, numero_shards))
+    return caminhos
+
+
+def executar_shard(caminho):
+    """
+    Busca na API e carrega no banco os códigos de um shard (executar_pipeline_em_fluxo),
+    usando a pasta de trabalho e a partição da UF do shard.
+    Ao terminar, grava o resumo (e os registros buscados, para o snapshot da UF) ao lado
+    e remove o arquivo do shard; executar de novo um shard já concluído não faz nada.
+    """
+    from BuscarCnesApiOficial import ler_codigos_cnes
+    from CodificadorCnes import rejeicoes
+    from EstadoIncrementalCnes import conectar_estado
+    from PipelineCnes import descartar_rejeitados, executar_pipeline_em_fluxo
+    from SnapshotCnes import criar_coletor, gravar_snapshot
+
+    caminho_resumo = caminho.replace('.csv', '.resumo.json')
+    if not os.path.exists(caminho):
+        if os.path.exists(caminho_resumo):
+            print(f"✅ Shard {caminho} já concluído")
+            return None
+        raise FileNotFoundError(f"Shard não encontrado: {caminho}")
+
+    with open(os.path.join(os.path.dirname(caminho), NOME_EXECUCAO), 'r', encoding='utf-8') as f:
+        uf = json.load(f)['uf']
+    codigos = ler_codigos_cnes(caminho)
+    # Os códigos do shard já foram selecionados em preparar_shards_uf: a amostra cobre
+    # todos os não alterados para que nenhum seja descartado de novo aqui. Sem listagem
+    # paginada: cada shard percorreria a listagem da UF inteira
+    coletor = criar_coletor()
+    rejeicoes.retirar()
+    resumo = executar_pipeline_em_fluxo(uf, codigos=codigos, amostra=len(codigos), listagem=False, coletor=coletor)
+    # Antes de reconciliar_shards_uf confirmar o estado da UF: os rejeitados ficam de fora
+    conn_estado = conectar_estado(pasta_uf(uf))
+    try:
+        resumo['rejeitados'] = descartar_rejeitados(uf, conn_estado)
+    finally:
+        conn_estado.close()
+    # Parte do snapshot da UF com os registros deste shard, juntada em reconciliar_shards_uf
+    if coletor is not None:
+        gravar_snapshot(coletor.tabela(), caminho.replace('.csv', '.snapshot.parquet'))
+    with open(caminho_resumo, 'w', encoding='utf-8') as f:
+        json.dump(resumo, f, ensure_ascii=False)
+    os.remove(caminho)
+    return resumo
+
+
+def reconciliar_shards_uf(uf):
+    """
+    Confere se todos os shards da UF terminaram; se sim, atualiza o snapshot da UF com
+    os registros dos shards, confirma o estado incremental e registra a execução da UF
+    como concluída. Retorna os totais somados dos shards, ou None se a UF não tem
+    execução em andamento.
+    """
+    from ControleAtualizacaoCnes import salvar_estado
+    from EstadoIncrementalCnes import conectar_estado, confirmar_consultas
+
+    pasta = pasta_shards(uf)
+    caminho_execucao = os.path.join(pasta, NOME_EXECUCAO)
+    if not os.path.exists(caminho_execucao):
+        return None
+    with open(caminho_execucao, 'r', encoding='utf-8') as f:
+        execucao = json.load(f)
+    pendentes = sorted(glob.glob(os.path.join(pasta, 'shard_*.csv')))
+    if pendentes:
+        raise Exception(f"{SIGLAS_UF[uf]}: {len(pendentes)} shards não concluídos: {pendentes}")
+
+    totais = {'inseridos': 0, 'atualizados': 0, 'inalterados': 0, 'sucesso': 0, 'erro': 0}
+    for caminho in glob.glob(os.path.join(pasta, 'shard_*.resumo.json')):
+        with open(caminho, 'r', encoding='utf-8') as f:
+            resumo = json.load(f)
+        for chave in ('inseridos', 'atualizados', 'inalterados'):
+            totais[chave] += resumo['carga'][chave]
+        for chave in ('sucesso', 'erro'):
+            totais[chave] += resumo['busca'][chave]
+
+    partes_snapshot = sorted(glob.glob(os.path.join(pasta, 'shard_*.snapshot.parquet')))
+    if partes_snapshot:
+        import pyarrow as pa
+        from BuscarCnesApiOficial import ler_codigos_cnes
+        from SnapshotCnes import atualizar_snapshot_uf, ler_snapshot
+
+        from ReconciliacaoCnes import etapa_reconciliacao
+
+        codigos_dump = ler_codigos_cnes(os.path.join(pasta, NOME_CODIGOS_DUMP))
+        atualizar_snapshot_uf(uf, pa.concat_tables([ler_snapshot(parte) for parte in partes_snapshot]), codigos_dump)
+        etapa_reconciliacao(uf, codigos_dump)
+
+    conn_estado = conectar_estado(pasta_uf(uf))
+    try:
+        confirmar_consultas(conn_estado)
+    finally:
+        conn_estado.close()
+    salvar_estado({'recurso': execucao['recurso'], 'codigos_sha256': execucao['codigos_sha256']}, uf)
+    shutil.rmtree(pasta, ignore_errors=True)
+    print(f"🧮 {SIGLAS_UF[uf]}: {execucao['shards']} shards reconciliados: {totais}")
+    return totais
+
+
+def reconciliar_shards(ufs=UFS):
+    """
+    Reconcilia cada UF com execução em andamento (reconciliar_shards_uf). As UFs completas
+    são confirmadas mesmo que outras ainda tenham shards pendentes; nesse caso, levanta
+    um erro no final listando as pendentes. Retorna {uf: totais}.
+    """
+    resultados = {}
+    incompletas = []
+    for uf in ufs:
+        try:
+            totais = reconciliar_shards_uf(uf)
+        except Exception as e:
+            print(f"❌ {e}")
+            incompletas.append(SIGLAS_UF[uf])
+            continue
+        if totais is not None:
+            resultados[uf] = totais
+    if incompletas:
+        raise Exception(f"UFs com shards não concluídos: {', '.join(incompletas)}")
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Execução da automação CNES dividida em shards')
+    parser.add_argument('--ufs', type=ler_ufs, default=UFS,
+                        help='UFs a processar, ex.: "11,12", "RO,AC" ou "todas" (padrão: CNES_UFS)')
+    subparsers = parser.add_subparsers(dest='etapa', required=True)
+    parser_preparar = subparsers.add_parser('preparar', help='Baixa o dump e grava os arquivos de shard')
+    parser_preparar.add_argument('--shards', type=int, default=NUMERO_SHARDS, help='Shards por UF')
+    parser_preparar.add_argument('--recarregar', action='store_true',
+                                 help='Descarta o estado das UFs e recarrega todos os seus códigos')
+    parser_shard = subparsers.add_parser('shard', help='Busca e carrega os códigos de um shard')
+    parser_shard.add_argument('caminho')
+    subparsers.add_parser('reconciliar', help='Confirma as UFs cujos shards terminaram')
+    args = parser.parse_args()
+
+    # Cada etapa (e cada shard) grava o próprio relatório; no Airflow o caminho vem de
+    # CNES_RELATORIO e os relatórios são consolidados na notificação
+    nome_relatorio = f'relatorio_shards_{args.etapa}.json'
+    if args.etapa == 'shard':
+        nome_shard = os.path.splitext(os.path.basename(args.caminho))[0]
+        nome_uf = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(args.caminho))))
+        nome_relatorio = f'relatorio_shard_{nome_uf}_{nome_shard}.json'
+    metricas.iniciar_progresso()
+    status = 'erro'
+    try:
+        if args.etapa == 'preparar':
+            preparar_shards(args.shards, args.ufs, args.recarregar)
+        elif args.etapa == 'shard':
+            executar_shard(args.caminho)
+        else:
+            reconciliar_shards(args.ufs)
+        status = 'ok'
+    except Exception as e:
+        print(f"❌ Erro na etapa '{args.etapa}': {e}")
+        sys.exit(1)
+    finally:
+        metricas.parar_progresso()
+        metricas.gravar(nome_relatorio, script='ShardsCnes.py', etapa=args.etapa, status=status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from datetime import datetime
+
+from GerarScriptSQLCnes import CAMPOS
+from CodificadorCnes import esquema_campos, obter_codificador
+from EstabelecimentosCsvDownload import SIGLAS_UF, pasta_uf
+from MetricasCnes import metricas
+
+# Snapshot colunar (Parquet) dos registros da API de cada UF, na pasta de trabalho da UF.
+# Cada execução grava um snapshot completo (o anterior com os registros buscados por cima)
+# e os SNAPSHOTS_MANTIDOS mais recentes são mantidos; o mais recente é a base da próxima
+# comparação. CNES_SNAPSHOT=0 desliga.
+USAR_SNAPSHOT = os.environ.get('CNES_SNAPSHOT', '1') == '1'
+NOME_PASTA_SNAPSHOTS = 'snapshots'
+SNAPSHOTS_MANTIDOS = int(os.environ.get('CNES_SNAPSHOTS_MANTIDOS', '3'))
+COMPRESSAO = os.environ.get('CNES_SNAPSHOT_COMPRESSAO', 'zstd')
+
+# Registros acumulados como dicionários antes de virarem um bloco colunar
+TAMANHO_BLOCO = 10000
+
+# Coluna extra com a impressão digital (hash) do conteúdo de cada registro, calculada
+# uma vez quando o registro entra no snapshot: a comparação entre snapshots só olha
+# para ela e para o código
+COLUNA_IMPRESSAO = 'impressao'
+
+
+def esquema_snapshot():
+    """
+    Campos nos tipos do codificador da carga (CodificadorCnes.TIPOS_CAMPOS) mais a impressão
+    """
+    import pyarrow as pa
+
+    return esquema_campos(CAMPOS).append(pa.field(COLUNA_IMPRESSAO, pa.uint64()))
+
+
+def pasta_snapshots(uf):
+    return os.path.join(pasta_uf(uf), NOME_PASTA_SNAPSHOTS)
+
+
+def listar_snapshots(uf):
+    """
+    Snapshots gravados da UF, do mais antigo para o mais recente
+    """
+    return sorted(glob.glob(os.path.join(pasta_snapshots(uf), 'cnes_snapshot_*.parquet')))
+
+
+def calcular_impressoes(tabela):
+    """
+    Hash (uint64) do conteúdo de cada linha, vetorizado com pandas. Os campos passam por
+    texto antes do hash, para que o mesmo conteúdo tenha o mesmo hash em qualquer bloco
+    (um bloco com nulos em uma coluna inteira viraria float no pandas)
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    textos = {campo: pc.fill_null(pc.cast(tabela[campo], pa.string()), '\x00') for campo in CAMPOS}
+    quadro = pa.table(textos).to_pandas()
+    return pa.array(pd.util.hash_pandas_object(quadro, index=False, categorize=False).to_numpy(), type=pa.uint64())
+
+
+def tabela_registros(registros):
+    """
+    Converte uma lista de registros da API (dicionários) em uma tabela Arrow com o
+    esquema do snapshot, já com a impressão de cada linha. A conversão é a mesma da
+    carga no banco (CodificadorCnes): os registros que ela rejeita, e que portanto não
+    chegam ao banco, também ficam fora do snapshot.
+    """
+    tabela, _ = obter_codificador(CAMPOS).tabela(registros)
+    return tabela.append_column(esquema_snapshot().field(COLUNA_IMPRESSAO), calcular_impressoes(tabela))
+
+
+class ColetorSnapshot:
+    """
+    Recebe os registros buscados na API por adicionar(registro) (no lugar ou junto do
+    ao_registro da busca) e os guarda em blocos colunares de TAMANHO_BLOCO registros,
+    bem menores em memória que os dicionários originais.
+    """
+
+    def __init__(self, tamanho_bloco=TAMANHO_BLOCO):
+        self.tamanho_bloco = tamanho_bloco
+        self.pendentes = []
+        self.blocos = []
+        self.total = 0
+
+    def adicionar(self, registro):
+        self.pendentes.append(registro)
+        self.total += 1
+        if len(self.pendentes) >= self.tamanho_bloco:
+            self._fechar_bloco()
+
+    def _fechar_bloco(self):
+        pendentes, self.pendentes = self.pendentes, []
+        if pendentes:
+            self.blocos.append(tabela_registros(pendentes))
+
+    def tabela(self):
+        import pyarrow as pa
+
+        self._fechar_bloco()
+        if not self.blocos:
+            return esquema_snapshot().empty_table()
+        return pa.concat_tables(self.blocos)
+
+
+def snapshot_ausente(uf, usar_snapshot=USAR_SNAPSHOT):
+    """
+    True se o snapshot está ligado e a UF ainda não tem nenhum: a próxima busca precisa
+    consultar todos os códigos da UF (não só os alterados e a amostra rotativa) para que
+    o primeiro snapshot seja completo
+    """
+    return usar_snapshot and not listar_snapshots(uf)
+
+
+def criar_coletor(usar_snapshot=USAR_SNAPSHOT):
+    """
+    Coletor para os registros da execução, ou None se o snapshot estiver desligado ou
+    o pyarrow não estiver instalado (a execução segue sem snapshot)
+    """
+    if not usar_snapshot:
+        return None
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("⚠️ pyarrow não instalado: snapshot dos registros desativado")
+        return None
+    return ColetorSnapshot()
+
+
+def ler_snapshot(caminho):
+    import pyarrow.parquet as pq
+
+    return pq.read_table(caminho).select(esquema_snapshot().names).cast(esquema_snapshot())
+
+
+def gravar_snapshot(tabela, caminho, compressao=COMPRESSAO):
+    """
+    Grava a tabela em Parquet de forma atômica (arquivo temporário + rename)
+    """
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    temporario = f'{caminho}.{os.getpid()}.tmp'
+    pq.write_table(tabela, temporario, compression=compressao)
+    os.replace(temporario, caminho)
+
+
+def _ultimas_ocorrencias(tabela):
+    """
+    Mantém só a última linha de cada código (um código pode ter sido buscado duas vezes)
+    """
+    import numpy as np
+
+    codigos = tabela['codigo_cnes'].to_numpy()
+    _, indices_invertidos = np.unique(codigos[::-1], return_index=True)
+    if len(indices_invertidos) == len(codigos):
+        return tabela
+    return tabela.take(np.sort(len(codigos) - 1 - indices_invertidos))
+
+
+def mesclar_snapshot(anterior, buscados, codigos_atuais=None):
+    """
+    Snapshot novo: as linhas do anterior cujo código não foi buscado de novo mais as
+    buscadas, ordenado por código. Com codigos_atuais, os códigos que saíram do dump
+    também saem do snapshot.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    buscados = _ultimas_ocorrencias(buscados)
+    partes = [buscados]
+    if anterior is not None and anterior.num_rows:
+        mantidos = pc.invert(pc.is_in(anterior['codigo_cnes'], value_set=buscados['codigo_cnes']))
+        partes.insert(0, anterior.filter(mantidos))
+    tabela = pa.concat_tables(partes)
+    if codigos_atuais is not None:
+        codigos = pa.array(sorted({int(codigo) for codigo in codigos_atuais}), type=pa.int64())
+        tabela = tabela.filter(pc.is_in(tabela['codigo_cnes'], value_set=codigos))
+    return tabela.sort_by('codigo_cnes')
+
+
+def comparar_snapshots(anterior, atual):
+    """
+    Compara dois snapshots pelos códigos e impressões, sem olhar para o conteúdo:
+    operações vetorizadas sobre duas colunas. Retorna {'novos', 'alterados', 'removidos'}
+    (arrays numpy de códigos) e 'inalterados' (quantidade).
+    """
+    import numpy as np
+
+    codigos_atuais = atual['codigo_cnes'].to_numpy()
+    impressoes_atuais = atual[COLUNA_IMPRESSAO].to_numpy()
+    if anterior is None or not anterior.num_rows:
+        vazio = np.array([], dtype=np.int64)
+        return {'novos': codigos_atuais, 'alterados': vazio, 'removidos': vazio, 'inalterados': 0}
+    codigos_anteriores = anterior['codigo_cnes'].to_numpy()
+    impressoes_anteriores = anterior[COLUNA_IMPRESSAO].to_numpy()
+
+    # Os snapshots são gravados ordenados por código, mas a ordem não é pressuposta
+    ordem = np.argsort(codigos_anteriores, kind='stable')
+    codigos_anteriores, impressoes_anteriores = codigos_anteriores[ordem], impressoes_anteriores[ordem]
+    posicoes = np.searchsorted(codigos_anteriores, codigos_atuais)
+    posicoes_validas = np.minimum(posicoes, len(codigos_anteriores) - 1)
+    existiam = codigos_anteriores[posicoes_validas] == codigos_atuais
+    mudaram = existiam & (impressoes_anteriores[posicoes_validas] != impressoes_atuais)
+    return {
+        'novos': codigos_atuais[~existiam],
+        'alterados': codigos_atuais[mudaram],
+        'removidos': np.setdiff1d(codigos_anteriores, codigos_atuais, assume_unique=True),
+        'inalterados': int(np.count_nonzero(existiam & ~mudaram)),
+    }
+
+
+def atualizar_snapshot_uf(uf, buscados, codigos_atuais=None, mantidos=SNAPSHOTS_MANTIDOS):
+    """
+    Grava o snapshot desta execução da UF a partir do mais recente e dos registros
+    buscados (tabela Arrow, ver ColetorSnapshot), compara com o anterior e remove os
+    snapshots além dos mantidos. Sem snapshot anterior, o novo tem só os registros
+    buscados: por isso a execução sem snapshot consulta todos os códigos da UF (ver
+    snapshot_ausente).
+    Retorna o resumo da comparação com as quantidades e o caminho do snapshot.
+    """
+    sigla = SIGLAS_UF[uf]
+    with metricas.etapa('snapshot', uf=sigla) as etapa:
+        etapa['entrada'] = buscados.num_rows
+        existentes = listar_snapshots(uf)
+        anterior = ler_snapshot(existentes[-1]) if existentes else None
+        atual = mesclar_snapshot(anterior, buscados, codigos_atuais)
+
+        inicio = time.perf_counter()
+        diferencas = comparar_snapshots(anterior, atual)
+        segundos_comparacao = time.perf_counter() - inicio
+
+        caminho = os.path.join(pasta_snapshots(uf),
+                               f"cnes_snapshot_{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.parquet")
+        gravar_snapshot(atual, caminho)
+        for antigo in listar_snapshots(uf)[:-max(mantidos, 1)]:
+            os.remove(antigo)
+        etapa['saida'] = atual.num_rows
+
+    resumo = {'registros': atual.num_rows, 'novos': len(diferencas['novos']),
+              'alterados': len(diferencas['alterados']), 'removidos': len(diferencas['removidos']),
+              'inalterados': diferencas['inalterados'], 'comparacao_ms': round(segundos_comparacao * 1000, 2),
+              'bytes': os.path.getsize(caminho), 'caminho': caminho}
+    print(f"🗂️ {sigla}: snapshot com {resumo['registros']} registros ({resumo['bytes'] / 1024:.0f} KB): "
+          f"{resumo['novos']} novos, {resumo['alterados']} alterados, {resumo['removidos']} removidos, "
+          f"{resumo['inalterados']} inalterados (comparação em {resumo['comparacao_ms']} ms)")
+    return resumo
+
+
+def main():
+    from EstabelecimentosCsvDownload import UFS, ler_ufs
+
+    parser = argparse.ArgumentParser(description='Compara os dois snapshots mais recentes de cada UF')
+    parser.add_argument('--ufs', type=ler_ufs, default=UFS,
+                        help='UFs a comparar, ex.: "11,12", "RO,AC" ou "todas" (padrão: CNES_UFS)')
+    parser.add_argument('--listar', type=int, default=10, help='Códigos listados de cada tipo de diferença')
+    args = parser.parse_args()
+
+    sem_snapshots = True
+    for uf in args.ufs:
+        snapshots = listar_snapshots(uf)
+        if len(snapshots) < 2:
+            continue
+        sem_snapshots = False
+        anterior, atual = ler_snapshot(snapshots[-2]), ler_snapshot(snapshots[-1])
+        inicio = time.perf_counter()
+        diferencas = comparar_snapshots(anterior, atual)
+        segundos = time.perf_counter() - inicio
+        print(f"🗂️ {SIGLAS_UF[uf]}: {os.path.basename(snapshots[-2])} -> {os.path.basename(snapshots[-1])} "
+              f"({segundos * 1000:.2f} ms)")
+        for tipo in ('novos', 'alterados', 'removidos'):
+            codigos = diferencas[tipo]
+            print(f"  {tipo}: {len(codigos)} {codigos[:args.listar].tolist()}")
+        print(f"  inalterados: {diferencas['inalterados']}")
+    if sem_snapshots:
+        print("❌ Nenhuma UF com dois snapshots para comparar")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
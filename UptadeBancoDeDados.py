@@ -1,7 +1,23 @@
 # pip install psycopg2-binary
 
+import contextlib
+import io
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import zlib
 import psycopg2
 
+from EstabelecimentosCsvDownload import UFS, SIGLAS_UF, pasta_uf
+from MetricasCnes import metricas
+from GerarScriptSQLCnes import (
+    CAMPOS, CHAVE_PRIMARIA, MARCADOR_FIM_LOTE, TAMANHO_LOTE, clausula_conflito, formatar_linha_copy,
+    formatar_registros, montar_upsert, nome_particao
+)
+
 # Configurações do banco (MODIFIQUE AQUI!)
 host = '172.16.111.87'
 database = 'cnes_ro_api_database'
@@ -9,46 +25,549 @@ user = 'servapp'
 password = 'Dev4pp$auded1gital'
 port = 5432
 
-# Arquivo SQL para executar
-arquivo_sql = 'downloads/cnes_upserts.sql'
+# Arquivo SQL para executar (na pasta de trabalho de cada UF)
+arquivo_sql = 'cnes_upserts.sql'
+
+# Modo de carga: 'copy' (COPY do JSONL para staging + merge único) ou 'sql' (script de UPSERTs em lotes)
+MODO_CARGA = os.environ.get('CNES_MODO_CARGA', 'copy')
+
+# Carga paralela (CarregadorParalelo): conexões simultâneas com o banco, cada uma com
+# os registros de uma faixa do hash de codigo_cnes, e tentativas de cada lote antes de
+# ele ser dado como falho. Com 1 conexão, a carga é feita na conexão de quem chama.
+CONEXOES_CARGA = int(os.environ.get('CNES_CONEXOES_CARGA', '4'))
+TENTATIVAS_LOTE = int(os.environ.get('CNES_TENTATIVAS_LOTE', '3'))
+# Lotes prontos à espera de cada conexão; com a fila cheia, quem envia espera
+LOTES_POR_CONEXAO = 2
+
+# Arquivos da busca na API, lidos diretamente no modo 'copy' (na pasta de trabalho de cada UF)
+arquivo_jsonl = 'cnes_resultados.jsonl'
+arquivo_checkpoint = 'cnes_resultados.checkpoint'
+
 
-try:
-    # Conectar ao banco
-    print("Conectando ao PostgreSQL...")
-    conn = psycopg2.connect(
+def ler_lotes_sql(caminho):
+    """
+    Lê o script gerado por GerarScriptSQLCnes como fluxo, produzindo (comando, quantidade)
+    por lote. Os lotes são separados pela linha MARCADOR_FIM_LOTE, que informa a
+    quantidade de registros do lote (None se não informada).
+    """
+    linhas = []
+    with open(caminho, 'r', encoding='utf-8') as f:
+        for linha in f:
+            if linha.startswith(MARCADOR_FIM_LOTE):
+                quantidade = re.search(r'\((\d+) registros\)', linha)
+                yield ''.join(linhas), int(quantidade.group(1)) if quantidade else None
+                linhas = []
+            elif linhas or (linha.strip() and not linha.startswith('--')):
+                linhas.append(linha)
+    if ''.join(linhas).strip():
+        yield ''.join(linhas), None
+
+
+def conectar():
+    """
+    Abre a conexão com o PostgreSQL usando as configurações acima
+    """
+    return psycopg2.connect(
         host=host,
         database=database,
         user=user,
         password=password,
         port=port
     )
-    cursor = conn.cursor()
-    print("✅ Conectado!")
-    
-    # Ler e executar o arquivo SQL
-    print(f"Executando {arquivo_sql}...")
-    with open(arquivo_sql, 'r', encoding='utf-8') as f:
-        sql_script = f.read()
-    
-    cursor.execute(sql_script)
+
+
+def tabela_particionada(conn, tabela='unidade_saude'):
+    """
+    True se a tabela existe e é particionada
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (tabela,))
+        linha = cursor.fetchone()
+    return bool(linha) and linha[0] == 'p'
+
+
+def garantir_particao_uf(conn, uf):
+    """
+    Cria, se ainda não existir, a partição de unidade_saude da UF (LIST por codigo_uf).
+    unidade_saude precisa já ser particionada (ver ParticionarUnidadeSaude.py).
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", (nome_particao(uf),))
+        if cursor.fetchone()[0] is not None:
+            return
+    if not tabela_particionada(conn):
+        raise Exception("unidade_saude não é particionada por codigo_uf; execute ParticionarUnidadeSaude.py")
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {nome_particao(uf)} "
+                       f"PARTITION OF unidade_saude FOR VALUES IN ({int(uf)})")
     conn.commit()
-    
-    print(f"✅ Script executado com sucesso!")
-    print(f"📊 Registros afetados: {cursor.rowcount}")
-    # Exclui o arquivo SQL após execução bem-sucedida
-    import os
+
+
+def particionar_unidade_saude(conn, ufs=SIGLAS_UF):
+    """
+    Converte unidade_saude em tabela particionada por LIST (codigo_uf), com chave
+    primária (codigo_cnes, codigo_uf) e uma partição por UF, copiando os dados da tabela
+    atual. A tabela antiga é mantida como unidade_saude_nao_particionada, para conferência.
+    Tudo em uma transação: se algo falhar, nada muda.
+    """
+    if tabela_particionada(conn):
+        print("✅ unidade_saude já é particionada")
+        return False
+    cursor = conn.cursor()
     try:
-        os.remove(arquivo_sql)
-        print(f"🗑️ Arquivo '{arquivo_sql}' excluído com sucesso!")
-    except Exception as e:
-        print(f"⚠️ Não foi possível excluir '{arquivo_sql}': {e}")
-    
-except Exception as e:
-    print(f"❌ Erro: {e}")
-finally:
-    # Fechar conexão
-    if 'cursor' in locals():
+        cursor.execute("SELECT COUNT(*) FROM unidade_saude WHERE codigo_uf IS NULL")
+        sem_uf = cursor.fetchone()[0]
+        if sem_uf:
+            raise Exception(f"{sem_uf} linhas de unidade_saude sem codigo_uf; corrija antes de particionar")
+        cursor.execute("ALTER TABLE unidade_saude RENAME TO unidade_saude_nao_particionada")
+        cursor.execute("ALTER INDEX IF EXISTS unidade_saude_pkey RENAME TO unidade_saude_nao_particionada_pkey")
+        cursor.execute("CREATE TABLE unidade_saude (LIKE unidade_saude_nao_particionada "
+                       "INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY LIST (codigo_uf)")
+        cursor.execute(f"ALTER TABLE unidade_saude ADD PRIMARY KEY ({', '.join(CHAVE_PRIMARIA)})")
+        cursor.execute("SELECT DISTINCT codigo_uf FROM unidade_saude_nao_particionada")
+        ufs = sorted(set(ufs) | {int(uf) for (uf,) in cursor.fetchall()})
+        for uf in ufs:
+            cursor.execute(f"CREATE TABLE {nome_particao(uf)} PARTITION OF unidade_saude FOR VALUES IN ({int(uf)})")
+        cursor.execute("INSERT INTO unidade_saude SELECT * FROM unidade_saude_nao_particionada")
+        print(f"📦 {cursor.rowcount} linhas copiadas para {len(ufs)} partições")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         cursor.close()
-    if 'conn' in locals():
-        conn.close()
-    print("🔌 Conexão fechada")
\ No newline at end of file
+    return True
+
+
+def registrar_linhas_banco(resumo):
+    """
+    Soma nas métricas da execução as linhas inseridas, atualizadas e inalteradas de uma carga
+    """
+    for operacao, quantidade in resumo.items():
+        metricas.contar('linhas_banco', quantidade, operacao=operacao)
+
+
+def carregar_lotes_sql(conn, lotes):
+    """
+    Executa comandos UPSERT gerados por GerarScriptSQLCnes, recebidos como pares
+    (comando, quantidade_de_registros), um lote por transação: um lote com erro não
+    desfaz os demais. Retorna (lotes, falhas, resumo), com o resumo no formato
+    {'inseridos', 'atualizados', 'inalterados'}.
+    """
+    cursor = conn.cursor()
+    total_lotes = 0
+    falhas = 0
+    resumo = {'inseridos': 0, 'atualizados': 0, 'inalterados': 0}
+    try:
+        for comando, quantidade in lotes:
+            total_lotes += 1
+            inicio_lote = time.perf_counter()
+            try:
+                cursor.execute(comando)
+                # Uma linha por registro inserido (true) ou atualizado (false)
+                aplicados = [inserido for (inserido,) in cursor.fetchall()] if cursor.description else []
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                falhas += 1
+                metricas.contar('lotes_com_falha')
+                print(f"❌ Lote {total_lotes} falhou: {e}")
+                continue
+            inseridos = sum(aplicados)
+            atualizados = len(aplicados) - inseridos
+            inalterados = quantidade - len(aplicados) if quantidade is not None else 0
+            resumo['inseridos'] += inseridos
+            resumo['atualizados'] += atualizados
+            resumo['inalterados'] += inalterados
+            registrar_linhas_banco({'inseridos': inseridos, 'atualizados': atualizados, 'inalterados': inalterados})
+            print(f"✅ Lote {total_lotes}: {inseridos} inseridos, {atualizados} atualizados, {inalterados} inalterados "
+                  f"em {time.perf_counter() - inicio_lote:.3f}s")
+    finally:
+        cursor.close()
+    return total_lotes, falhas, resumo
+
+
+def carregar_script_sql(conn, caminho):
+    """
+    Executa o script gerado por GerarScriptSQLCnes (ver carregar_lotes_sql)
+    """
+    return carregar_lotes_sql(conn, ler_lotes_sql(caminho))
+
+
+class LinhasCopy:
+    """
+    Adapta um iterador de linhas de texto (formato COPY) para o objeto de arquivo
+    esperado por cursor.copy_expert, lendo as linhas sob demanda
+    """
+
+    def __init__(self, linhas):
+        self._linhas = linhas
+        self._buffer = ''
+
+    def read(self, tamanho=-1):
+        while tamanho < 0 or len(self._buffer) < tamanho:
+            try:
+                self._buffer += next(self._linhas)
+            except StopIteration:
+                break
+        if tamanho < 0:
+            dados, self._buffer = self._buffer, ''
+        else:
+            dados, self._buffer = self._buffer[:tamanho], self._buffer[tamanho:]
+        return dados
+
+
+class BlocosCopy:
+    """
+    Como LinhasCopy, para um iterador de blocos de bytes já no formato do COPY
+    (ver CodificadorCnes.blocos_copy): cada bloco é lido sem ser copiado de novo
+    """
+
+    def __init__(self, blocos):
+        self._blocos = blocos
+        self._atual = io.BytesIO()
+
+    def read(self, tamanho=-1):
+        while True:
+            dados = self._atual.read(tamanho)
+            if dados:
+                return dados
+            try:
+                self._atual = io.BytesIO(next(self._blocos))
+            except StopIteration:
+                return b''
+
+
+def carregar_via_copy(conn, registros, campos=CAMPOS, tabela='unidade_saude'):
+    """
+    Carrega os registros com COPY ... FROM STDIN em uma tabela temporária de staging
+    (mesma estrutura de unidade_saude) e aplica tudo em tabela (unidade_saude ou, já
+    particionada, a partição da UF: ver nome_particao) com um único
+    INSERT ... SELECT ... ON CONFLICT DO UPDATE, que só atualiza as
+    linhas cujo conteúdo mudou; se um código vier repetido, vale a última cópia recebida
+    (coluna seq da staging). Retorna {'inseridos', 'atualizados', 'inalterados'}.
+    Com pyarrow, os registros são convertidos em blocos pelo codificador tipado
+    (CodificadorCnes), que rejeita os inválidos; sem ele, valor a valor.
+    """
+    from CodificadorCnes import blocos_copy, obter_codificador
+
+    campos_str = ", ".join(campos)
+    if obter_codificador(campos) is not None:
+        comando_copy = f"COPY staging_unidade_saude ({campos_str}) FROM STDIN WITH (FORMAT csv)"
+        dados_copy = BlocosCopy(blocos_copy(registros, campos))
+    else:
+        comando_copy = f"COPY staging_unidade_saude ({campos_str}) FROM STDIN"
+        dados_copy = LinhasCopy(formatar_linha_copy(registro, campos) for registro in registros)
+
+    cursor = conn.cursor()
+    try:
+        inicio = time.perf_counter()
+        # seq numera as linhas na ordem do COPY, para o merge ficar com a última de cada código
+        cursor.execute("CREATE TEMP TABLE staging_unidade_saude "
+                       "(LIKE unidade_saude INCLUDING DEFAULTS, seq bigserial) ON COMMIT DROP")
+        cursor.copy_expert(comando_copy, dados_copy)
+        cursor.execute("SELECT COUNT(*) FROM staging_unidade_saude")
+        recebidos = cursor.fetchone()[0]
+        print(f"📥 COPY: {recebidos} registros na staging em {time.perf_counter() - inicio:.3f}s")
+
+        inicio = time.perf_counter()
+        # xmax = 0 identifica as linhas recém-inseridas (as atualizadas têm xmax preenchido)
+        cursor.execute(f"""
+            WITH aplicados AS (
+                INSERT INTO {tabela} ({campos_str})
+                SELECT DISTINCT ON ({', '.join(CHAVE_PRIMARIA)}) {campos_str} FROM staging_unidade_saude
+                ORDER BY {', '.join(CHAVE_PRIMARIA)}, seq DESC
+                {clausula_conflito(campos, tabela)}
+                RETURNING (xmax = 0) AS inserido
+            )
+            SELECT COUNT(*) FILTER (WHERE inserido), COUNT(*) FILTER (WHERE NOT inserido) FROM aplicados
+        """)
+        inseridos, atualizados = cursor.fetchone()
+        cursor.execute(f"SELECT COUNT(DISTINCT ({', '.join(CHAVE_PRIMARIA)})) FROM staging_unidade_saude")
+        distintos = cursor.fetchone()[0]
+        conn.commit()
+        print(f"🔀 Merge em {tabela} em {time.perf_counter() - inicio:.3f}s")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    resumo = {'inseridos': inseridos, 'atualizados': atualizados, 'inalterados': distintos - inseridos - atualizados}
+    registrar_linhas_banco(resumo)
+    return resumo
+
+
+def aplicar_upsert(conn, registros, tabela='unidade_saude'):
+    """
+    Aplica os registros com um único comando UPSERT (ver GerarScriptSQLCnes) em uma
+    transação. Retorna {'inseridos', 'atualizados', 'inalterados', 'rejeitados'}, com
+    rejeitados os registros que o codificador não deixou chegar ao banco (um lote só
+    com rejeitados não vai ao banco); em caso de erro, desfaz a transação e levanta o erro.
+    """
+    lista_valores = formatar_registros(registros)
+    if not lista_valores:
+        return {'inseridos': 0, 'atualizados': 0, 'inalterados': 0, 'rejeitados': len(registros)}
+    cursor = conn.cursor()
+    try:
+        cursor.execute(montar_upsert(lista_valores, tabela=tabela))
+        aplicados = [inserido for (inserido,) in cursor.fetchall()]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    inseridos = sum(aplicados)
+    resumo = {'inseridos': inseridos, 'atualizados': len(aplicados) - inseridos,
+              'inalterados': len(lista_valores) - len(aplicados)}
+    registrar_linhas_banco(resumo)
+    return dict(resumo, rejeitados=len(registros) - len(lista_valores))
+
+
+class CarregadorParalelo:
+    """
+    Carga com várias conexões: cada registro enviado por enviar(registro) vai para a
+    conexão da faixa do hash do seu codigo_cnes, que o aplica em lotes de até
+    tamanho_lote registros, um lote por transação (COPY + merge no modo 'copy',
+    UPSERT no modo 'sql'). Como um código sempre cai na mesma conexão, duas
+    transações simultâneas nunca disputam a mesma linha, e cada uma segura seus
+    bloqueios só durante um lote.
+    Um lote que falha por erro transitório (conexão perdida, deadlock, timeout) é
+    tentado de novo até tentativas vezes, sozinho, sem desfazer os demais; se ainda
+    assim falhar, ou falhar por erro nos dados, vai para lotes_com_falha e a carga
+    continua. Só um erro ao abrir as conexões interrompe a carga (levantado na
+    próxima chamada de enviar() ou em finalizar()): as demais conexões param no
+    próximo lote, sem esperar pelo fim da fila.
+    """
+
+    def __init__(self, modo=MODO_CARGA, conexoes=CONEXOES_CARGA, tamanho_lote=TAMANHO_LOTE,
+                 tabela='unidade_saude', tentativas=TENTATIVAS_LOTE, fabrica_conexao=conectar):
+        self.modo = modo
+        self.conexoes = max(1, conexoes)
+        self.tamanho_lote = tamanho_lote
+        self.tabela = tabela
+        self.tentativas = max(1, tentativas)
+        self.fabrica_conexao = fabrica_conexao
+        self.pendentes = [{} for _ in range(self.conexoes)]
+        self.filas = [queue.Queue(maxsize=LOTES_POR_CONEXAO) for _ in range(self.conexoes)]
+        self.resumo = {'inseridos': 0, 'atualizados': 0, 'inalterados': 0}
+        self.lotes = 0
+        self.lotes_repetidos = 0
+        self.lotes_com_falha = []
+        self.segundos_aplicando = 0.0
+        self.maior_lote_segundos = 0.0
+        self.erro = None
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._executar, args=(indice,), name=f'carga-cnes-{indice}',
+                                          daemon=True) for indice in range(self.conexoes)]
+
+    def iniciar(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def particao(self, registro):
+        return zlib.crc32(str(registro.get('codigo_cnes')).encode()) % self.conexoes
+
+    def enviar(self, registro):
+        indice = self.particao(registro)
+        pendentes = self.pendentes[indice]
+        # Um código repetido no mesmo lote quebraria o ON CONFLICT: fica o mais recente
+        pendentes[tuple(registro.get(campo) for campo in CHAVE_PRIMARIA)] = registro
+        if len(pendentes) >= self.tamanho_lote:
+            self._despachar(indice)
+
+    def descarregar(self):
+        """
+        Despacha os lotes incompletos, sem esperar que se completem
+        """
+        for indice in range(self.conexoes):
+            self._despachar(indice)
+
+    def finalizar(self):
+        """
+        Despacha o que falta, espera todas as conexões terminarem e retorna o resumo da carga
+        """
+        if self.erro is None:
+            # Se uma conexão falhar no meio, _colocar desiste e o erro é levantado abaixo
+            with contextlib.suppress(RuntimeError):
+                self.descarregar()
+                for fila in self.filas:
+                    self._colocar(fila, None)
+        for thread in self._threads:
+            thread.join()
+        if self.erro is not None:
+            raise self.erro
+        return self.resumo
+
+    def _despachar(self, indice):
+        if not self.pendentes[indice]:
+            return
+        lote = list(self.pendentes[indice].values())
+        self.pendentes[indice] = {}
+        self._colocar(self.filas[indice], lote)
+
+    def _colocar(self, fila, item):
+        while True:
+            if self.erro is not None:
+                raise RuntimeError(f"Carga no banco interrompida: {self.erro}") from self.erro
+            try:
+                fila.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _aplicar(self, conn, lote):
+        if self.modo == 'copy':
+            return carregar_via_copy(conn, lote, tabela=self.tabela)
+        return aplicar_upsert(conn, lote, self.tabela)
+
+    def _executar(self, indice):
+        fila = self.filas[indice]
+        conn = None
+        try:
+            conn = self.fabrica_conexao()
+            # Com erro em outra conexão, a carga foi interrompida: ninguém mais vai encerrar a fila
+            while self.erro is None:
+                try:
+                    lote = fila.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if lote is None:
+                    break
+                inicio = time.perf_counter()
+                conn, resumo = self._aplicar_com_tentativas(conn, lote)
+                with self._lock:
+                    self.lotes += 1
+                    self.segundos_aplicando += time.perf_counter() - inicio
+                    self.maior_lote_segundos = max(self.maior_lote_segundos, time.perf_counter() - inicio)
+                    if resumo is None:
+                        self.lotes_com_falha.append(lote)
+                        continue
+                    for chave in self.resumo:
+                        self.resumo[chave] += resumo[chave]
+        except Exception as e:
+            self.erro = e
+            # Esvazia a fila para não deixar quem envia bloqueado
+            while True:
+                try:
+                    fila.get_nowait()
+                except queue.Empty:
+                    break
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _aplicar_com_tentativas(self, conn, lote):
+        """
+        Aplica um lote, reconectando e repetindo após erros transitórios.
+        Retorna (conexão em uso, resumo), com resumo None se o lote falhou.
+        """
+        for tentativa in range(1, self.tentativas + 1):
+            try:
+                return conn, self._aplicar(conn, lote)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # Inclui deadlock, falha de serialização, lock/statement timeout e conexão perdida
+                print(f"⚠️ Lote de {len(lote)} registros falhou (tentativa {tentativa}/{self.tentativas}): {e}")
+                if tentativa == self.tentativas:
+                    break
+                with self._lock:
+                    self.lotes_repetidos += 1
+                metricas.contar('lotes_repetidos')
+                time.sleep(min(0.5 * 2 ** (tentativa - 1), 10))
+                if conn.closed:
+                    conn = self.fabrica_conexao()
+            except psycopg2.Error as e:
+                # Erro nos dados ou no comando: repetir daria o mesmo resultado
+                print(f"❌ Lote de {len(lote)} registros falhou: {e}")
+                break
+        metricas.contar('lotes_com_falha')
+        return conn, None
+
+
+def carregar_em_paralelo(registros, modo=MODO_CARGA, conexoes=CONEXOES_CARGA, tamanho_lote=TAMANHO_LOTE,
+                         tabela='unidade_saude', fabrica_conexao=conectar):
+    """
+    Carrega os registros (qualquer iterável) com o CarregadorParalelo. Retorna o resumo
+    {'inseridos', 'atualizados', 'inalterados'}; levanta erro se algum lote falhou, depois
+    de aplicar todos os demais.
+    """
+    carregador = CarregadorParalelo(modo, conexoes, tamanho_lote, tabela, fabrica_conexao=fabrica_conexao).iniciar()
+    try:
+        for registro in registros:
+            carregador.enviar(registro)
+    finally:
+        resumo = carregador.finalizar()
+    if carregador.lotes_com_falha:
+        raise Exception(f"{len(carregador.lotes_com_falha)} de {carregador.lotes} lotes falharam")
+    return resumo
+
+
+def main():
+    conn = None
+    try:
+        # Conectar ao banco
+        print("Conectando ao PostgreSQL...")
+        conn = conectar()
+        print("✅ Conectado!")
+        for uf in UFS:
+            print(f"\n🗺️ {SIGLAS_UF[uf]}")
+            garantir_particao_uf(conn, uf)
+            carregar_uf(conn, uf)
+
+    except Exception as e:
+        print(f"❌ Erro: {e}")
+        # Código de saída diferente de zero para o main.py não registrar a execução como concluída
+        sys.exit(1)
+    finally:
+        # Fechar conexão
+        if conn is not None:
+            conn.close()
+        print("🔌 Conexão fechada")
+
+
+def carregar_uf(conn, uf):
+    """
+    Carrega no banco os arquivos da busca (modo 'copy') ou o script SQL (modo 'sql')
+    da pasta de trabalho da UF e os exclui após a carga
+    """
+    caminho_jsonl = os.path.join(pasta_uf(uf), arquivo_jsonl)
+    caminho_sql = os.path.join(pasta_uf(uf), arquivo_sql)
+    if MODO_CARGA == 'copy':
+        # Carga direta do JSONL da busca, sem passar pelo script SQL
+        from BuscarCnesApiOficial import ler_resultados_jsonl
+        print(f"Carregando {caminho_jsonl} via COPY...")
+        inicio = time.perf_counter()
+        resumo = carregar_via_copy(conn, ler_resultados_jsonl(caminho_jsonl), tabela=nome_particao(uf))
+        print(f"✅ Carga concluída em {time.perf_counter() - inicio:.2f}s")
+        print(f"📊 Inseridos: {resumo['inseridos']}, atualizados: {resumo['atualizados']}, "
+              f"inalterados: {resumo['inalterados']}")
+        arquivos_concluidos = [caminho_jsonl, os.path.join(pasta_uf(uf), arquivo_checkpoint)]
+    else:
+        # Ler e executar o arquivo SQL
+        print(f"Executando {caminho_sql}...")
+        inicio = time.perf_counter()
+        lotes, falhas, resumo = carregar_script_sql(conn, caminho_sql)
+
+        # Script só com comentários: nenhum registro mudou desde a última carga
+        if lotes == 0:
+            print("✅ Nenhum registro para atualizar.")
+        elif falhas:
+            raise Exception(f"{falhas} de {lotes} lotes falharam; arquivo '{caminho_sql}' mantido para nova tentativa")
+        else:
+            print(f"✅ Script executado com sucesso! ({lotes} lotes em {time.perf_counter() - inicio:.2f}s)")
+            print(f"📊 Inseridos: {resumo['inseridos']}, atualizados: {resumo['atualizados']}, "
+                  f"inalterados: {resumo['inalterados']}")
+        arquivos_concluidos = [caminho_sql]
+
+    # Exclui os arquivos de entrada após execução bem-sucedida
+    for arquivo in arquivos_concluidos:
+        try:
+            os.remove(arquivo)
+            print(f"🗑️ Arquivo '{arquivo}' excluído com sucesso!")
+        except Exception as e:
+            print(f"⚠️ Não foi possível excluir '{arquivo}': {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 from airflow import DAG
-from airflow.operators.python import PythonOperator
+from airflow.operators.python import PythonOperator, ShortCircuitOperator
 from datetime import datetime, timedelta
+import glob
+import json
 import subprocess
 import sys
+import threading
 import os
 
 # Configurações padrão do DAG
@@ -17,11 +20,14 @@ default_args = {
 }
 
 # Definição do DAG
+# Execução diária: quando o dump do OpenDataSUS não muda, a tarefa de verificação
+# encerra a execução sem baixar nada. O id era 'automacao_cnes_quinzenal' quando a
+# execução era quinzenal: com o novo id, o histórico de execuções do scheduler recomeça
 dag = DAG(
-    'automacao_cnes_quinzenal',
+    'automacao_cnes_diaria',
     default_args=default_args,
-    description='Automação quinzenal para coleta e processamento de dados CNES - Rondônia',
-    schedule_interval=timedelta(days=15),
+    description='Automação diária (com verificação de atualização) para coleta e processamento de dados CNES - Rondônia',
+    schedule_interval=timedelta(days=1),
     catchup=False,
     tags=['cnes', 'rondonia', 'saude', 'automacao'],
     max_active_runs=1,
@@ -48,6 +54,12 @@ def instalar_e_importar(nome_modulo, pacote_pip):
         elif nome_modulo == 'pandas':
             import pandas
             return True, pandas.__version__
+        elif nome_modulo == 'aiohttp':
+            import aiohttp
+            return True, aiohttp.__version__
+        elif nome_modulo == 'pyarrow':
+            import pyarrow
+            return True, pyarrow.__version__
         elif nome_modulo == 'webdriver_manager':
             from webdriver_manager.chrome import ChromeDriverManager
             return True, "OK"
@@ -110,6 +122,14 @@ def instalar_e_importar(nome_modulo, pacote_pip):
             exec('import psycopg2')
             import psycopg2
             return True, psycopg2.__version__
+        elif nome_modulo == 'aiohttp':
+            exec('import aiohttp')
+            import aiohttp
+            return True, aiohttp.__version__
+        elif nome_modulo == 'pyarrow':
+            exec('import pyarrow')
+            import pyarrow
+            return True, pyarrow.__version__
         elif nome_modulo == 'webdriver_manager':
             exec('from webdriver_manager.chrome import ChromeDriverManager')
             from webdriver_manager.chrome import ChromeDriverManager
@@ -138,6 +158,16 @@ def verificar_ambiente(**context):
         # Verificar scripts
         scripts_necessarios = [
             'main.py',
+            'PipelineCnes.py',
+            'ShardsCnes.py',
+            'MetricasCnes.py',
+            'SnapshotCnes.py',
+            'ReconciliacaoCnes.py',
+            'CodificadorCnes.py',
+            'IndiceEspacialCnes.py',
+            'ControleAtualizacaoCnes.py',
+            'EstadoIncrementalCnes.py',
+            'CacheApiCnes.py',
             'EstabelecimentosCsvDownload.py', 
             'BuscarCnesApiOficial.py',
             'GerarScriptSQLCnes.py',
@@ -166,6 +196,8 @@ def verificar_ambiente(**context):
             'requests': 'requests==2.31.0',
             'pandas': 'pandas==2.1.3',
             'psycopg2': 'psycopg2-binary==2.9.9',
+            'aiohttp': 'aiohttp==3.9.1',
+            'pyarrow': 'pyarrow==14.0.1',
             'webdriver_manager': 'webdriver-manager==4.0.1'
         }
         
@@ -179,7 +211,7 @@ def verificar_ambiente(**context):
         
         # Teste final de importação
         try:
-            import selenium, requests, pandas, psycopg2
+            import selenium, requests, pandas, psycopg2, aiohttp, pyarrow
             from webdriver_manager.chrome import ChromeDriverManager
             print("🎉 TESTE FINAL: Todas as dependências importadas com sucesso!")
         except ImportError as e:
@@ -205,62 +237,170 @@ def verificar_ambiente(**context):
         traceback.print_exc()
         raise
 
-def executar_automacao_cnes(**context):
+def verificar_atualizacao(**context):
     """
-    Executa o script main.py que orquestra toda a automação
+    Verifica se o dump do CNES mudou desde a última execução concluída.
+    Retorna False (pulando as tarefas seguintes) quando não houve atualização.
     """
-    main_script = os.path.join(SCRIPTS_DIR, 'main.py')
-    
-    try:
-        print("🚀 Iniciando automação CNES...")
-        print(f"📁 Executando: {main_script}")
-        print(f"📁 Diretório de trabalho: {SCRIPTS_DIR}")
-        print("=" * 60)
-        
-        if not os.path.exists(main_script):
-            raise FileNotFoundError(f"❌ Script main.py não encontrado: {main_script}")
-        
-        # Executar o main.py
-        resultado = subprocess.run([
-            sys.executable, main_script
-        ], 
-        capture_output=True, 
-        text=True, 
+    script = os.path.join(SCRIPTS_DIR, 'ControleAtualizacaoCnes.py')
+    # Mesmo valor de ControleAtualizacaoCnes.CODIGO_SEM_ATUALIZACAO
+    codigo_sem_atualizacao = 3
+
+    resultado = subprocess.run([
+        sys.executable, script
+    ],
+    capture_output=True,
+    text=True,
+    cwd=SCRIPTS_DIR,
+    timeout=300
+    )
+
+    if resultado.stdout:
+        print(resultado.stdout)
+    if resultado.stderr:
+        print(f"⚠️ AVISOS/ERROS: {resultado.stderr}")
+
+    if resultado.returncode == codigo_sem_atualizacao:
+        print("⏭️ Nenhuma atualização no OpenDataSUS. Pulando a automação.")
+        return False
+    return True
+
+# Quantidade de shards (tarefas mapeadas 04_executar_shard que rodam em paralelo)
+NUMERO_SHARDS = int(os.environ.get('CNES_NUMERO_SHARDS', '4'))
+
+def pasta_relatorios(context):
+    """
+    Pasta com os relatórios de execução (MetricasCnes) das tarefas de uma execução do DAG
+    """
+    execucao = ''.join(c if c.isalnum() or c in '-_' else '_' for c in context['run_id'])
+    return os.path.join(SCRIPTS_DIR, 'downloads', 'relatorios', execucao)
+
+def executar_script_cnes(argumentos, timeout, context):
+    """
+    Executa um script da pasta SCRIPTS_DIR mostrando a saída enquanto ele roda e falha se o
+    código de retorno não for 0. O relatório de execução gravado pelo script é publicado
+    no XCom da tarefa (chave 'relatorio') e retornado.
+    """
+    ti = context['ti']
+    nome_relatorio = ti.task_id
+    if getattr(ti, 'map_index', -1) >= 0:
+        nome_relatorio += f'_{ti.map_index}'
+    caminho_relatorio = os.path.join(pasta_relatorios(context), f'{nome_relatorio}.json')
+    # Uma nova tentativa da tarefa não pode publicar o relatório da tentativa anterior
+    if os.path.exists(caminho_relatorio):
+        os.remove(caminho_relatorio)
+    # O textfile do Prometheus é gravado só uma vez, com o consolidado (notificar_conclusao)
+    ambiente = dict(os.environ, PYTHONUNBUFFERED='1', CNES_RELATORIO=caminho_relatorio,
+                    CNES_PROMETHEUS_TEXTFILE='')
+
+    print(f"📁 Executando: {' '.join(argumentos)}")
+    print("📋 SAÍDA:")
+    print("-" * 40)
+    processo = subprocess.Popen(
+        [sys.executable] + argumentos,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1,
         cwd=SCRIPTS_DIR,
-        timeout=3600
-        )
-        
-        # Logs
-        if resultado.stdout:
-            print("📋 SAÍDA DA AUTOMAÇÃO:")
-            print("-" * 40)
-            print(resultado.stdout)
-            print("-" * 40)
-            
-        if resultado.stderr:
-            print("⚠️ AVISOS/ERROS:")
-            print("-" * 40)
-            print(resultado.stderr)
-            print("-" * 40)
-        
-        if resultado.returncode != 0:
-            error_msg = f"❌ Automação falhou com código de retorno: {resultado.returncode}"
-            print(error_msg)
-            raise subprocess.CalledProcessError(resultado.returncode, 'main.py')
-        
-        print("🎉 AUTOMAÇÃO CNES EXECUTADA COM SUCESSO!")
-        return {'status': 'success', 'return_code': resultado.returncode}
-        
-    except Exception as e:
-        print(f"💥 ERRO na automação CNES: {str(e)}")
-        raise
+        env=ambiente,
+    )
+    # O timeout vale para a execução inteira, não para cada linha lida
+    expirou = threading.Event()
+    def encerrar():
+        expirou.set()
+        processo.kill()
+    cronometro = threading.Timer(timeout, encerrar)
+    cronometro.start()
+    try:
+        for linha in processo.stdout:
+            print(linha, end='')
+        codigo_retorno = processo.wait()
+    finally:
+        cronometro.cancel()
+    print("-" * 40)
+
+    relatorio = None
+    try:
+        with open(caminho_relatorio, 'r', encoding='utf-8') as f:
+            relatorio = json.load(f)
+        ti.xcom_push(key='relatorio', value=relatorio)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"⚠️ Relatório de execução não disponível: {e}")
+
+    if expirou.is_set():
+        print(f"❌ {argumentos[0]} excedeu o tempo limite de {timeout}s")
+        raise subprocess.TimeoutExpired(argumentos[0], timeout)
+    if codigo_retorno != 0:
+        print(f"❌ {argumentos[0]} falhou com código de retorno: {codigo_retorno}")
+        raise subprocess.CalledProcessError(codigo_retorno, argumentos[0])
+    return relatorio
+
+def preparar_shards(**context):
+    """
+    Baixa e filtra o dump e divide os códigos a consultar de cada UF em NUMERO_SHARDS arquivos.
+    Retorna os argumentos de cada tarefa 04_executar_shard (lista vazia pula as seguintes).
+    """
+    print("🚀 Iniciando automação CNES...")
+    executar_script_cnes(['ShardsCnes.py', 'preparar', '--shards', str(NUMERO_SHARDS)], 1800, context)
+
+    # Shards de todas as UFs configuradas (CNES_UFS), um diretório por UF
+    shards = sorted(glob.glob(os.path.join(SCRIPTS_DIR, 'downloads', 'uf_*', 'shards', 'shard_*.csv')))
+    if not shards:
+        print("⏭️ Nenhum código para consultar. Pulando a automação.")
+    return [{'caminho_shard': caminho} for caminho in shards]
+
+def executar_shard(caminho_shard, **context):
+    """
+    Busca na API e carrega no banco os códigos de um shard. Uma nova tentativa
+    (retries) repete apenas este shard.
+    """
+    executar_script_cnes(['ShardsCnes.py', 'shard', caminho_shard], 3600, context)
+    print(f"✅ Shard concluído: {os.path.basename(caminho_shard)}")
+
+def reconciliar_shards(**context):
+    """
+    Depois de todos os shards, confirma o estado incremental e registra a execução
+    """
+    executar_script_cnes(['ShardsCnes.py', 'reconciliar'], 600, context)
+    print("🎉 AUTOMAÇÃO CNES EXECUTADA COM SUCESSO!")
 
 def notificar_conclusao(**context):
     """
-    Notifica que a automação foi concluída
+    Consolida os relatórios das tarefas da execução em um só (também no formato do
+    Prometheus, se CNES_PROMETHEUS_TEXTFILE estiver definido) e notifica a conclusão.
+    O consolidado é o retorno da tarefa (XCom).
     """
-    print("📧 Automação CNES quinzenal concluída!")
-    print("📅 Próxima execução: dia 1 ou 15 do próximo mês")
+    pasta = pasta_relatorios(context)
+    caminho_consolidado = os.path.join(pasta, 'consolidado.json')
+    relatorios = sorted(caminho for caminho in glob.glob(os.path.join(pasta, '*.json'))
+                        if caminho != caminho_consolidado)
+    consolidado = None
+    if relatorios:
+        resultado = subprocess.run(
+            [sys.executable, 'MetricasCnes.py', 'consolidar', caminho_consolidado] + relatorios,
+            capture_output=True, text=True, cwd=SCRIPTS_DIR, timeout=300
+        )
+        print(resultado.stdout)
+        if resultado.returncode == 0:
+            with open(caminho_consolidado, 'r', encoding='utf-8') as f:
+                consolidado = json.load(f)
+        else:
+            print(f"⚠️ Falha ao consolidar os relatórios: {resultado.stderr}")
+
+    print("📧 Automação CNES concluída!")
+    if consolidado:
+        print(f"📊 {consolidado['processos']} processos, {consolidado['segundos']:.1f}s, "
+              f"pico de memória {consolidado['pico_rss_mb']:.0f} MB")
+        linhas_banco = {}
+        for contador in consolidado['contadores']:
+            if contador['nome'] == 'linhas_banco':
+                operacao = contador['rotulos'].get('operacao', '?')
+                linhas_banco[operacao] = linhas_banco.get(operacao, 0) + contador['valor']
+        if linhas_banco:
+            print(f"🗄️ Linhas no banco: {linhas_banco}")
+    print("📅 Próxima verificação de atualização: amanhã")
+    return consolidado
 
 # Definição das tarefas
 tarefa_verificar_ambiente = PythonOperator(
@@ -269,17 +409,37 @@ tarefa_verificar_ambiente = PythonOperator(
     dag=dag,
 )
 
-tarefa_executar_automacao = PythonOperator(
-    task_id='02_executar_automacao_cnes',
-    python_callable=executar_automacao_cnes,
+tarefa_verificar_atualizacao = ShortCircuitOperator(
+    task_id='02_verificar_atualizacao',
+    python_callable=verificar_atualizacao,
+    dag=dag,
+)
+
+tarefa_preparar_shards = ShortCircuitOperator(
+    task_id='03_preparar_shards',
+    python_callable=preparar_shards,
+    dag=dag,
+)
+
+# Uma tarefa por shard (mapeamento dinâmico), distribuídas entre os workers disponíveis
+tarefa_executar_shard = PythonOperator.partial(
+    task_id='04_executar_shard',
+    python_callable=executar_shard,
+    dag=dag,
+).expand(op_kwargs=tarefa_preparar_shards.output)
+
+tarefa_reconciliar = PythonOperator(
+    task_id='05_reconciliar_shards',
+    python_callable=reconciliar_shards,
     dag=dag,
 )
 
 tarefa_notificar = PythonOperator(
-    task_id='03_notificar_conclusao',
+    task_id='06_notificar_conclusao',
     python_callable=notificar_conclusao,
     dag=dag,
 )
 
 # Ordem de execução
-tarefa_verificar_ambiente >> tarefa_executar_automacao >> tarefa_notificar
\ No newline at end of file
+tarefa_verificar_ambiente >> tarefa_verificar_atualizacao >> tarefa_preparar_shards
+tarefa_preparar_shards >> tarefa_executar_shard >> tarefa_reconciliar >> tarefa_notificar
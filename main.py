@@ -1,46 +1,88 @@
-import subprocess
-import sys
 import os
+import sys
+
+from MetricasCnes import metricas
+
+
+def executar_etapa(descricao, funcao, *args, **kwargs):
+    print(f"\n{descricao}...")
+    try:
+        with metricas.etapa(funcao.__name__):
+            resultado = funcao(*args, **kwargs)
+    except Exception as e:
+        print(f"❌ Falha na etapa '{descricao}': {e}")
+        print("Parando execução devido ao erro.")
+        sys.exit(1)
+    print(f"✅ {descricao}: concluído!")
+    return resultado
+
 
-def executar_script(script):
+def executar_automacao():
+    from ControleAtualizacaoCnes import carregar_estado, obter_assinatura_recurso, recurso_mudou
+    from EstabelecimentosCsvDownload import UFS, SIGLAS_UF, acessar_opendatasus, separar_codigos_por_uf
+    from PipelineCnes import processar_uf, reiniciar_estado_uf
+    from SnapshotCnes import snapshot_ausente
+
+    print(f"Iniciando automação CNES ({', '.join(SIGLAS_UF[uf] for uf in UFS)})...")
+
+    # CNES_RECARREGAR=1 descarta o estado das UFs configuradas e recarrega todos os seus códigos
+    if os.environ.get('CNES_RECARREGAR') == '1':
+        for uf in UFS:
+            reiniciar_estado_uf(uf)
+
+    # Verificação prévia: se nenhuma UF precisa do dump publicado (nem do primeiro snapshot),
+    # não há nada a fazer
     try:
-        print(f"Executando: {script}")
-        resultado = subprocess.run([
-            sys.executable, script  # ✅ Usar sys.executable
-        ], check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
-        
-        if resultado.stdout:
-            print(f"Saída: {resultado.stdout}")
-        return True
-        
-    except subprocess.CalledProcessError as e:
-        print(f"Erro ao executar {script}: Código {e.returncode}")
-        if e.stdout:
-            print(f"Stdout: {e.stdout}")
-        if e.stderr:
-            print(f"Stderr: {e.stderr}")
-        return False
+        assinatura = obter_assinatura_recurso()
     except Exception as e:
-        print(f"Erro inesperado ao executar {script}: {e}")
-        return False
+        print(f"Não foi possível verificar o recurso, seguindo com a execução: {e}")
+        assinatura = None
+    if assinatura and not any(recurso_mudou(assinatura, carregar_estado(uf)) or snapshot_ausente(uf) for uf in UFS):
+        print("\n⏭️ Dump do CNES não mudou desde a última execução. Nada a fazer.")
+        sys.exit(0)
+
+    # As etapas rodam no mesmo processo e passam os dados em memória;
+    # com CNES_MATERIALIZAR=1 os arquivos intermediários também são gravados (e a
+    # busca e a carga rodam uma depois da outra, como com CNES_EM_FLUXO=0)
+    executar_etapa("Baixando arquivo CSV de estabelecimentos", acessar_opendatasus)
+    # Uma única leitura do dump separa os códigos de todas as UFs configuradas
+    codigos_por_uf = executar_etapa("Filtrando códigos CNES por UF", separar_codigos_por_uf, UFS)
+
+    # Cada UF tem pasta de trabalho, estado e partição próprios: uma falha não afeta as demais
+    falhas = []
+    for uf, codigos in codigos_por_uf.items():
+        if not codigos:
+            print(f"\n❌ {SIGLAS_UF[uf]}: nenhum código CNES encontrado.")
+            falhas.append(SIGLAS_UF[uf])
+            continue
+        print(f"\n🗺️ {SIGLAS_UF[uf]}: buscando dados da API oficial do CNES e atualizando o banco de dados "
+              f"({len(codigos)} códigos)...")
+        try:
+            with metricas.etapa('processar_uf', uf=SIGLAS_UF[uf]) as etapa:
+                etapa['entrada'] = len(codigos)
+                processar_uf(uf, codigos, assinatura)
+            print(f"✅ {SIGLAS_UF[uf]}: concluído!")
+        except Exception as e:
+            print(f"❌ {SIGLAS_UF[uf]}: {e}")
+            falhas.append(SIGLAS_UF[uf])
+
+    if falhas:
+        print(f"\n❌ Falha nas UFs: {', '.join(falhas)}. As demais foram atualizadas.")
+        sys.exit(1)
+    print("\n🎉 Processo de automação CNES finalizado com sucesso!")
+
 
 if __name__ == "__main__":
-    print("Iniciando automação CNES...")
-    
-    scripts = [
-        ("EstabelecimentosCsvDownload.py", "Baixando arquivo CSV de estabelecimentos"),
-        ("BuscarCnesApiOficial.py", "Buscando dados da API oficial do CNES"),
-        ("GerarScriptSQLCnes.py", "Gerando script SQL para atualização do banco"),
-        ("UptadeBancoDeDados.py", "Atualizando banco de dados")
-    ]
-    
-    for script, descricao in scripts:
-        print(f"\n{descricao}...")
-        if executar_script(script):
-            print(f"✅ {script} executado com sucesso!")
-        else:
-            print(f"❌ Falha ao executar {script}")
-            print("Parando execução devido ao erro.")
-            sys.exit(1)
-    
-    print("\n🎉 Processo de automação CNES finalizado com sucesso!")
\ No newline at end of file
+    # Progresso impresso periodicamente durante a execução e relatório JSON ao final
+    # (também quando a execução falha ou não tem nada a fazer), ver MetricasCnes
+    metricas.iniciar_progresso()
+    status = 'erro'
+    try:
+        executar_automacao()
+        status = 'ok'
+    except SystemExit as e:
+        status = 'ok' if not e.code else 'erro'
+        raise
+    finally:
+        metricas.parar_progresso()
+        metricas.gravar(script='main.py', status=status)
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# Os módulos ficam na raiz do repositório e são importados pelo nome, como nos scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Pasta de trabalho isolada: os módulos criam arquivos de estado nela ao serem usados
+os.environ.setdefault('CNES_PASTA_DOWNLOADS', tempfile.mkdtemp(prefix='cnes_testes_'))
@@ -0,0 +1,274 @@
+import asyncio
+import contextlib
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import BuscarCnesApiOficial
+from BuscarCnesApiOficial import (
+    ControleConcorrencia, ControleHedge, consultar_cnes_async, ler_retry_after, requisicao_cnes_async
+)
+
+
+@contextlib.asynccontextmanager
+async def servidor_api(tratar):
+    """
+    Servidor aiohttp local com a rota de estabelecimentos da API; tratar(request, codigo)
+    devolve a resposta. Produz a URL base.
+    """
+    async def estabelecimento(request):
+        return await tratar(request, request.match_info['codigo'])
+
+    app = web.Application()
+    app.router.add_get('/cnes/estabelecimentos/{codigo}', estabelecimento)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    try:
+        yield f'http://127.0.0.1:{runner.addresses[0][1]}'
+    finally:
+        await runner.cleanup()
+
+
+def registro(codigo):
+    return {'codigo_cnes': int(codigo), 'nome_fantasia': f'UNIDADE {codigo}'}
+
+
+@pytest.fixture(autouse=True)
+def backoff_curto(monkeypatch):
+    # Repetições sem Retry-After esperam no máximo alguns centésimos
+    monkeypatch.setattr(BuscarCnesApiOficial, 'BACKOFF_BASE', 0.01)
+
+
+@pytest.mark.parametrize('valor, esperado', [('2', 2.0), ('-5', 0.0), ('', None), ('depois', None)])
+def test_ler_retry_after(valor, esperado):
+    assert ler_retry_after(valor) == esperado
+
+
+def test_retry_after_espera_e_repete():
+    chegadas = []
+
+    async def tratar(request, codigo):
+        chegadas.append(time.monotonic())
+        if len(chegadas) == 1:
+            return web.Response(status=429, headers={'Retry-After': '0.5'})
+        return web.json_response(registro(codigo))
+
+    async def executar():
+        async with servidor_api(tratar) as url, aiohttp.ClientSession() as session:
+            controle = ControleConcorrencia(inicial=8)
+            dados = await requisicao_cnes_async(session, '1234567', 3, url, controle)
+            return dados, controle
+
+    dados, controle = asyncio.run(executar())
+
+    assert dados == registro('1234567')
+    assert len(chegadas) == 2
+    assert chegadas[1] - chegadas[0] >= 0.5
+    # 429 conta como sobrecarga: o limite cai pela metade
+    assert controle.sobrecargas == 1
+    assert controle.limite == 4
+
+
+def test_falha_definitiva_vai_para_falhas():
+    async def tratar(request, codigo):
+        return web.Response(status=503)
+
+    async def executar():
+        falhas = {}
+        async with servidor_api(tratar) as url, aiohttp.ClientSession() as session:
+            dados = await requisicao_cnes_async(session, '1234567', 2, url, falhas=falhas)
+        return dados, falhas
+
+    dados, falhas = asyncio.run(executar())
+
+    assert dados is None
+    assert falhas == {'1234567': {'status': 503, 'tentativas': 2}}
+
+
+def test_hedge_duplica_requisicao_lenta():
+    chegadas = []
+    liberar = asyncio.Event()
+
+    async def tratar(request, codigo):
+        chegadas.append(time.monotonic())
+        if len(chegadas) == 1:
+            # A primeira só responde quando o teste terminar (ou em 5 s)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(liberar.wait(), 5)
+        return web.json_response(registro(codigo))
+
+    async def executar():
+        hedge = ControleHedge(orcamento=1.0, minimo_amostras=50)
+        # Latências anteriores de 50 ms: o p95 passa a ser o limiar de duplicação
+        for _ in range(50):
+            hedge.registrar(0.05)
+        async with servidor_api(tratar) as url, aiohttp.ClientSession() as session:
+            inicio = time.monotonic()
+            dados = await requisicao_cnes_async(session, '1234567', 1, url, hedge=hedge)
+            segundos = time.monotonic() - inicio
+            liberar.set()
+            return dados, segundos, hedge
+
+    dados, segundos, hedge = asyncio.run(executar())
+
+    assert dados == registro('1234567')
+    assert segundos < 2
+    assert len(chegadas) == 2
+    assert hedge.duplicadas == 1
+    assert hedge.vencidas_pela_copia == 1
+
+
+def test_hedge_respeita_orcamento():
+    async def tratar(request, codigo):
+        await asyncio.sleep(0.2)
+        return web.json_response(registro(codigo))
+
+    async def executar():
+        hedge = ControleHedge(orcamento=0, minimo_amostras=50)
+        for _ in range(50):
+            hedge.registrar(0.01)
+        async with servidor_api(tratar) as url, aiohttp.ClientSession() as session:
+            await requisicao_cnes_async(session, '1234567', 1, url, hedge=hedge)
+        return hedge
+
+    hedge = asyncio.run(executar())
+
+    assert hedge.duplicadas == 0
+
+
+def test_hedge_guarda_latencias_limitadas_e_acompanha_a_atual():
+    hedge = ControleHedge(orcamento=0.05, janela=1000, minimo_amostras=100)
+    for _ in range(BuscarCnesApiOficial.AMOSTRA_LATENCIAS):
+        hedge.registrar(0.01)
+    for _ in range(1000):
+        hedge.registrar(0.5)
+
+    assert len(hedge.latencias) == BuscarCnesApiOficial.AMOSTRA_LATENCIAS
+    # O limiar vem só da janela recente, não da execução inteira
+    assert hedge._limiar == 0.5
+
+
+def test_aimd_partida_lenta_e_corte():
+    controle = ControleConcorrencia(inicial=2, maximo=10)
+    for _ in range(3):
+        controle.registrar(0.05, 200)
+    # Até o primeiro corte, +1 por resposta saudável
+    assert controle.limite == 5
+    controle.registrar(0.05, 503)
+    assert controle.limite == 2.5
+    assert not controle.partida_lenta
+    # Depois do corte, +1 só a cada 'limite' respostas saudáveis
+    for _ in range(2):
+        controle.registrar(0.05, 200)
+    assert controle.limite == 2.5
+    controle.registrar(0.05, 200)
+    assert controle.limite == 3.5
+
+
+def test_aimd_acompanha_capacidade_do_servidor():
+    capacidade = 8
+    estado = {'em_andamento': 0, 'maximo': 0}
+
+    async def tratar(request, codigo):
+        estado['em_andamento'] += 1
+        try:
+            estado['maximo'] = max(estado['maximo'], estado['em_andamento'])
+            if estado['em_andamento'] > capacidade:
+                return web.Response(status=503)
+            await asyncio.sleep(0.01)
+            return web.json_response(registro(codigo))
+        finally:
+            estado['em_andamento'] -= 1
+
+    async def executar():
+        controle = ControleConcorrencia(inicial=2, maximo=64)
+        async with servidor_api(tratar) as url:
+            resultados = await consultar_cnes_async([str(1000000 + i) for i in range(400)], 64, 8, url,
+                                                    controle=controle)
+        return resultados, controle
+
+    resultados, controle = asyncio.run(executar())
+
+    assert all(resultados)
+    # O limite cresce a partir do inicial, é cortado pelas sobrecargas e não fica muito acima da capacidade
+    assert controle.limite_maximo_atingido > capacidade
+    assert controle.sobrecargas > 0
+    assert controle.limite <= 2 * capacidade
+
+
+def test_entrega_lenta_nao_trava_o_loop_de_eventos(monkeypatch, tmp_path):
+    from BenchmarkCnes import MockApiCnes
+
+    controles = []
+
+    class HedgeRegistrado(ControleHedge):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            controles.append(self)
+
+    monkeypatch.setattr(BuscarCnesApiOficial, 'ControleHedge', HedgeRegistrado)
+    entregues = []
+
+    def consumidor_lento(registro):
+        # Como um put em uma fila cheia esperando a carga
+        time.sleep(0.02)
+        entregues.append(registro['codigo_cnes'])
+
+    codigos = [str(2000000 + i) for i in range(80)]
+    with MockApiCnes(latencia=0.01) as mock:
+        resumo = BuscarCnesApiOficial.consultar_lista_cnes_api(
+            codigos, pasta_downloads=str(tmp_path), url_base=mock.url, incremental=False, usar_cache=False,
+            ao_registro=consumidor_lento, max_concorrencia=16, tentativas_repescagem=0)
+
+    assert resumo['sucesso'] == len(codigos)
+    assert sorted(entregues) == sorted(int(codigo) for codigo in codigos)
+    # A espera pela entrega não entra na latência medida das requisições (16 x 20 ms se travasse o loop)
+    assert max(controles[0].latencias) < 0.15
+
+
+def test_falhas_definitivas_ficam_fora_da_fila(tmp_path):
+    import http.server
+    import json
+    import threading
+
+    from EstadoIncrementalCnes import conectar_estado, listar_falhas, registrar_falhas
+
+    class Api(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            codigo = self.path.rsplit('/', 1)[-1]
+            status = {'1': 404, '2': 503, '3': 400}.get(codigo[-1], 200)
+            corpo = json.dumps(registro(codigo)).encode() if status == 200 else b'{}'
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, *args):
+            pass
+
+    # Um 404 de uma execução anterior, gravado antes desta correção
+    conn = conectar_estado(str(tmp_path))
+    registrar_falhas(conn, {'2000011': {'status': 404, 'tentativas': 1}})
+    conn.close()
+
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Api)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        resumo = BuscarCnesApiOficial.consultar_lista_cnes_api(
+            [str(2000010 + i) for i in range(4)], pasta_downloads=str(tmp_path),
+            url_base=f'http://127.0.0.1:{httpd.server_address[1]}', incremental=False, usar_cache=False,
+            ao_registro=lambda registro: None, max_retries=2, tentativas_repescagem=0)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert resumo['sucesso'] == 1
+    assert resumo['falhas_definitivas'] == 2
+    conn = conectar_estado(str(tmp_path))
+    assert set(listar_falhas(conn)) == {'2000012'}
+    conn.close()
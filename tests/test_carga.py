@@ -0,0 +1,68 @@
+import threading
+
+import psycopg2
+
+from UptadeBancoDeDados import CarregadorParalelo, carregar_em_paralelo
+
+
+class ConexaoFalsa:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def fabrica_que_falha(falhar_na=2):
+    """
+    Fábrica de conexões em que a chamada de número falhar_na não consegue conectar
+    """
+    chamadas = []
+    lock = threading.Lock()
+
+    def fabrica():
+        with lock:
+            chamadas.append(None)
+            numero = len(chamadas)
+        if numero == falhar_na:
+            raise psycopg2.OperationalError('conexão recusada')
+        return ConexaoFalsa()
+    return fabrica
+
+
+def executar_com_limite(funcao, segundos=15):
+    """
+    Executa funcao em uma thread e devolve a exceção levantada; falha o teste se travar
+    """
+    resultado = {}
+
+    def alvo():
+        try:
+            funcao()
+        except BaseException as e:
+            resultado['erro'] = e
+
+    thread = threading.Thread(target=alvo, daemon=True)
+    thread.start()
+    thread.join(segundos)
+    assert not thread.is_alive(), 'a carga ficou travada'
+    return resultado.get('erro')
+
+
+def test_finalizar_levanta_erro_de_conexao_sem_travar():
+    carregador = CarregadorParalelo('sql', conexoes=3, tamanho_lote=10,
+                                    fabrica_conexao=fabrica_que_falha()).iniciar()
+    for codigo in range(5):
+        carregador.enviar({'codigo_cnes': 2000000 + codigo, 'codigo_uf': 11})
+
+    erro = executar_com_limite(carregador.finalizar)
+
+    assert isinstance(erro, psycopg2.OperationalError)
+
+
+def test_carregar_em_paralelo_levanta_erro_de_conexao_sem_travar():
+    registros = [{'codigo_cnes': 2000000 + codigo, 'codigo_uf': 11} for codigo in range(5)]
+
+    erro = executar_com_limite(lambda: carregar_em_paralelo(registros, 'sql', conexoes=4, tamanho_lote=100,
+                                                            fabrica_conexao=fabrica_que_falha()))
+
+    assert isinstance(erro, psycopg2.OperationalError)
@@ -0,0 +1,157 @@
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+import EstabelecimentosCsvDownload
+from EstabelecimentosCsvDownload import DownloadInvalidoError, baixar_arquivo
+
+# Vários blocos de download (TAMANHO_BLOCO_DOWNLOAD): o corte no meio deixa blocos inteiros no .part
+CONTEUDO = bytes(range(256)) * 4096 * 4  # 4 MiB
+# Dump republicado com o mesmo tamanho: só o If-Range evita juntar as duas versões
+CONTEUDO_NOVO = bytes(reversed(range(256))) * 4096 * 4
+
+
+class ServidorArquivo(http.server.BaseHTTPRequestHandler):
+    """
+    Serve o conteúdo atual (com ETag) com suporte a Range e If-Range. Com cortar_primeira,
+    a primeira resposta anuncia o arquivo inteiro mas fecha a conexão no meio, como um
+    download interrompido; com publicar_apos_primeira, CONTEUDO_NOVO passa a ser servido
+    depois da primeira requisição.
+    """
+    cortar_primeira = False
+    publicar_apos_primeira = False
+    requisicoes = []
+    validadores = []
+
+    def do_GET(self):
+        intervalo = self.headers.get('Range')
+        self.requisicoes.append(intervalo)
+        self.validadores.append(self.headers.get('If-Range'))
+        if self.publicar_apos_primeira and len(self.requisicoes) > 1:
+            conteudo, etag = CONTEUDO_NOVO, '"v2"'
+        else:
+            conteudo, etag = CONTEUDO, '"v1"'
+        # If-Range de outra versão: o Range é ignorado e vai o arquivo inteiro
+        if intervalo and self.headers.get('If-Range') not in (None, etag):
+            intervalo = None
+        inicio = int(intervalo.split('=')[1].rstrip('-')) if intervalo else 0
+        if inicio >= len(conteudo):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        corpo = conteudo[inicio:]
+        if intervalo:
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {inicio}-{len(conteudo) - 1}/{len(conteudo)}')
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        if self.cortar_primeira and len(self.requisicoes) == 1:
+            corpo = corpo[:len(corpo) // 2]
+            self.close_connection = True
+        self.wfile.write(corpo)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def servidor(monkeypatch):
+    # Sem espera entre as tentativas de download
+    monkeypatch.setattr(EstabelecimentosCsvDownload.time, 'sleep', lambda segundos: None)
+    ServidorArquivo.cortar_primeira = False
+    ServidorArquivo.publicar_apos_primeira = False
+    ServidorArquivo.requisicoes = []
+    ServidorArquivo.validadores = []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ServidorArquivo)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/cnes.zip'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_retoma_download_interrompido_com_range(servidor, tmp_path):
+    ServidorArquivo.cortar_primeira = True
+    destino = str(tmp_path / 'cnes.zip')
+
+    baixar_arquivo(servidor, destino, hash_esperado=hashlib.sha256(CONTEUDO).hexdigest())
+
+    with open(destino, 'rb') as f:
+        assert f.read() == CONTEUDO
+    assert not os.path.exists(destino + '.part')
+    # A segunda requisição continua de onde o .part parou
+    assert len(ServidorArquivo.requisicoes) == 2
+    assert ServidorArquivo.requisicoes[0] is None
+    retomado_em = int(ServidorArquivo.requisicoes[1].split('=')[1].rstrip('-'))
+    assert 0 < retomado_em <= len(CONTEUDO) // 2
+    assert ServidorArquivo.validadores[1] == '"v1"'
+    assert not os.path.exists(destino + '.part.validador')
+
+
+def test_dump_republicado_durante_a_retomada_recomeca_do_zero(servidor, tmp_path):
+    ServidorArquivo.cortar_primeira = True
+    ServidorArquivo.publicar_apos_primeira = True
+    destino = str(tmp_path / 'cnes.zip')
+
+    # Sem hash, só o tamanho é conferido, e ele é o mesmo nas duas versões
+    baixar_arquivo(servidor, destino)
+
+    with open(destino, 'rb') as f:
+        assert f.read() == CONTEUDO_NOVO
+    assert ServidorArquivo.validadores[1] == '"v1"'
+
+
+def test_parcial_sem_validador_nao_e_retomado(servidor, tmp_path):
+    destino = str(tmp_path / 'cnes.zip')
+    with open(destino + '.part', 'wb') as f:
+        f.write(CONTEUDO_NOVO[:1000])
+
+    baixar_arquivo(servidor, destino)
+
+    assert ServidorArquivo.requisicoes == [None]
+    with open(destino, 'rb') as f:
+        assert f.read() == CONTEUDO
+
+
+def test_parcial_completo_nao_baixa_de_novo(servidor, tmp_path):
+    destino = str(tmp_path / 'cnes.zip')
+    with open(destino + '.part', 'wb') as f:
+        f.write(CONTEUDO)
+    with open(destino + '.part.validador', 'w', encoding='utf-8') as f:
+        f.write('"v1"')
+
+    baixar_arquivo(servidor, destino, tamanho_esperado=len(CONTEUDO))
+
+    assert ServidorArquivo.requisicoes == [f'bytes={len(CONTEUDO)}-']
+    assert os.path.getsize(destino) == len(CONTEUDO)
+
+
+@pytest.mark.parametrize('hash_esperado', [
+    'sha256:' + hashlib.sha256(b'outro arquivo').hexdigest(),
+    hashlib.md5(b'outro arquivo').hexdigest(),
+])
+def test_checksum_divergente_descarta_download(servidor, tmp_path, hash_esperado):
+    destino = str(tmp_path / 'cnes.zip')
+
+    with pytest.raises(DownloadInvalidoError):
+        baixar_arquivo(servidor, destino, hash_esperado=hash_esperado)
+
+    assert not os.path.exists(destino)
+    assert not os.path.exists(destino + '.part')
+    assert not os.path.exists(destino + '.part.validador')
+
+
+def test_download_maior_que_o_esperado(servidor, tmp_path):
+    destino = str(tmp_path / 'cnes.zip')
+
+    with pytest.raises(DownloadInvalidoError):
+        baixar_arquivo(servidor, destino, tamanho_esperado=len(CONTEUDO) - 1)
+
+    assert not os.path.exists(destino + '.part')